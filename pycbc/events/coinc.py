@@ -24,7 +24,7 @@
 """ This modules contains functions for calculating and manipulating
 coincident triggers.
 """
-import numpy, logging, pycbc.pnutils, copy, lal
+import numpy, logging, pycbc.pnutils, copy, lal, itertools
 
 def background_bin_from_string(background_bins, data):
     """ Return template ids for each bin as defined by the format string
@@ -180,8 +180,13 @@ def timeslide_durations(start1, start2, end1, end2, timeslide_offsets):
         durations.append(abs((seg1 & seg2).coalesce()))
     return numpy.array(durations)
 
-def time_coincidence(t1, t2, window, slide_step=0):
-    """ Find coincidences by time window
+def time_coincidence_chunks(t1, t2, window, slide_step=0, chunk_size=2**22):
+    """ Find coincidences by time window, in chunks of a bounded size
+
+    The times are sorted once and the coincident pairs are generated by
+    sweeping over the sorted times of the first detector, so that each
+    chunk has roughly at most chunk_size pairs. The chunks are in the order
+    of the pairs returned by time_coincidence.
 
     Parameters
     ----------
@@ -194,9 +199,11 @@ def time_coincidence(t1, t2, window, slide_step=0):
     slide_step : optional, {None, float}
         If calculating background coincidences, the interval between background
         slides in seconds.
+    chunk_size : optional, int
+        The number of pairs to generate at once
 
-    Returns
-    -------
+    Yields
+    ------
     idx1 : numpy.ndarray
         Array of indices into the t1 array.
     idx2 : numpy.ndarray
@@ -222,23 +229,204 @@ def time_coincidence(t1, t2, window, slide_step=0):
 
     left = numpy.searchsorted(fold2, fold1 - window)
     right = numpy.searchsorted(fold2, fold1 + window)
+    counts = right - left
+    del fold1, fold2
+
+    # Split the sorted first detector triggers where the number of pairs
+    # crosses a multiple of the chunk size
+    total = counts.cumsum()
+    edges = numpy.searchsorted(total, numpy.arange(chunk_size,
+                               total[-1] if len(total) else 0, chunk_size),
+                               side='right')
+    edges = numpy.unique(numpy.concatenate([[0], edges, [len(counts)]]))
+
+    for start, end in zip(edges[:-1], edges[1:]):
+        num = counts[start:end]
+        idx1 = numpy.repeat(sort1[start:end], num)
+        offset = numpy.repeat(left[start:end] - (num.cumsum() - num), num)
+        idx2 = sort2[numpy.arange(num.sum()) + offset]
+
+        if slide_step:
+            diff = ((t1 / slide_step)[idx1] - (t2 / slide_step)[idx2])
+            slide = numpy.rint(diff)
+        else:
+            slide = numpy.zeros(len(idx1))
 
-    idx1 = numpy.repeat(sort1, right-left)
-    idx2 = [sort2[l:r] for l,r in zip(left, right)]
+        yield idx1.astype(numpy.uint32), idx2.astype(numpy.uint32), \
+              slide.astype(numpy.int32)
 
-    if len(idx2) > 0:
-        idx2 = numpy.concatenate(idx2)
-    else:
-        idx2 = numpy.array([], dtype=numpy.int64)
+def time_coincidence(t1, t2, window, slide_step=0, keep=None,
+                     chunk_size=2**22):
+    """ Find coincidences by time window
 
-    if slide_step:
-        diff = ((t1 / slide_step)[idx1] - (t2 / slide_step)[idx2])
-        slide = numpy.rint(diff)
-    else:
-        slide = numpy.zeros(len(idx1))
+    Parameters
+    ----------
+    t1 : numpy.ndarray
+        Array of trigger times from the first detector
+    t2 : numpy.ndarray
+        Array of trigger times from the second detector
+    window : float
+        The coincidence window in seconds
+    slide_step : optional, {None, float}
+        If calculating background coincidences, the interval between background
+        slides in seconds.
+    keep : optional, function
+        A function of (idx1, idx2, slide) which returns a boolean array of
+        the pairs to keep. It is applied to each chunk of pairs as they are
+        generated, so the rejected pairs, for example background below a
+        statistic threshold, are never all held in memory.
+    chunk_size : optional, int
+        The number of pairs to generate at once
 
-    return idx1.astype(numpy.uint32), idx2.astype(numpy.uint32), slide.astype(numpy.int32)
+    Returns
+    -------
+    idx1 : numpy.ndarray
+        Array of indices into the t1 array.
+    idx2 : numpy.ndarray
+        Array of indices into the t2 array.
+    slide : numpy.ndarray
+        Array of slide ids
+    """
+    idx1, idx2, slide = [], [], []
+    for i1, i2, s in time_coincidence_chunks(t1, t2, window, slide_step,
+                                             chunk_size):
+        if keep is not None:
+            k = keep(i1, i2, s)
+            i1, i2, s = i1[k], i2[k], s[k]
+        idx1.append(i1)
+        idx2.append(i2)
+        slide.append(s)
+
+    if len(idx1) == 0:
+        return numpy.array([], dtype=numpy.uint32), \
+               numpy.array([], dtype=numpy.uint32), \
+               numpy.array([], dtype=numpy.int32)
+    return numpy.concatenate(idx1), numpy.concatenate(idx2), \
+           numpy.concatenate(slide)
+
+def _join(keys1, keys2):
+    """ Return every pair of indices (idx1, idx2) where keys1[idx1] is equal
+    to keys2[idx2]
+    """
+    sort2 = keys2.argsort(kind='mergesort')
+    left = numpy.searchsorted(keys2[sort2], keys1, side='left')
+    right = numpy.searchsorted(keys2[sort2], keys1, side='right')
+    counts = right - left
+    idx1 = numpy.repeat(numpy.arange(len(keys1)), counts)
+    start = numpy.repeat(left - (counts.cumsum() - counts), counts)
+    idx2 = sort2[numpy.arange(counts.sum()) + start]
+    return idx1, idx2
+
+def _row_keys(rows1, rows2):
+    """ Return integer keys for the rows of two 2-d integer arrays, such that
+    equal rows of either array get the same key
+    """
+    key = numpy.zeros(len(rows1) + len(rows2), dtype=numpy.int64)
+    for col in range(rows1.shape[1]):
+        _, inv = numpy.unique(numpy.concatenate([rows1[:, col], rows2[:, col]]),
+                              return_inverse=True)
+        _, key = numpy.unique(key * (inv.max() + 1) + inv, return_inverse=True)
+    return key[:len(rows1)], key[len(rows1):]
+
+def time_multi_coincidence(times, windows, slide_step=0):
+    """ Find coincidences by time window between any number of detectors
+
+    All the 2-, 3- up to N-fold coincidences are found in one pass. The
+    coincident pairs of each two detectors are found once with
+    time_coincidence, and the coincidences of each set of detectors are built
+    by joining the coincidences of the set without its last detector to the
+    pairs of its first and last detectors, and keeping those where the last
+    trigger is also coincident with each of the others. Each coincidence
+    is reported once, with the largest set of detectors whose triggers are
+    all mutually coincident.
+
+    In a timeslide with id `slide` the triggers of the k-th detector are
+    shifted by `slide * k * slide_step`, so with two detectors the slide
+    ids are those of time_coincidence.
 
+    Parameters
+    ----------
+    times : list of numpy.ndarrays
+        The arrays of trigger times of each detector
+    windows : dict
+        The coincidence window in seconds of each two detectors, keyed by the
+        tuple (j, k), j < k, of their positions in the `times` list.
+    slide_step : optional, {None, float}
+        If calculating background coincidences, the interval between background
+        slides in seconds.
+
+    Returns
+    -------
+    ids : numpy.ndarray
+        Array with a row of indices into each detector's time array for each
+        coincidence. The index is -1 for the detectors which are not part of
+        the coincidence.
+    slide : numpy.ndarray
+        Array of slide ids
+    """
+    ndet = len(times)
+    slide_step = slide_step or 0
+    pairs = {}
+    for j, k in itertools.combinations(range(ndet), 2):
+        idx1, idx2, slide = time_coincidence(times[j], times[k],
+                                             windows[j, k],
+                                             (k - j) * slide_step)
+        pairs[j, k] = (numpy.array([idx1, idx2], dtype=numpy.int64).T, slide)
+
+    found = dict(pairs)
+    for num in range(3, ndet + 1):
+        for dets in itertools.combinations(range(ndet), num):
+            ids, slide = found[dets[:-1]]
+            pair_ids, pair_slide = pairs[dets[0], dets[-1]]
+
+            # Match on the trigger of the first detector and the slide id
+            _, inv = numpy.unique(numpy.concatenate([slide, pair_slide]),
+                                  return_inverse=True)
+            nslide = inv.max() + 1 if len(inv) else 1
+            idx1, idx2 = _join(ids[:, 0] * nslide + inv[:len(slide)],
+                               pair_ids[:, 0] * nslide + inv[len(slide):])
+            ids = numpy.concatenate([ids[idx1], pair_ids[idx2, 1:]], axis=1)
+            slide = slide[idx1]
+
+            last = times[dets[-1]][ids[:, -1]] + slide * dets[-1] * slide_step
+            keep = numpy.ones(len(ids), dtype=bool)
+            for pos in range(1, num - 1):
+                det = dets[pos]
+                t = times[det][ids[:, pos]] + slide * det * slide_step
+                keep &= abs(t - last) <= windows[det, dets[-1]]
+            found[dets] = (ids[keep], slide[keep])
+
+    # Remove the coincidences which are part of one with more detectors
+    coincs = dict(found)
+    for dets in coincs:
+        ids, slide = coincs[dets]
+        if len(dets) < 3 or len(ids) == 0:
+            continue
+        for pos in range(len(dets)):
+            sub = dets[:pos] + dets[pos + 1:]
+            sub_ids, sub_slide = found[sub]
+            if len(sub_ids) == 0:
+                continue
+            rows = numpy.concatenate([numpy.delete(ids, pos, axis=1),
+                                      slide[:, None]], axis=1)
+            sub_rows = numpy.concatenate([sub_ids, sub_slide[:, None]], axis=1)
+            key, sub_key = _row_keys(rows, sub_rows)
+            keep = numpy.logical_not(numpy.in1d(sub_key, key))
+            found[sub] = (sub_ids[keep], sub_slide[keep])
+
+    all_ids, all_slides = [], []
+    for dets in sorted(found):
+        ids, slide = found[dets]
+        full = numpy.zeros((len(ids), ndet), dtype=numpy.int64) - 1
+        full[:, list(dets)] = ids
+        all_ids.append(full)
+        all_slides.append(slide)
+
+    if len(all_ids) == 0:
+        return numpy.zeros((0, ndet), dtype=numpy.int64), \
+               numpy.array([], dtype=numpy.int32)
+    return numpy.concatenate(all_ids), \
+           numpy.concatenate(all_slides).astype(numpy.int32)
 
 def cluster_coincs(stat, time1, time2, timeslide_id, slide, window, argmax=numpy.argmax):
     """Cluster coincident events for each timeslide separately, across
@@ -270,12 +458,50 @@ def cluster_coincs(stat, time1, time2, timeslide_id, slide, window, argmax=numpy
         logging.info('No coinc triggers in one, or both, ifos.')
         return numpy.array([])
 
-    indices = []
-    if numpy.isfinite(slide):
-        time = (time2 + (time1 + timeslide_id * slide)) / 2
-    else:
-        time = 0.5 * (time2 + time1)
+    time = _coinc_time(time1, time2, timeslide_id, slide)
+    return _cluster_coincs_by_time(stat, time, timeslide_id, window, argmax)
+
+def cluster_coincs_multi(stat, times, timeslide_id, slide, window,
+                         argmax=numpy.argmax):
+    """Cluster coincident events between any number of detectors for each
+    timeslide separately, across templates, based on the ranking statistic
 
+    Parameters
+    ----------
+    stat: numpy.ndarray
+        vector of ranking values to maximize
+    times: numpy.ndarray
+        Array with a row of the trigger times in each detector for each
+        coincidence, NaN for the detectors which are not part of it. The
+        triggers of the k-th detector are shifted by k * timeslide_id * slide
+        as in time_multi_coincidence.
+    timeslide_id: numpy.ndarray
+        vector that determines the timeslide offset
+    slide: float
+        length of the timeslides offset interval
+    window: float
+        length to cluster over
+
+    Returns
+    -------
+    cindex: numpy.ndarray
+        The set of indices corresponding to the surviving coincidences.
+    """
+    logging.info('clustering coinc triggers over %ss window' % window)
+
+    if len(stat) == 0:
+        logging.info('No coinc triggers.')
+        return numpy.array([])
+
+    times = numpy.array(times, dtype=numpy.float64)
+    if slide and numpy.isfinite(slide):
+        shift = numpy.arange(times.shape[1]) * slide
+        times = times + timeslide_id[:, None] * shift[None, :]
+    time = numpy.nanmean(times, axis=1)
+    return _cluster_coincs_by_time(stat, time, timeslide_id, window, argmax)
+
+def _cluster_coincs_by_time(stat, time, timeslide_id, window, argmax):
+    """Cluster the coincidences with the given times in each timeslide"""
     tslide = timeslide_id.astype(numpy.float128)
     time = time.astype(numpy.float128)
 
@@ -286,6 +512,16 @@ def cluster_coincs(stat, time1, time2, timeslide_id, slide, window, argmax=numpy
     stat = stat[time_sorting]
     time = time[time_sorting]
 
+    indices = _cluster_sorted(stat, time, window, argmax)
+
+    logging.info('done clustering coinc triggers: %s triggers remaining' % len(indices))
+    return time_sorting[indices]
+
+def _cluster_sorted(stat, time, window, argmax):
+    """Cluster time sorted events, keeping those which have the maximum
+    statistic in the window around them. Return the indices of the kept
+    events.
+    """
     logging.info('sorting...')
     left = numpy.searchsorted(time, time - window)
     right = numpy.searchsorted(time, time + window)
@@ -322,10 +558,268 @@ def cluster_coincs(stat, time1, time2, timeslide_id, slide, window, argmax=numpy
         elif max_loc < i:
             i += 1
 
-    indices = indices[:j]
+    return indices[:j]
+
+def _cluster_by_slide(stat, time, timeslide_id, window, chunk_size, argmax):
+    """Cluster the coincidences of each timeslide separately, in chunks of
+    time sorted coincidences. Return the indices of the kept coincidences.
+
+    An event is kept when it has the maximum statistic in the window around
+    it, so a chunk gives the same result as the full timeslide as long as it
+    is clustered together with the events within a window of either end.
+    """
+    slide_sort = timeslide_id.argsort(kind='mergesort')
+    edges = numpy.flatnonzero(numpy.diff(timeslide_id[slide_sort])) + 1
+    edges = numpy.concatenate([[0], edges, [len(slide_sort)]])
+
+    indices = []
+    for start, end in zip(edges[:-1], edges[1:]):
+        locs = slide_sort[start:end]
+        stime = time[locs]
+        time_sorting = stime.argsort()
+        stime = stime[time_sorting]
+        sstat = stat[locs][time_sorting]
+
+        for cstart in range(0, len(stime), chunk_size):
+            cend = min(cstart + chunk_size, len(stime))
+            # Include the events within a window of the ends of the chunk
+            l = numpy.searchsorted(stime, stime[cstart] - window)
+            r = numpy.searchsorted(stime, stime[cend - 1] + window)
+            kept = _cluster_sorted(sstat[l:r], stime[l:r], window, argmax) + l
+            kept = kept[(kept >= cstart) & (kept < cend)]
+            indices.append(locs[time_sorting[kept]])
+
+    if len(indices) == 0:
+        return numpy.array([], dtype=numpy.int64)
+    return numpy.concatenate(indices)
+
+def _coinc_time(time1, time2, timeslide_id, slide):
+    """The time of two detector coincidences used for clustering"""
+    if numpy.isfinite(slide):
+        return (time2 + (time1 + timeslide_id * slide)) / 2
+    else:
+        return 0.5 * (time2 + time1)
+
+def cluster_coincs_chunked(stat, time1, time2, timeslide_id, slide, window,
+                           chunk_size=2**20, argmax=numpy.argmax):
+    """Cluster coincident events for each timeslide separately, across
+    templates, based on the ranking statistic, with a bounded working memory
+
+    This gives the same clustering as cluster_coincs, but the coincidences
+    of each timeslide are clustered separately and in chunks of at most
+    chunk_size time sorted coincidences, so that the memory needed beyond
+    the input arrays is a few arrays of the number of coincidences instead
+    of the many extended precision arrays of cluster_coincs.
 
+    Parameters
+    ----------
+    stat: numpy.ndarray
+        vector of ranking values to maximize
+    time1: numpy.ndarray
+        first time vector
+    time2: numpy.ndarray
+        second time vector
+    timeslide_id: numpy.ndarray
+        vector that determines the timeslide offset
+    slide: float
+        length of the timeslides offset interval
+    window: float
+        length to cluster over
+    chunk_size: int
+        The number of coincidences of a timeslide to cluster at once
+
+    Returns
+    -------
+    cindex: numpy.ndarray
+        The set of indices corresponding to the surviving coincidences.
+    """
+    logging.info('clustering coinc triggers over %ss window in chunks of '
+                 '%s' % (window, chunk_size))
+
+    if len(time1) == 0 or len(time2) == 0:
+        logging.info('No coinc triggers in one, or both, ifos.')
+        return numpy.array([])
+
+    time = _coinc_time(time1, time2, timeslide_id, slide)
+    indices = _cluster_by_slide(stat, time, timeslide_id, window, chunk_size,
+                                argmax)
     logging.info('done clustering coinc triggers: %s triggers remaining' % len(indices))
-    return time_sorting[indices]
+    return indices
+
+def _cluster_task(args):
+    """Cluster a group of timeslides in a worker process"""
+    return _cluster_by_slide(*args)
+
+def cluster_coincs_parallel(stat, time1, time2, timeslide_id, slide, window,
+                            pool, chunk_size=2**20, argmax=numpy.argmax):
+    """Cluster coincident events for each timeslide separately, across
+    templates, based on the ranking statistic, with the timeslides
+    partitioned among the workers of a pool
+
+    This gives the same clustering as cluster_coincs. Each task of the pool
+    clusters whole timeslides, with about chunk_size coincidences per task,
+    as in cluster_coincs_chunked.
+
+    Parameters
+    ----------
+    stat: numpy.ndarray
+        vector of ranking values to maximize
+    time1: numpy.ndarray
+        first time vector
+    time2: numpy.ndarray
+        second time vector
+    timeslide_id: numpy.ndarray
+        vector that determines the timeslide offset
+    slide: float
+        length of the timeslides offset interval
+    window: float
+        length to cluster over
+    pool: object
+        A pool with a map method, such as one from pycbc.pool.choose_pool
+    chunk_size: int
+        The number of coincidences to cluster in each task
+
+    Returns
+    -------
+    cindex: numpy.ndarray
+        The set of indices corresponding to the surviving coincidences.
+    """
+    logging.info('clustering coinc triggers over %ss window in parallel'
+                 % window)
+
+    if len(time1) == 0 or len(time2) == 0:
+        logging.info('No coinc triggers in one, or both, ifos.')
+        return numpy.array([])
+
+    time = _coinc_time(time1, time2, timeslide_id, slide)
+    slide_sort = timeslide_id.argsort(kind='mergesort')
+    sorted_ids = timeslide_id[slide_sort]
+
+    # Split the timeslides into tasks of about chunk_size coincidences
+    edges = numpy.flatnonzero(numpy.diff(sorted_ids)) + 1
+    edges = numpy.concatenate([[0], edges, [len(slide_sort)]])
+    splits = numpy.searchsorted(edges, numpy.arange(0, len(slide_sort),
+                                                    chunk_size))
+    splits = numpy.unique(numpy.concatenate([edges[splits],
+                                             [len(slide_sort)]]))
+    del sorted_ids
+
+    tasks, locs = [], []
+    for start, end in zip(splits[:-1], splits[1:]):
+        loc = slide_sort[start:end]
+        locs.append(loc)
+        tasks.append((stat[loc], time[loc], timeslide_id[loc], window,
+                      chunk_size, argmax))
+    results = pool.map(_cluster_task, tasks)
+    indices = numpy.concatenate([loc[r] for loc, r in zip(locs, results)])
+    logging.info('done clustering coinc triggers: %s triggers remaining' % len(indices))
+    return indices
+
+class RemovableBackground(object):
+    """Background statistic values which can be removed, with the number of
+    louder background events updated after each removal in logarithmic time.
+
+    The decimation factors of the background are kept in a Fenwick tree in
+    the order of the statistic, so that the number of louder background
+    events of a value is a prefix sum over the tree.
+    """
+
+    def __init__(self, stat, dec):
+        """
+        Parameters
+        ----------
+        stat: numpy.ndarray
+            Array of the background statistic values
+        dec: numpy.ndarray
+            Array of the decimation factors for the background statistics
+        """
+        self.sort = stat.argsort(kind='mergesort')
+        self.stat = stat[self.sort]
+        self.dec = numpy.array(dec, dtype=numpy.int64)[self.sort]
+        self.position = numpy.zeros(len(stat), dtype=numpy.int64)
+        self.position[self.sort] = numpy.arange(len(stat))
+        self.alive = numpy.ones(len(stat), dtype=bool)
+        self.total = self.dec.sum()
+        self.first = 0
+
+        # Element i of the tree holds the sum of the i & -i values up to i
+        cumsum = numpy.concatenate([[0], self.dec.cumsum()])
+        i = numpy.arange(1, len(stat) + 1)
+        self.tree = numpy.concatenate([[0], cumsum[i] - cumsum[i - (i & -i)]])
+
+    def __len__(self):
+        """ Return the number of background events which are not removed """
+        return self.alive.sum()
+
+    def _prefix(self, positions):
+        """ The sum of the decimation factors before each sorted position """
+        total = numpy.zeros(len(positions), dtype=numpy.int64)
+        i = numpy.array(positions, dtype=numpy.int64)
+        while (i > 0).any():
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def remove(self, idx):
+        """ Remove background events
+
+        Parameters
+        ----------
+        idx: numpy.ndarray
+            Indices of the events to remove into the original statistic array.
+            Events which are already removed are ignored.
+        """
+        positions = numpy.unique(self.position[idx])
+        positions = positions[self.alive[positions]]
+        self.alive[positions] = False
+        self.total -= self.dec[positions].sum()
+
+        values = -self.dec[positions]
+        i = positions + 1
+        while len(i) > 0:
+            numpy.add.at(self.tree, i, values)
+            i = i + (i & -i)
+            keep = i < len(self.tree)
+            i, values = i[keep], values[keep]
+
+    def n_louder(self, fstat):
+        """ Calculate for each foreground event the number of background
+        events that are louder than it, as calculate_n_louder does for the
+        background which is not removed.
+
+        Parameters
+        ----------
+        fstat: numpy.ndarray
+            Array of the foreground statistic values
+
+        Returns
+        -------
+        fore_n_louder: numpy.ndarray
+            The number of background triggers above each foreground trigger
+        """
+        while self.first < len(self.alive) and not self.alive[self.first]:
+            self.first += 1
+        if self.first == len(self.alive):
+            return numpy.zeros(len(fstat), dtype=numpy.int64)
+
+        quieter = self._prefix(numpy.searchsorted(self.stat, fstat,
+                                                  side='left'))
+        fore_n_louder = self.total - quieter
+        # The events quieter than all of the background are compared to the
+        # quietest background event, as calculate_n_louder does
+        fore_n_louder[quieter == 0] = self.total - self.dec[self.first]
+        return fore_n_louder
+
+    def cumulative(self):
+        """ Return the number of louder background events of each event which
+        is not removed, in the order of the original statistic array
+        """
+        dec = self.dec[self.alive]
+        n_louder = numpy.zeros(len(self.alive), dtype=numpy.int64)
+        n_louder[self.sort[self.alive]] = dec[::-1].cumsum()[::-1] - dec
+        alive = numpy.zeros(len(self.alive), dtype=bool)
+        alive[self.sort] = self.alive
+        return n_louder[alive]
 
 class MultiRingBuffer(object):
     """Dynamic size n-dimensional ring buffer that can expire elements."""
@@ -61,6 +61,37 @@ def threshold_and_cluster(series, threshold, window):
     """
     return
 
+@schemed("pycbc.events.threshold_")
+def threshold_and_cluster_block(block, thresholds, window):
+    """Threshold and cluster each row of a 2-d block of SNR time series.
+
+    Each row is searched as by `ThresholdCluster`: it is divided into
+    windows of fixed length, and the peak of a window is kept if it is above
+    the row's threshold and louder than the peaks of the windows before and
+    after it.
+
+    Parameters
+    ----------
+    block : numpy.ndarray
+        Complex 2-d array, one SNR time series per row, such as a block of
+        rows from batched filtering.
+    thresholds : {float, numpy.ndarray}
+        The threshold on the absolute value of the series, one per row or
+        the same for all rows.
+    window : int
+        The size (in number of samples) of the window over which to cluster.
+
+    Returns
+    -------
+    rows : numpy.ndarray
+        uint32 row of each trigger, in increasing order.
+    locs : numpy.ndarray
+        uint32 index of each trigger in its row, increasing within a row.
+    values : numpy.ndarray
+        Complex values of the triggers.
+    """
+    return
+
 @schemed("pycbc.events.threshold_")
 def _threshold_cluster_factory(series):
     return
@@ -114,6 +145,11 @@ def findchirp_cluster_over_window(times, values, window_length):
     """ Reduce the events by clustering over a window using
     the FindChirp clustering algorithm
 
+    The events are visited once, in the order given. Each event either
+    replaces the current loudest event of the cluster, if it is louder and
+    within the window of it, or starts a new cluster if it is more than the
+    window after it. The run time is linear in the number of events.
+
     Parameters
     -----------
     indices: Array
@@ -130,12 +166,16 @@ def findchirp_cluster_over_window(times, values, window_length):
     """
     assert window_length > 0, 'Clustering window length is not positive'
 
+    tlen = len(times)
+    if tlen < 2:
+        return numpy.arange(tlen)
+
     from weave import inline
-    indices = numpy.zeros(len(times), dtype=int)
-    tlen = len(times) # pylint:disable=unused-variable
+    indices = numpy.zeros(tlen, dtype=int)
     k = numpy.zeros(1, dtype=int)
     absvalues = abs(values) # pylint:disable=unused-variable
-    times = times.astype(int)
+    if times.dtype != int:
+        times = times.astype(int)
     code = """
         int j = 0;
         int curr_ind = 0;
@@ -156,6 +196,61 @@ def findchirp_cluster_over_window(times, values, window_length):
                  extra_compile_args=[WEAVE_FLAGS])
     return indices[0:k[0]+1]
 
+def loudest_in_windows(window_ids, values, times, template_ids):
+    """ Find the loudest event in each window, for events from any number of
+    templates in any order
+
+    This is the clustering over the bank of `EventManager.maximize_over_bank`.
+    The events are visited once, keeping the loudest event seen so far of
+    each window in a table indexed by the window, so they do not need to be
+    sorted. Events of equal value are ordered by time and then by template,
+    which is the order of the sorted events.
+
+    Parameters
+    ----------
+    window_ids : numpy.ndarray
+        Non-negative integer index of the window of each event. Indices which
+        are not used take space in the table, so they should be dense.
+    values : numpy.ndarray
+        The value to maximize.
+    times : numpy.ndarray
+        The time of each event.
+    template_ids : numpy.ndarray
+        The template of each event.
+
+    Returns
+    -------
+    indices : numpy.ndarray
+        The index of the loudest event of each window which has events, in
+        order of the window.
+    """
+    nevents = len(window_ids) # pylint:disable=unused-variable
+    if nevents == 0:
+        return numpy.array([], dtype=int)
+
+    from weave import inline
+    window_ids = numpy.asarray(window_ids).astype(int, copy=False)
+    values = numpy.asarray(values).astype(numpy.float64, copy=False) # pylint:disable=unused-variable
+    times = numpy.asarray(times).astype(int, copy=False) # pylint:disable=unused-variable
+    template_ids = numpy.asarray(template_ids).astype(int, copy=False) # pylint:disable=unused-variable
+    loudest = numpy.zeros(window_ids.max() + 1, dtype=int) - 1
+    code = """
+        for (int i=0; i < nevents; i++){
+            long w = window_ids[i];
+            long j = loudest[w];
+            if ((j < 0) || (values[i] > values[j]) ||
+                ((values[i] == values[j]) && ((times[i] < times[j]) ||
+                    ((times[i] == times[j]) &&
+                     (template_ids[i] < template_ids[j]))))){
+                loudest[w] = i;
+            }
+        }
+    """
+    inline(code, ['window_ids', 'values', 'times', 'template_ids', 'loudest',
+                  'nevents'],
+                 extra_compile_args=[WEAVE_FLAGS])
+    return loudest[loudest >= 0]
+
 def cluster_reduce(idx, snr, window_size):
     """ Reduce the events by clustering over a window
 
@@ -226,6 +321,244 @@ def effsnr(snr, reduced_x2, fac=250.):
     else:
         return effsnr[0]
 
+class TriggerStore(object):
+    """Columnar storage of triggers which can be appended to in amortized
+    constant time.
+
+    Each column of the trigger dtype is held in its own preallocated numpy
+    array. When the arrays are full their capacity is doubled, so the total
+    cost of adding N triggers is O(N) rather than the O(N^2) of repeatedly
+    calling `numpy.append`.
+
+    Parameters
+    ----------
+    dtype : numpy.dtype
+        The structured dtype of the triggers. Each named field becomes a
+        column.
+    capacity : {4096, int}
+        The number of triggers to allocate space for initially.
+    """
+    def __init__(self, dtype, capacity=4096):
+        self.dtype = numpy.dtype(dtype)
+        self.size = 0
+        self.capacity = 0
+        self.columns = {}
+        self._allocate(max(int(capacity), 1))
+
+    def __len__(self):
+        return self.size
+
+    def _allocate(self, capacity):
+        for name in self.dtype.names:
+            col = numpy.zeros(capacity, dtype=self.dtype[name])
+            if name in self.columns:
+                col[0:self.size] = self.columns[name][0:self.size]
+            self.columns[name] = col
+        self.capacity = capacity
+
+    def reserve(self, size):
+        """ Ensure there is space for at least `size` triggers, doubling the
+        capacity as many times as needed.
+        """
+        if size > self.capacity:
+            capacity = self.capacity
+            while capacity < size:
+                capacity *= 2
+            self._allocate(capacity)
+
+    def append(self, events):
+        """ Copy a structured array of triggers, with the same field names as
+        the store, onto the end of the store.
+        """
+        num = len(events)
+        if num == 0:
+            return
+        self.reserve(self.size + num)
+        for name in self.dtype.names:
+            self.columns[name][self.size:self.size + num] = events[name]
+        self.size += num
+
+    def column(self, name):
+        """ Return a view of the named column holding only the stored
+        triggers.
+        """
+        return self.columns[name][0:self.size]
+
+    def array(self):
+        """ Return a new structured array containing all of the stored
+        triggers.
+        """
+        out = numpy.zeros(self.size, dtype=self.dtype)
+        for name in self.dtype.names:
+            out[name] = self.column(name)
+        return out
+
+    def clear(self):
+        """ Remove all triggers, keeping the allocated memory """
+        self.size = 0
+
+class HDFTriggerStream(object):
+    """Append triggers to an HDF file as they are found.
+
+    Each trigger column is a resizable, chunked dataset under 'events/', and
+    the parameters of each template (its hash, duration and normalization)
+    are appended under 'templates/'. Triggers and template parameters are
+    buffered in memory and only written to the datasets once buffer_size
+    triggers are held, or on a commit. Every call to `commit` records in the
+    file attributes the number of events and templates written, and the bank
+    index of the last completed template. Reopening the file with
+    `resume=True` discards anything written after the last commit, so a job
+    which was interrupted can carry on from the template after
+    `last_template`.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the HDF file to write.
+    dtype : numpy.dtype
+        The structured dtype of the triggers.
+    chunk_size : {4096, int}
+        The HDF chunk size of the event datasets.
+    buffer_size : {65536, int}
+        The number of triggers to hold in memory before writing them to the
+        file.
+    resume : {False, bool}
+        If True and the file exists, keep the triggers committed to it, and
+        any other content of the file. Otherwise the file is overwritten.
+    """
+    def __init__(self, filename, dtype, chunk_size=4096, buffer_size=65536,
+                 resume=False):
+        import h5py
+        self.dtype = numpy.dtype(dtype)
+        self.chunk_size = chunk_size
+        self.buffer_size = buffer_size
+        self.buffer = TriggerStore(self.dtype)
+        self.template_buffer = {}
+
+        if resume and os.path.exists(filename):
+            self.f = h5py.File(filename, 'a')
+        else:
+            self.f = h5py.File(filename, 'w')
+
+        if 'events' in self.f:
+            names = tuple(self.f['events'].keys())
+            if sorted(names) != sorted(self.dtype.names):
+                raise ValueError("Trigger columns of %s do not match, "
+                                 "cannot resume from it" % filename)
+            # Drop anything written after the last commit
+            self._resize('events', self.f.attrs['num_events'])
+            self._resize('templates', self.f.attrs['num_templates'])
+        else:
+            for name in self.dtype.names:
+                self.f.create_dataset('events/' + name, (0,),
+                                      maxshape=(None,),
+                                      chunks=(self.chunk_size,),
+                                      dtype=self.dtype[name])
+            self.f.create_group('templates')
+            self.commit(-1)
+
+    def _resize(self, group, size):
+        for name in self.f[group]:
+            self.f[group][name].resize((size,))
+
+    def _append(self, group, name, values, dtype=None):
+        path = group + '/' + name
+        if path not in self.f:
+            self.f.create_dataset(path, (0,), maxshape=(None,),
+                                  chunks=(self.chunk_size,),
+                                  dtype=dtype or numpy.array(values).dtype)
+        dset = self.f[path]
+        start = len(dset)
+        dset.resize((start + len(values),))
+        dset[start:] = values
+
+    @property
+    def num_events(self):
+        """ The number of triggers, including those not yet written """
+        return len(self.f['events/' + self.dtype.names[0]]) + len(self.buffer)
+
+    @property
+    def num_templates(self):
+        return int(self.f.attrs['num_templates'])
+
+    @property
+    def last_template(self):
+        """ The bank index of the last template recorded as complete """
+        return int(self.f.attrs['last_template'])
+
+    def append_events(self, events):
+        """ Append a structured array of triggers """
+        self.buffer.append(events)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def append_templates(self, params):
+        """ Append the parameters of some templates.
+
+        Parameters
+        ----------
+        params : dict
+            Dictionary of arrays, with one entry per template for each
+            parameter.
+        """
+        for name in params:
+            self.template_buffer.setdefault(name, []).extend(params[name])
+
+    def flush(self):
+        """ Write the buffered triggers and template parameters to the
+        datasets of the file
+        """
+        if len(self.buffer):
+            for name in self.dtype.names:
+                self._append('events', name, self.buffer.column(name),
+                             self.dtype[name])
+            self.buffer.clear()
+        for name in self.template_buffer:
+            self._append('templates', name, self.template_buffer[name])
+        self.template_buffer = {}
+
+    def commit(self, last_template):
+        """ Record that everything up to and including the template with bank
+        index last_template has been written, and flush the file to disk.
+        """
+        self.flush()
+        templates = list(self.f['templates'].values())
+        self.f.attrs['num_events'] = self.num_events
+        self.f.attrs['num_templates'] = len(templates[0]) if templates else 0
+        self.f.attrs['last_template'] = last_template
+        self.f.flush()
+
+    def replace_events(self, events):
+        """ Replace all of the triggers with a structured array """
+        self.buffer.clear()
+        for name in self.dtype.names:
+            dset = self.f['events/' + name]
+            dset.resize((len(events),))
+            if len(events):
+                dset[:] = events[name]
+
+    def read_events(self):
+        """ Return all of the triggers as a structured array """
+        self.flush()
+        events = numpy.zeros(self.num_events, dtype=self.dtype)
+        for name in self.dtype.names:
+            events[name] = self.f['events/' + name][:]
+        return events
+
+    def read_column(self, name):
+        """ Return one column of all of the triggers """
+        self.flush()
+        return self.f['events/' + name][:]
+
+    def read_templates(self):
+        """ Return a dictionary of the template parameter arrays """
+        self.flush()
+        return dict((name, self.f['templates/' + name][:])
+                    for name in self.f['templates'])
+
+    def close(self):
+        self.f.close()
+
 class EventManager(object):
     def __init__(self, opt, column, column_types, **kwds):
         self.opt = opt
@@ -235,7 +568,9 @@ class EventManager(object):
         for column, coltype in zip (column, column_types):
             self.event_dtype.append( (column, coltype) )
 
-        self.events = numpy.array([], dtype=self.event_dtype)
+        self.event_store = TriggerStore(self.event_dtype)
+        self._events = None
+        self.stream = None
         self.template_params = []
         self.template_index = -1
         self.template_events = numpy.array([], dtype=self.event_dtype)
@@ -255,23 +590,154 @@ class EventManager(object):
                 setattr(opt, arg, getattr(opt, arg)[ifo])
         return cls(opt, column, column_types, **kwds)
 
+    @property
+    def events(self):
+        """ Structured array of all the finalized triggers.
+
+        The triggers are accumulated in a columnar `TriggerStore`, or in
+        the HDF file given to `stream_to_hdf`, and the array is only built
+        when first requested. It may then be modified or replaced; the store
+        or file is brought up to date from it the next time triggers are
+        added, or the file is committed by `checkpoint`.
+        """
+        if self._events is None:
+            if self.stream is not None:
+                self._events = self.stream.read_events()
+            else:
+                self._events = self.event_store.array()
+        return self._events
+
+    @events.setter
+    def events(self, events):
+        self._events = events
+
+    @property
+    def num_events(self):
+        """ The number of finalized triggers, without building `events` """
+        if self._events is not None:
+            return len(self._events)
+        if self.stream is not None:
+            return self.stream.num_events
+        return len(self.event_store)
+
+    def event_column(self, name):
+        """ Return one column of the finalized triggers. Triggers streamed
+        to an HDF file, and not read back into `events`, are read a column at
+        a time rather than all at once.
+        """
+        if self._events is None and self.stream is not None:
+            return self.stream.read_column(name)
+        return self.events[name]
+
+    def _sync_stream(self):
+        """ Write the events array, which may have been modified, back to
+        the HDF stream
+        """
+        if self._events is not None:
+            self.stream.replace_events(self._events)
+            self._events = None
+
+    def _append_events(self, new_events):
+        """ Add an array of triggers to the finalized triggers """
+        if self.stream is not None:
+            self._sync_stream()
+            self.stream.append_events(new_events)
+            return
+
+        if self._events is not None:
+            self.event_store.clear()
+            self.event_store.append(self._events)
+            self._events = None
+        self.event_store.append(new_events)
+
+    def stream_to_hdf(self, filename, resume=False):
+        """ Write the triggers of each template to an HDF file when they are
+        finalized, instead of holding them in memory until the end of the job.
+        The file is only a store of the unclustered-over-bank triggers, the
+        final output is still written by `write_events`.
+
+        Parameters
+        ----------
+        filename : str
+            The name of the HDF file to stream to.
+        resume : {False, bool}
+            If True and the file exists, load the templates and triggers
+            which were committed to it by an earlier run.
+
+        Returns
+        -------
+        last_template : int
+            The bank index of the last template completed in the file, or -1
+            if there is none. Filtering should restart from the next template.
+        """
+        self.stream = HDFTriggerStream(filename, self.event_dtype,
+                                       resume=resume)
+        self._events = None
+        self.template_params = []
+        templates = self.stream.read_templates()
+        if templates:
+            tmplt = numpy.rec.fromarrays([templates.pop('template_hash'),
+                                          templates.pop('template_duration')],
+                               names='template_hash,template_duration')
+            for i in range(len(tmplt)):
+                params = dict((k, templates[k][i]) for k in templates)
+                params['tmplt'] = tmplt[i]
+                self.template_params.append(params)
+        self.template_index = len(self.template_params) - 1
+        self.streamed_templates = len(self.template_params)
+        return self.stream.last_template
+
+    def merge_events(self, events, template_params):
+        """ Add the finalized triggers and template parameters of another
+        event manager, such as one which filtered a different part of the
+        bank in another process. The template ids of the triggers are
+        renumbered to follow the templates already held.
+
+        Parameters
+        ----------
+        events : numpy.ndarray
+            The `events` of the other event manager.
+        template_params : list of dicts
+            The `template_params` of the other event manager.
+        """
+        events = events.copy()
+        events['template_id'] += len(self.template_params)
+        self.template_params += template_params
+        self.template_index = len(self.template_params) - 1
+        self._append_events(events)
+
+    def checkpoint(self, last_template):
+        """ Record that the templates up to and including bank index
+        last_template are complete. If streaming to an HDF file, everything
+        finalized so far is committed to it.
+        """
+        if self.stream is not None:
+            self._sync_stream()
+            self.stream.commit(last_template)
+
     def chisq_threshold(self, value, num_bins, delta=0):
-        remove = []
-        for i, event in enumerate(self.events):
-            xi = event['chisq'] / (event['chisq_dof'] / 2 + 1 + delta * event['snr'].conj() * event['snr'])
-            if xi > value:
-                remove.append(i)
-        self.events = numpy.delete(self.events, remove)
+        """ Remove events whose reduced chisq, with an optional SNR dependent
+        correction, is larger than the given value
+        """
+        if len(self.events) == 0:
+            return
+
+        e = self.events
+        snr_sqr = e['snr'].real ** 2 + e['snr'].imag ** 2
+        xi = e['chisq'] / (e['chisq_dof'] / 2 + 1 + delta * snr_sqr)
+        self.events = e[~(xi > value)]
 
     def newsnr_threshold(self, threshold):
         """ Remove events with newsnr smaller than given threshold
         """
         if not self.opt.chisq_bins:
             raise RuntimeError('Chi-square test must be enabled in order to use newsnr threshold')
+        if len(self.events) == 0:
+            return
 
-        remove = [i for i, e in enumerate(self.events) if \
-            newsnr(abs(e['snr']), e['chisq'] / e['chisq_dof']) < threshold]
-        self.events = numpy.delete(self.events, remove)
+        e = self.events
+        nsnr = newsnr(abs(e['snr']), e['chisq'] / e['chisq_dof'])
+        self.events = e[~(nsnr < threshold)]
 
     def keep_near_injection(self, window, injections):
         from pycbc.events.veto import indices_within_times
@@ -285,6 +751,9 @@ class EventManager(object):
         self.events = self.events[i]
 
     def keep_loudest_in_interval(self, window, num_keep):
+        """ Keep only the num_keep loudest events, by newsnr, in each time
+        interval of the given length (in samples)
+        """
         if len(self.events) == 0:
             return
 
@@ -293,58 +762,158 @@ class EventManager(object):
         time = e['time_index']
 
         wtime = (time / window).astype(numpy.int32)
-        bins = numpy.unique(wtime)
 
-        keep = []
-        for b in bins:
-            bloc = numpy.where((wtime == b))[0]
-            bloudest = stat[bloc].argsort()[-num_keep:]
-            keep.append(bloc[bloudest])
-        keep = numpy.concatenate(keep)
-        self.events = e[keep]
+        # Sort by interval, then by statistic, and keep the last num_keep
+        # events of each interval
+        order = numpy.lexsort((stat, wtime))
+        wtime = wtime[order]
+        bin_end = numpy.searchsorted(wtime, wtime, side='right')
+        keep = (bin_end - numpy.arange(len(wtime))) <= num_keep
+        self.events = e[order[keep]]
 
     def maximize_over_bank(self, tcolumn, column, window):
+        """ Keep only the loudest event, by the absolute value of column, in
+        each window of the given length (in samples). The windows are
+        aligned to the start of each GPS second, as in lalapps_inspiral.
+        """
         if len(self.events) == 0:
             return
 
-        self.events = numpy.sort(self.events, order=tcolumn)
-        cvec = self.events[column]
-        tvec = self.events[tcolumn]
-
-        indices = []
-#        mint = tvec.min()
-#        maxt = tvec.max()
-#        edges = numpy.arange(mint, maxt, window)
-
-#        # Get the location of each time bin
-#        bins = numpy.searchsorted(tvec, edges)
-#        bins = numpy.append(bins, len(tvec))
-#        for i in range(len(bins)-1):
-#            kmin = bins[i]
-#            kmax = bins[i+1]
-#            if kmin == kmax:
-#                continue
-#            event_idx = numpy.argmax(cvec[kmin:kmax]) + kmin
-#            indices.append(event_idx)
-
-        # This algorithm is confusing, but it is what lalapps_inspiral does
-        # REMOVE ME!!!!!!!!!!!
+        e = self.events
+        tvec = e[tcolumn]
+        gps_sec, win = self._maximization_windows(tvec, window)
+
+        # Number the windows in time order, so that the loudest event of each
+        # can be found without sorting the events
+        gps_sec = (gps_sec - gps_sec.min()).astype(int)
+        window_ids = gps_sec * (win.max() + 1) + win
+        keep = loudest_in_windows(window_ids, abs(e[column]), tvec,
+                                  e['template_id'])
+        self.events = numpy.take(e, keep)
+
+    def _maximization_windows(self, tvec, window):
+        """ Return the GPS second and the index of the window within it of
+        each time index, for maximize_over_bank
+        """
         gps = tvec.astype(numpy.float64) / self.opt.sample_rate + self.opt.gps_start_time
         gps_sec  = numpy.floor(gps)
         gps_nsec = (gps - gps_sec) * 1e9
 
         wnsec = int(window * 1e9 / self.opt.sample_rate)
-        win = gps_nsec.astype(int) / wnsec
+        win = gps_nsec.astype(int) // wnsec
+        return gps_sec, win
+
+    def compute_deferred_vetoes(self, compute_vetoes, passes, min_snr=None,
+                                loudest=None, keep=None,
+                                maximization_window=None):
+        """ Compute the signal consistency tests of the triggers, which were
+        found without them, only for the triggers which could survive the
+        final cuts, and remove the others.
+
+        The cuts are taken to be those applied at the end of pycbc_inspiral,
+        in order: cuts on each trigger using its tests (`passes`),
+        `keep_loudest_in_interval` (`loudest`), cuts on each trigger by time
+        (`keep`) and `maximize_over_bank` on the snr (`maximization_window`).
+        As newsnr is never larger than the snr, the snr bounds the ranking
+        statistic of a trigger whose tests are not known. The tests are
+        computed in rounds, in order of decreasing snr in each interval or
+        window, until the triggers which are left in it cannot be kept.
+        Applying the same cuts to the remaining triggers gives the same
+        result as applying them to all the triggers with their tests.
 
-        indices.append(0)
-        for i in xrange(len(tvec)):
-            if gps_sec[i] == gps_sec[indices[-1]] and  win[i] == win[indices[-1]]:
-                if abs(cvec[i]) > abs(cvec[indices[-1]]):
-                    indices[-1] = i
-            else:
-                indices.append(i)
-
-        self.events = numpy.take(self.events, indices)
+        Parameters
+        ----------
+        compute_vetoes : function
+            Called with the events array and an array of positions in it,
+            fills in the tests of those triggers.
+        passes : function
+            Called with an array of triggers with their tests, returns a
+            boolean array of those which pass the cuts on each trigger.
+        min_snr : {None, float}
+            Triggers with a smaller snr cannot pass those cuts.
+        loudest : {None, tuple}
+            The interval (in samples) and number of triggers kept by
+            `keep_loudest_in_interval`.
+        keep : {None, numpy.ndarray}
+            Boolean array of the triggers kept by the cuts by time.
+        maximization_window : {None, int}
+            The window (in samples) of `maximize_over_bank`.
+
+        Returns
+        -------
+        num_computed : int
+            The number of triggers whose tests were computed.
+        """
+        e = self.events
+        snr = abs(e['snr'])
+        alive = numpy.ones(len(e), dtype=bool)
+        if min_snr is not None:
+            alive &= snr >= min_snr
+        done = numpy.zeros(len(e), dtype=bool)
+
+        def compute(positions):
+            positions = positions[~done[positions]]
+            if len(positions):
+                compute_vetoes(e, positions)
+                done[positions] = True
+                alive[positions] &= passes(e[positions])
+
+        def bins_by_snr(*keys):
+            # Positions of the triggers in each bin, loudest first
+            order = numpy.lexsort((-snr,) + keys)
+            new_bin = numpy.zeros(len(order), dtype=bool)
+            for key in keys:
+                new_bin[1:] |= key[order][1:] != key[order][:-1]
+            return numpy.split(order, numpy.flatnonzero(new_bin))
+
+        def resolve(bins, num_keep, resolved, eligible):
+            # Compute the tests of the loudest eligible triggers in each bin,
+            # doubling the number each round, until the bin is resolved
+            pending = range(len(bins))
+            num = num_keep
+            while pending:
+                compute(numpy.concatenate([bins[b][eligible[bins[b]] &
+                                                   alive[bins[b]] &
+                                                   ~done[bins[b]]][:num]
+                                           for b in pending]))
+                left = []
+                for b in pending:
+                    pos = bins[b][alive[bins[b]] & eligible[bins[b]]]
+                    unknown = pos[~done[pos]]
+                    if len(unknown) and not resolved(pos[done[pos]], unknown):
+                        left.append(b)
+                    else:
+                        alive[unknown] = False
+                pending = left
+                num *= 2
+
+        if loudest is not None and len(e):
+            window, num_keep = loudest
+            def loudest_resolved(known, unknown):
+                if len(known) < num_keep:
+                    return False
+                stat = newsnr(snr[known], e['chisq'][known] /
+                                          e['chisq_dof'][known])
+                return numpy.sort(stat)[-num_keep] > snr[unknown].max()
+            wtime = (e['time_index'] / window).astype(numpy.int32)
+            resolve(bins_by_snr(wtime), num_keep, loudest_resolved, alive)
+
+        # The triggers cut by time may still have displaced others from the
+        # loudest in their interval, so they are only dropped here if their
+        # tests are not known
+        eligible = alive.copy() if keep is None else alive & keep
+
+        if maximization_window is not None and len(e):
+            def maximum_resolved(known, unknown):
+                return len(known) and \
+                       snr[known].max() > snr[unknown].max()
+            gps_sec, win = self._maximization_windows(e['time_index'],
+                                                      maximization_window)
+            resolve(bins_by_snr(win, gps_sec), 1, maximum_resolved, eligible)
+
+        compute(numpy.flatnonzero(alive & eligible))
+        self.events = e[alive & done]
+        return int(done.sum())
 
     def add_template_events(self, columns, vectors):
         """ Add a vector indexed """
@@ -382,9 +951,22 @@ class EventManager(object):
         self.template_params[-1].update(kwds)
 
     def finalize_template_events(self):
-        self.events = numpy.append(self.events, self.template_events)
+        self._append_events(self.template_events)
         self.template_events = numpy.array([], dtype=self.event_dtype)
 
+        if self.stream is not None and \
+                len(self.template_params) > self.streamed_templates:
+            # Only scalar template parameters can be streamed
+            new = self.template_params[self.streamed_templates:]
+            params = {'template_hash': [p['tmplt'].template_hash for p in new],
+                      'template_duration': [p['tmplt'].template_duration
+                                            for p in new]}
+            for key in new[0]:
+                if isinstance(new[0][key], (int, float, numpy.number)):
+                    params[key] = [p[key] for p in new]
+            self.stream.append_templates(params)
+            self.streamed_templates = len(self.template_params)
+
     def make_output_dir(self, outname):
         path = os.path.dirname(outname)
         if path != '':
@@ -427,26 +1009,30 @@ class EventManager(object):
                                       compression_opts=9,
                                       shuffle=True)
 
-        self.events.sort(order='template_id')
+        # Streamed triggers are already in template order
+        if self._events is not None or self.stream is None:
+            self.events.sort(order='template_id')
+        column = self.event_column
+        names = numpy.dtype(self.event_dtype).names
         th = numpy.array([p['tmplt'].template_hash for p in self.template_params])
-        tid = self.events['template_id']
+        tid = column('template_id')
         f = fw(outname, self.opt.channel_name[0:2])
 
-        if len(self.events):
-            f['snr'] = abs(self.events['snr'])
+        if self.num_events:
+            f['snr'] = abs(column('snr'))
             try:
                 # Precessing
-                f['u_vals'] = self.events['u_vals']
-                f['coa_phase'] = self.events['coa_phase']
-                f['hplus_cross_corr'] = self.events['hplus_cross_corr']
+                f['u_vals'] = column('u_vals')
+                f['coa_phase'] = column('coa_phase')
+                f['hplus_cross_corr'] = column('hplus_cross_corr')
             except Exception:
                 # Not precessing
-                f['coa_phase'] = numpy.angle(self.events['snr'])
-            f['chisq'] = self.events['chisq']
-            f['bank_chisq'] = self.events['bank_chisq']
-            f['bank_chisq_dof'] = self.events['bank_chisq_dof']
-            f['cont_chisq'] = self.events['cont_chisq']
-            f['end_time'] = self.events['time_index'] / float(self.opt.sample_rate) + self.opt.gps_start_time
+                f['coa_phase'] = numpy.angle(column('snr'))
+            f['chisq'] = column('chisq')
+            f['bank_chisq'] = column('bank_chisq')
+            f['bank_chisq_dof'] = column('bank_chisq_dof')
+            f['cont_chisq'] = column('cont_chisq')
+            f['end_time'] = column('time_index') / float(self.opt.sample_rate) + self.opt.gps_start_time
             try:
                 # Precessing
                 template_sigmasq_plus = numpy.array([t['sigmasq_plus'] for t in self.template_params], dtype=numpy.float32)
@@ -474,20 +1060,20 @@ class EventManager(object):
                 cont_dof = cont_dof * 2
             if self.opt.autochi_max_valued_dof:
                 cont_dof = self.opt.autochi_max_valued_dof
-            f['cont_chisq_dof'] = numpy.repeat(cont_dof, len(self.events))
+            f['cont_chisq_dof'] = numpy.repeat(cont_dof, self.num_events)
 
-            if 'chisq_dof' in self.events.dtype.names:
-                f['chisq_dof'] = self.events['chisq_dof'] / 2 + 1
+            if 'chisq_dof' in names:
+                f['chisq_dof'] = column('chisq_dof') / 2 + 1
             else:
-                f['chisq_dof'] = numpy.zeros(len(self.events))
+                f['chisq_dof'] = numpy.zeros(self.num_events)
 
             f['template_hash'] = th[tid]
 
-            if 'sg_chisq' in self.events.dtype.names:
-                f['sg_chisq'] = self.events['sg_chisq']
+            if 'sg_chisq' in names:
+                f['sg_chisq'] = column('sg_chisq')
 
             if self.opt.psdvar_short_segment is not None:
-                f['psd_var_val'] = self.events['psd_var_val']
+                f['psd_var_val'] = column('psd_var_val')
 
         if self.opt.trig_start_time:
             f['search/start_time'] = numpy.array([self.opt.trig_start_time])
@@ -557,7 +1143,9 @@ class EventManagerMultiDet(EventManager):
         for column, coltype in zip (column, column_types):
             self.event_dtype.append( (column, coltype) )
 
-        self.events = numpy.array([], dtype=self.event_dtype)
+        self.event_store = TriggerStore(self.event_dtype)
+        self._events = None
+        self.stream = None
         self.event_id_map = {}
         self.event_index = 0
         self.template_params = []
@@ -622,8 +1210,7 @@ class EventManagerMultiDet(EventManager):
                         event2 = self.template_event_dict[ifo2][idx2]
                         self.coinc_list.append((event1, event2))
         for ifo in self.ifos:
-            self.events = numpy.append(self.events,
-                                       self.template_event_dict[ifo])
+            self._append_events(self.template_event_dict[ifo])
             self.template_event_dict[ifo] = numpy.array([],
                                                         dtype=self.event_dtype)
 
@@ -764,8 +1351,10 @@ class EventManagerMultiDet(EventManager):
                         f['gating/' + gate_type + '/pad'] = \
                                 numpy.array([g[2] for g in gating_info[gate_type]])
 
-__all__ = ['threshold_and_cluster', 'newsnr', 'effsnr', 'newsnr_sgveto',
-           'findchirp_cluster_over_window',
+__all__ = ['threshold_and_cluster', 'threshold_and_cluster_block',
+           'newsnr', 'effsnr', 'newsnr_sgveto',
+           'findchirp_cluster_over_window', 'loudest_in_windows',
            'threshold', 'cluster_reduce', 'ThresholdCluster',
            'threshold_real_numpy', 'threshold_only',
-           'EventManager', 'EventManagerMultiDet']
+           'EventManager', 'EventManagerMultiDet', 'TriggerStore',
+           'HDFTriggerStream']
@@ -26,7 +26,7 @@ This module defines several C functions that are weave compiled and compute
 a combined thresholding and time clustering of a complex array using a
 multithreaded, SIMD vectoried code.
 
-There are four C functions defined:
+There are five C functions defined:
 
 max_simd: A single-threaded function that uses SIMD vectorization to compute
           the maximum of a complex time series over a given window.
@@ -52,7 +52,11 @@ parallel_thresh_cluster: A multithreaded function that finds the maxima in
                          tests for above threshold, and time-clusters the
                          surviving triggers.
 
-A user calls only the last function; the other three exist to conveniently
+parallel_thresh_cluster_block: The same as parallel_thresh_cluster, for each
+                               row of a block of arrays at once, returning
+                               the triggers of all rows together.
+
+A user calls only the last two functions; the others exist to conveniently
 compartmentalize SIMD code from OpenMP code.
 """
 
@@ -684,6 +688,124 @@ int parallel_thresh_cluster(std::complex<float> * __restrict inarr, const uint32
 
 """
 
+# The batched version of parallel_thresh_cluster, for a block of SNR time
+# series of equal length, one per row.
+
+thresh_cluster_block_support = thresh_cluster_support + """
+int64_t parallel_thresh_cluster_block(std::complex<float> * __restrict inarr,
+                                      const int64_t nrows, const int64_t arrlen,
+                                      const int64_t rowstride,
+                                      const float * __restrict thresh,
+                                      const int64_t winsize, const int64_t segsize,
+                                      uint32_t * __restrict rows,
+                                      uint32_t * __restrict locs,
+                                      std::complex<float> * __restrict values){
+
+  /*
+
+  This function applies the thresholding and clustering of parallel_thresh_cluster
+  to each of 'nrows' complex arrays of length 'arrlen', the start of each being
+  'rowstride' elements after the start of the one before it in 'inarr'. Each row
+  has its own threshold, given in 'thresh'. The clustered triggers of all rows are
+  returned together in 'rows', 'locs' and 'values', ordered by row and then by
+  location, and the number of triggers is returned. The locations are indices into
+  the row. The output arrays must be pre-allocated with room for one trigger per
+  window of each row.
+
+  The window maxima of all chunks of all rows are found in a single parallel loop,
+  so the work is shared between the threads whether there are many short rows or a
+  few long ones.
+
+  */
+
+  int64_t i, r, t, nsegs, nwins_ps, true_segsize, nwin, ntasks, cnt;
+  int64_t *mlocs, *counts;
+  float *norms;
+  std::complex<float> *cvals;
+
+  if (winsize < segsize) {
+    nwins_ps = segsize / winsize;
+  } else {
+    nwins_ps = 1;
+  }
+  true_segsize = nwins_ps * winsize;
+
+  nwin = ( (arrlen % winsize) ? (arrlen/winsize) + 1 : (arrlen/winsize) );
+  nsegs = ( (arrlen % true_segsize) ? (arrlen/true_segsize) + 1 : (arrlen/true_segsize) );
+  ntasks = nrows * nsegs;
+
+  cvals = (std::complex<float> *) malloc(nrows * nwin * sizeof(std::complex<float>) );
+  norms = (float *) malloc(nrows * nwin * sizeof(float) );
+  mlocs = (int64_t *) malloc(nrows * nwin * sizeof(int64_t) );
+  counts = (int64_t *) malloc(nrows * sizeof(int64_t) );
+
+  if ( (cvals == NULL) || (norms == NULL) || (mlocs == NULL) || (counts == NULL) ){
+    error(EXIT_FAILURE, ENOMEM, "Could not allocate temporary memory needed by parallel_thresh_cluster_block");
+  }
+
+#pragma omp parallel for schedule(dynamic,1)
+  for (t = 0; t < ntasks; t++){
+    int64_t row = t / nsegs;
+    int64_t start = (t % nsegs) * true_segsize;
+    int64_t len = ( (start + true_segsize > arrlen) ? arrlen - start : true_segsize );
+    int64_t out = row * nwin + (t % nsegs) * nwins_ps;
+
+    windowed_max(&inarr[row * rowstride + start], len, &cvals[out],
+                 &norms[out], &mlocs[out], winsize, start);
+  }
+
+  // Test each window maximum against the threshold and its neighbours, as
+  // parallel_thresh_cluster does, moving the survivors of each row to the
+  // start of its part of cvals and mlocs.
+
+#pragma omp parallel for schedule(static)
+  for (r = 0; r < nrows; r++){
+    std::complex<float> *rvals = &cvals[r * nwin];
+    float *rnorms = &norms[r * nwin];
+    int64_t *rlocs = &mlocs[r * nwin];
+    float thr_sqr = thresh[r] * thresh[r];
+    int64_t j, c = 0;
+
+    for (j = 0; j < nwin; j++){
+      bool keep = (rnorms[j] > thr_sqr);
+      if (nwin > 1) {
+        if (j == 0) {
+          keep = keep && (rnorms[j] > rnorms[j+1]);
+        } else if (j == nwin-1) {
+          keep = keep && (rnorms[j] > rnorms[j-1]);
+        } else {
+          keep = keep && (rnorms[j] > rnorms[j-1]) && (rnorms[j] >= rnorms[j+1]);
+        }
+      }
+      if (keep) {
+        rvals[c] = rvals[j];
+        rlocs[c] = rlocs[j];
+        c++;
+      }
+    }
+    counts[r] = c;
+  }
+
+  cnt = 0;
+  for (r = 0; r < nrows; r++){
+    for (i = 0; i < counts[r]; i++){
+      rows[cnt] = (uint32_t) r;
+      locs[cnt] = (uint32_t) mlocs[r * nwin + i];
+      values[cnt] = cvals[r * nwin + i];
+      cnt++;
+    }
+  }
+
+  free(cvals);
+  free(norms);
+  free(mlocs);
+  free(counts);
+
+  return cnt;
+}
+
+"""
+
 ### Now some actual code that just implements the different
 ### correlations in a parallelized fashion.
 
@@ -94,6 +94,53 @@ class Stat(object):
         # a buffer of such values.
         self.single_dtype = numpy.float32
 
+    def check_ifos(self, ifos):
+        """Check that the statistic can rank the coincidences of the given
+        detectors. Statistics are only defined for pairs of detectors unless
+        they override this.
+
+        Parameters
+        ----------
+        ifos: list of strs
+            The name of each detector.
+
+        Raises
+        ------
+        ValueError
+            If the statistic can not be used with these detectors.
+        """
+        if len(ifos) != 2:
+            raise ValueError("The %s statistic is only defined for two "
+                             "detectors" % self.__class__.__name__)
+
+    def coinc_multi(self, singles, ifos, slide, steps):
+        """Calculate the coincident detection statistic of any number of
+        detectors.
+
+        Statistics which are only defined for pairs of detectors use their
+        two detector statistic, and raise a ValueError for detectors they
+        can not rank (see `check_ifos`).
+
+        Parameters
+        ----------
+        singles: list of numpy.ndarrays
+            Single detector ranking statistic for each detector.
+        ifos: list of strs
+            The name of each detector.
+        slide: numpy.ndarray
+            Array of ints. These represent the multiple of the timeslide
+        offsets to bring the single detector triggers into coincidence.
+        steps: list of floats
+            The timeslide offset of each detector in seconds.
+
+        Returns
+        -------
+        numpy.ndarray
+            Array of coincident ranking statistic values
+        """
+        self.check_ifos(ifos)
+        return self.coinc(singles[0], singles[1], slide, steps[1] - steps[0])
+
 
 class NewSNRStatistic(Stat):
 
@@ -113,6 +160,10 @@ class NewSNRStatistic(Stat):
         """
         return get_newsnr(trigs)
 
+    def check_ifos(self, ifos):
+        """The statistic can rank the coincidences of any detectors"""
+        pass
+
     def coinc(self, s0, s1, slide, step): # pylint:disable=unused-argument
         """Calculate the coincident detection statistic.
 
@@ -132,6 +183,12 @@ class NewSNRStatistic(Stat):
         """
         return (s0**2. + s1**2.) ** 0.5
 
+    def coinc_multi(self, singles, ifos, slide, steps): # pylint:disable=unused-argument
+        """Calculate the coincident detection statistic of any number of
+        detectors, the quadrature sum of the single detector values.
+        """
+        return sum([s**2. for s in singles]) ** 0.5
+
 
 class NewSNRSGStatistic(NewSNRStatistic):
 
@@ -205,6 +262,15 @@ class NewSNRCutStatistic(NewSNRStatistic):
         cstat[s1==-1] = 0
         return cstat
 
+    def coinc_multi(self, singles, ifos, slide, steps): # pylint:disable=unused-argument
+        """Calculate the coincident detection statistic of any number of
+        detectors, zero if any of the triggers was cut.
+        """
+        cstat = sum([s**2. for s in singles]) ** 0.5
+        for s in singles:
+            cstat[s==-1] = 0
+        return cstat
+
 
 class PhaseTDStatistic(NewSNRStatistic):
 
@@ -227,6 +293,10 @@ class PhaseTDStatistic(NewSNRStatistic):
         self.sbins = self.files['phasetd_newsnr']['sbins'][:]
         self.rbins = self.files['phasetd_newsnr']['rbins'][:]
 
+        # The pair of detectors the histogram was made for
+        attrs = self.files['phasetd_newsnr'].attrs
+        self.hist_ifos = [attrs[k] for k in ['ifo0', 'ifo1'] if k in attrs]
+
         self.single_dtype = [('snglstat', numpy.float32),
                     ('coa_phase', numpy.float32),
                     ('end_time', numpy.float64),
@@ -322,6 +392,21 @@ class PhaseTDStatistic(NewSNRStatistic):
         cstat[cstat < 0] = 0
         return cstat ** 0.5
 
+    def check_ifos(self, ifos):
+        """The signal rate histogram is only defined for the pair of
+        detectors it was made for
+        """
+        Stat.check_ifos(self, ifos)
+        if self.hist_ifos and sorted(ifos) != sorted(self.hist_ifos):
+            raise ValueError("The %s statistic file is for the detectors %s, "
+                             "not %s" % (self.__class__.__name__,
+                                         ' '.join(self.hist_ifos),
+                                         ' '.join(ifos)))
+
+    def coinc_multi(self, singles, ifos, slide, steps):
+        """The signal rate histogram is only defined for pairs of detectors"""
+        return Stat.coinc_multi(self, singles, ifos, slide, steps)
+
 
 class ExpFitStatistic(NewSNRStatistic):
 
@@ -364,6 +449,16 @@ class ExpFitStatistic(NewSNRStatistic):
     def get_ref_vals(self, ifo):
         self.alphamax[ifo] = self.fits_by_tid[ifo]['alpha'].max()
 
+    def check_ifos(self, ifos):
+        """The statistic can rank the coincidences of any detectors with
+        fit coefficients
+        """
+        missing = [i for i in ifos if i not in self.ifos]
+        if missing:
+            raise ValueError("The %s statistic files have no fit "
+                             "coefficients for %s"
+                             % (self.__class__.__name__, ' '.join(missing)))
+
     def find_fits(self, trigs):
         """Get fit coeffs for a specific ifo and template id"""
         tnum = trigs.template_num
@@ -407,6 +502,14 @@ class ExpFitStatistic(NewSNRStatistic):
         # via log likelihood ratio \propto rho_c^2 / 2
         return (2. * loglr) ** 0.5
 
+    def coinc_multi(self, singles, ifos, slide, steps): # pylint:disable=unused-argument
+        """Calculate the final coinc ranking statistic of any number of
+        detectors"""
+        loglr = - sum(singles)
+        threshes = [self.fits_by_tid[i]['thresh'] for i in ifos]
+        loglr += sum([t**2. / 2. for t in threshes])
+        return (2. * loglr) ** 0.5
+
 
 class ExpFitCombinedSNR(ExpFitStatistic):
 
@@ -440,6 +543,10 @@ class ExpFitCombinedSNR(ExpFitStatistic):
         # scale by 1/sqrt(2) to resemble network SNR
         return (s0 + s1) / (2.**0.5)
 
+    def coinc_multi(self, singles, ifos, slide, steps): # pylint:disable=unused-argument
+        # scale by 1/sqrt(number of detectors) to resemble network SNR
+        return sum(singles) / (len(singles)**0.5)
+
 
 class PhaseTDExpFitStatistic(PhaseTDStatistic, ExpFitCombinedSNR):
 
@@ -451,6 +558,13 @@ class PhaseTDExpFitStatistic(PhaseTDStatistic, ExpFitCombinedSNR):
         # need the self.single_dtype value from PhaseTDStatistic
         PhaseTDStatistic.__init__(self, files)
 
+    def check_ifos(self, ifos):
+        """The detectors need both the signal rate histogram and fit
+        coefficients
+        """
+        PhaseTDStatistic.check_ifos(self, ifos)
+        ExpFitCombinedSNR.check_ifos(self, ifos)
+
     def single(self, trigs):
         # same single-ifo stat as ExpFitCombinedSNR
         sngl_stat = ExpFitCombinedSNR.single(self, trigs)
@@ -26,6 +26,7 @@ import numpy
 from pycbc import WEAVE_FLAGS
 from pycbc.weave import inline
 from .simd_threshold import thresh_cluster_support, default_segsize
+from .simd_threshold import thresh_cluster_block_support
 from .events import _BaseThresholdCluster
 from pycbc.opt import omp_libs, omp_flags
 
@@ -127,3 +128,77 @@ class CPUThresholdCluster(_BaseThresholdCluster):
 
 def _threshold_cluster_factory(series):
     return CPUThresholdCluster
+
+def threshold_and_cluster_block_numpy(block, thresholds, window):
+    """ Numpy version of threshold_and_cluster_block
+    """
+    block = numpy.asarray(block)
+    nrows, slen = block.shape
+    thr_sqr = (numpy.zeros(nrows, dtype=numpy.float32) + thresholds) ** 2
+    nwin = (slen + window - 1) // window
+    if nwin * window != slen:
+        padded = numpy.zeros((nrows, nwin * window), dtype=block.dtype)
+        padded[:, 0:slen] = block
+    else:
+        padded = block
+    power = padded.real ** 2 + padded.imag ** 2
+    power = power.reshape(nrows, nwin, window)
+
+    wloc = power.argmax(axis=2)
+    ridx = numpy.arange(nrows)[:, None]
+    widx = numpy.arange(nwin)[None, :]
+    wmax = power[ridx, widx, wloc]
+
+    keep = wmax > thr_sqr[:, None]
+    if nwin > 1:
+        keep[:, 0] &= wmax[:, 0] > wmax[:, 1]
+        keep[:, 1:-1] &= (wmax[:, 1:-1] > wmax[:, :-2]) & \
+                         (wmax[:, 1:-1] >= wmax[:, 2:])
+        keep[:, -1] &= wmax[:, -1] > wmax[:, -2]
+
+    rows, wins = numpy.nonzero(keep)
+    locs = wins * window + wloc[rows, wins]
+    return (rows.astype(numpy.uint32), locs.astype(numpy.uint32),
+            block[rows, locs])
+
+def threshold_and_cluster_block_inline(block, thresholds, window):
+    block = numpy.asarray(block)
+    if block.dtype != numpy.complex64 or block.ndim != 2 or \
+            block.strides[1] != block.itemsize or \
+            block.strides[0] % block.itemsize:
+        block = numpy.ascontiguousarray(block, dtype=numpy.complex64)
+    nrows, slen = block.shape
+    nwin = (slen + window - 1) // window
+    rows = numpy.zeros(nrows * nwin, dtype=numpy.uint32)
+    locs = numpy.zeros(nrows * nwin, dtype=numpy.uint32)
+    values = numpy.zeros(nrows * nwin, dtype=numpy.complex64)
+    if nrows == 0 or slen == 0:
+        return rows, locs, values
+
+    # The rows may be a view into a larger array, as when only the analyzed
+    # part of each SNR time series is searched, so the block is passed as a
+    # flat array running from the start of the first row to the end of the
+    # last, along with the distance between the starts of the rows.
+    rowstride = block.strides[0] // block.itemsize
+    series = numpy.lib.stride_tricks.as_strided(block,
+                        shape=((nrows - 1) * rowstride + slen,),
+                        strides=(block.itemsize,))
+    thresh = numpy.zeros(nrows, dtype=numpy.float32) + thresholds # pylint:disable=unused-variable
+    count = numpy.zeros(1, dtype=numpy.int64)
+    nrows, slen, rowstride = int(nrows), int(slen), int(rowstride)
+    window = int(window) # pylint:disable=unused-variable
+    segsize = int(default_segsize) # pylint:disable=unused-variable
+    code = """
+        count[0] = parallel_thresh_cluster_block(series, (int64_t) nrows,
+                        (int64_t) slen, (int64_t) rowstride, thresh,
+                        (int64_t) window, (int64_t) segsize, rows, locs, values);
+    """
+    inline(code, ['series', 'nrows', 'slen', 'rowstride', 'thresh', 'window',
+                  'segsize', 'rows', 'locs', 'values', 'count'],
+           extra_compile_args=[WEAVE_FLAGS] + omp_flags,
+           support_code=thresh_cluster_block_support, libraries=omp_libs,
+           auto_downcast=1)
+    num = count[0]
+    return rows[0:num], locs[0:num], values[0:num]
+
+threshold_and_cluster_block = threshold_and_cluster_block_inline
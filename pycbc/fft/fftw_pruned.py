@@ -245,7 +245,7 @@ def fft_transpose_fftw(vec):
     """
     global _thetransposeplan
     outvec = pycbc.types.zeros(len(vec), dtype=vec.dtype)
-    if _theplan is None:
+    if _thetransposeplan is None:
         N1, N2 = splay(vec)
         _thetransposeplan = plan_transpose(N1, N2)
     ftexecute(_thetransposeplan, vec.ptr, outvec.ptr)
@@ -275,7 +275,7 @@ def splay(vec):
     """ Determine two lengths to split stride the input vector by
     """
     N2 = 2 ** int(numpy.log2( len(vec) ) / 2)
-    N1 = len(vec) / N2
+    N1 = len(vec) // N2
     return N1, N2
 
 def pruned_c2cifft(invec, outvec, indices, pretransposed=False):
@@ -205,7 +205,7 @@ class MatchedFilterControl(object):
             self.upsample_threshold = upsample_threshold
 
             N_full = self.tlen
-            N_red = N_full / downsample_factor
+            N_red = N_full // downsample_factor
             self.kmin_full, self.kmax_full = get_cutoff_indices(self.flow,
                                               self.fhigh, self.delta_f, N_full)
 
@@ -364,13 +364,27 @@ class MatchedFilterControl(object):
         corr = FrequencySeries(self.corr_mem, delta_f=self.delta_f, copy=False)
         return snr, norm, corr, idx, snrv
 
-    def heirarchical_matched_filter_and_cluster(self, segnum, template_norm, window):
+    def heirarchical_matched_filter_and_cluster(self, segnum, template_norm,
+                                                window, epoch=None):
         """ Returns the complex snr timeseries, normalization of the complex snr,
         the correlation vector frequency series, the list of indices of the
         triggers, and the snr values at the trigger locations. Returns empty
         lists for these for points that are not above the threshold.
 
-        Calculated the matched filter, threshold, and cluster.
+        The SNR is first calculated at a sample rate reduced by
+        `downsample_factor`, using only the frequencies below the reduced
+        Nyquist frequency, and thresholded at `upsample_threshold` times the
+        SNR threshold. The full rate SNR is then calculated with a pruned
+        inverse FFT only within `downsample_factor` samples of the clustered
+        reduced rate peaks, and is thresholded and clustered as usual.
+
+        The reduced rate SNR of a signal is smaller than its full rate SNR
+        because of the power of the template above the reduced Nyquist
+        frequency, and because the peak may fall between reduced rate samples.
+        A signal is only missed if this loss takes its SNR below
+        `upsample_threshold` times the SNR threshold. See
+        `hierarchical_snr_loss_bound` for a bound on the loss of a given
+        template and PSD.
 
         Parameters
         ----------
@@ -380,6 +394,8 @@ class MatchedFilterControl(object):
             The htilde, template normalization factor.
         window : int
             Size of the window over which to cluster triggers, in samples
+        epoch : {None, LIGOTimeGPS}, optional
+            The epoch of the returned reduced rate SNR time series.
 
         Returns
         -------
@@ -408,8 +424,8 @@ class MatchedFilterControl(object):
 
         if not hasattr(stilde, 'red_analyze'):
             stilde.red_analyze = \
-                             slice(stilde.analyze.start/self.downsample_factor,
-                                   stilde.analyze.stop/self.downsample_factor)
+                             slice(stilde.analyze.start // self.downsample_factor,
+                                   stilde.analyze.stop // self.downsample_factor)
 
 
         idx_red, snrv_red = events.threshold(self.snr_mem[stilde.red_analyze],
@@ -417,32 +433,37 @@ class MatchedFilterControl(object):
         if len(idx_red) == 0:
             return [], None, [], [], []
 
-        idx_red, _ = events.cluster_reduce(idx_red, snrv_red, window / self.downsample_factor)
+        idx_red, _ = events.cluster_reduce(idx_red, snrv_red,
+                                           window // self.downsample_factor)
         logging.info("%s points above threshold at reduced resolution"\
                       %(str(len(idx_red)),))
 
         # The fancy upsampling is here
         if self.upsample_method=='pruned_fft':
-            idx = (idx_red + stilde.analyze.start/self.downsample_factor)\
+            idx = (idx_red + stilde.analyze.start // self.downsample_factor)\
                    * self.downsample_factor
 
             idx = smear(idx, self.downsample_factor)
+            idx = idx[(idx >= stilde.analyze.start) &
+                      (idx < stilde.analyze.stop)]
+            if len(idx) == 0:
+                return [], None, [], [], []
 
-            # cache transposed  versions of htilde and stilde
+            # cache transposed  versions of stilde, the template memory is
+            # reused for each template so it is transposed on every call
             if not hasattr(self.corr_mem_full, 'transposed'):
                 self.corr_mem_full.transposed = zeros(len(self.corr_mem_full), dtype=self.dtype)
+                self.htilde_full = zeros(len(self.corr_mem_full), dtype=self.dtype)
 
-            if not hasattr(htilde, 'transposed'):
-                htilde.transposed = zeros(len(self.corr_mem_full), dtype=self.dtype)
-                htilde.transposed[self.kmin_full:self.kmax_full] = htilde[self.kmin_full:self.kmax_full]
-                htilde.transposed = fft_transpose(htilde.transposed)
+            self.htilde_full[self.kmin_full:self.kmax_full] = htilde[self.kmin_full:self.kmax_full]
+            htilde_transposed = fft_transpose(self.htilde_full)
 
             if not hasattr(stilde, 'transposed'):
                 stilde.transposed = zeros(len(self.corr_mem_full), dtype=self.dtype)
                 stilde.transposed[self.kmin_full:self.kmax_full] = stilde[self.kmin_full:self.kmax_full]
                 stilde.transposed = fft_transpose(stilde.transposed)
 
-            correlate(htilde.transposed, stilde.transposed, self.corr_mem_full.transposed)
+            correlate(htilde_transposed, stilde.transposed, self.corr_mem_full.transposed)
             snrv = pruned_c2cifft(self.corr_mem_full.transposed, self.inter_vec, idx, pretransposed=True)
             idx = idx - stilde.analyze.start
             idx2, snrv = events.threshold(Array(snrv, copy=False), self.snr_threshold / norm)
@@ -456,11 +477,180 @@ class MatchedFilterControl(object):
                 idx, snrv = [], []
 
             logging.info("%s points at full rate and clustering" % len(idx))
-            return self.snr_mem, norm, self.corr_mem_full, idx, snrv
+            snr = TimeSeries(self.snr_mem, epoch=epoch, copy=False,
+                             delta_t=self.delta_t * self.downsample_factor)
+            return snr, norm, self.corr_mem_full, idx, snrv
         else:
             raise ValueError("Invalid upsample method")
 
 
+class BatchMatchedFilterControl(object):
+    def __init__(self, low_frequency_cutoff, high_frequency_cutoff,
+                 snr_threshold, tlen, delta_f, dtype, segment_list, nbatch,
+                 use_cluster, cluster_function='symmetric'):
+        """ Create a matched filter engine which filters a block of templates
+        against a data segment at once. The templates are correlated against
+        the segment in a single pass, and their SNR time series are computed
+        with one batched inverse FFT. Thresholding and clustering is then
+        done for every template of the block in a vectorized pass.
+
+        Parameters
+        ----------
+        low_frequency_cutoff : {None, float}, optional
+            The frequency to begin the filter calculation. If None, begin at the
+            first frequency after DC.
+        high_frequency_cutoff : {None, float}, optional
+            The frequency to stop the filter calculation. If None, continue to the
+            the nyquist frequency.
+        snr_threshold : float
+            The minimum snr to return when filtering
+        tlen : int
+            The length of each SNR time series.
+        delta_f : float
+            The frequency spacing of the data segments.
+        dtype : numpy.dtype
+            The complex dtype of the filter memory.
+        segment_list : list
+            List of FrequencySeries that are the Fourier-transformed data segments
+        nbatch : int
+            The maximum number of templates to filter together. Templates must
+            be written into the arrays given by the `template_outputs`
+            attribute, eg. as the 'out' parameter of
+            `FilterBank.generate_template`.
+        use_cluster : boolean
+            If true, cluster triggers above threshold using a window; otherwise,
+            only apply a threshold.
+        cluster_function : {symmetric, str}, optional
+            Which method is used to cluster triggers over time. If 'findchirp', a
+            sliding forward window; if 'symmetric', each window's peak is compared
+            to the windows before and after it, and only kept as a trigger if larger
+            than both.
+        """
+        if cluster_function not in ['symmetric', 'findchirp']:
+            raise ValueError("BatchMatchedFilter: 'cluster_function' must be either 'symmetric' or 'findchirp'")
+        self.tlen = tlen
+        self.flen = self.tlen // 2 + 1
+        self.delta_f = delta_f
+        self.delta_t = 1.0/(self.delta_f * self.tlen)
+        self.dtype = dtype
+        self.snr_threshold = snr_threshold
+        self.flow = low_frequency_cutoff
+        self.fhigh = high_frequency_cutoff
+        self.segments = segment_list
+        self.nbatch = nbatch
+        self.use_cluster = use_cluster
+        self.cluster_function = cluster_function
+
+        # One contiguous block of memory for each stage of the filter, each
+        # template in the batch owning one row of length tlen
+        self.template_mem = zeros(self.tlen * nbatch, dtype=self.dtype)
+        self.corr_mem = zeros(self.tlen * nbatch, dtype=self.dtype)
+        self.snr_mem = zeros(self.tlen * nbatch, dtype=self.dtype)
+        rows = [slice(i * self.tlen, (i + 1) * self.tlen) for i in range(nbatch)]
+        self.template_outputs = [self.template_mem[r] for r in rows]
+        self.corr_rows = [self.corr_mem[r] for r in rows]
+        self.snr_rows = [self.snr_mem[r] for r in rows]
+        self.snr_block = numpy.array(self.snr_mem.data,
+                                     copy=False).reshape(nbatch, self.tlen)
+        self.corr_block = numpy.array(self.corr_mem.data,
+                                      copy=False).reshape(nbatch, self.tlen)
+
+        self.kmin, self.kmax = get_cutoff_indices(self.flow, self.fhigh,
+                                                  self.delta_f, self.tlen)
+        self.corr_slice = slice(self.kmin, self.kmax)
+        self.correlator = BatchCorrelator(
+                            [h[self.corr_slice] for h in self.template_outputs],
+                            [c[self.corr_slice] for c in self.corr_rows],
+                            self.kmax - self.kmin)
+        self.ifft = IFFT(self.corr_mem, self.snr_mem, nbatch=nbatch,
+                         size=self.tlen)
+
+    def matched_filter_and_cluster(self, segnum, template_norms, window,
+                                   epoch=None):
+        """ Filter the first len(template_norms) templates of the batch against
+        a segment, then threshold and cluster each SNR time series.
+
+        Parameters
+        ----------
+        segnum : int
+            Index into the list of segments at BatchMatchedFilterControl
+            construction against which to filter.
+        template_norms : list of floats
+            The htilde, template normalization factor of each template in the
+            batch.
+        window : int
+            Size of the window over which to cluster triggers, in samples
+
+        Returns
+        -------
+        results : list of tuples
+            One entry for each template, containing the snr time series, the
+            normalization of the complex snr, the correlation vector, the
+            indices of the triggers and the snr values at the trigger
+            locations, as returned by
+            `MatchedFilterControl.matched_filter_and_cluster`. Templates with
+            no points above threshold have empty lists for these.
+        """
+        ntemplates = len(template_norms)
+        norms = (4.0 * self.delta_f) / numpy.sqrt(numpy.array(template_norms,
+                                                    dtype=numpy.float64))
+
+        self.correlator.execute(self.segments[segnum][self.corr_slice])
+        self.ifft.execute()
+
+        block = self.snr_block[0:ntemplates, self.segments[segnum].analyze]
+        thresholds = self.snr_threshold / norms
+        if not self.use_cluster:
+            rows, idx, snrv = _batch_threshold(block, thresholds)
+        elif self.cluster_function == 'symmetric':
+            rows, idx, snrv = events.threshold_and_cluster_block(block,
+                                                          thresholds, window)
+        else:
+            rows, idx, snrv = _batch_threshold_and_cluster_fc(block,
+                                                          thresholds, window)
+        logging.info("%s points above threshold in %s templates",
+                     len(idx), ntemplates)
+
+        bounds = numpy.searchsorted(rows, numpy.arange(ntemplates + 1))
+        results = []
+        for i in range(ntemplates):
+            lo, hi = bounds[i], bounds[i+1]
+            if lo == hi:
+                results.append(([], [], [], [], []))
+                continue
+            snr = TimeSeries(self.snr_rows[i], epoch=epoch,
+                             delta_t=self.delta_t, copy=False)
+            corr = FrequencySeries(self.corr_rows[i], delta_f=self.delta_f,
+                                   copy=False)
+            results.append((snr, norms[i], corr, idx[lo:hi], snrv[lo:hi]))
+        return results
+
+def _batch_threshold(block, thresholds):
+    """ Find the points of each row of a 2-d block of complex SNR time series
+    whose magnitude is above that row's threshold. Returns the row, column and
+    value of each point, ordered by row and then column.
+    """
+    thr_sqr = thresholds.astype(numpy.float32) ** 2
+    power = block.real ** 2 + block.imag ** 2
+    rows, locs = numpy.nonzero(power > thr_sqr[:, None])
+    return rows, locs, block[rows, locs]
+
+def _batch_threshold_and_cluster_fc(block, thresholds, window):
+    """ Threshold each row of a 2-d block of complex SNR time series and
+    cluster the points of each row with the findchirp algorithm.
+
+    The points of all rows are clustered in a single call by placing the rows
+    end to end with a gap longer than the window between them, so that no
+    cluster can contain points from two different rows.
+    """
+    rows, locs, vals = _batch_threshold(block, thresholds)
+    if len(locs) == 0:
+        return rows, locs, vals
+    stride = block.shape[1] + window + 1
+    keep = events.findchirp_cluster_over_window(rows * stride + locs,
+                                                vals, window)
+    return rows[keep], locs[keep], vals[keep]
+
 def compute_max_snr_over_sky_loc_stat(hplus, hcross, hphccorr,
                                                       hpnorm=None, hcnorm=None,
                                                       out=None, thresh=0,
@@ -1229,6 +1419,65 @@ def matched_filter_core(template, data, psd=None, low_frequency_cutoff=None,
            FrequencySeries(qtilde, epoch=stilde._epoch, delta_f=htilde.delta_f, copy=False),
            norm)
 
+def hierarchical_snr_loss_bound(htilde, psd, downsample_factor,
+                                low_frequency_cutoff=None,
+                                high_frequency_cutoff=None):
+    """ Return a lower bound on the fraction of the SNR of a signal that is
+    kept by the reduced rate stage of the hierarchical matched filter of
+    `MatchedFilterControl`.
+
+    The reduced rate SNR only uses the frequencies below the reduced Nyquist
+    frequency, and is sampled every `downsample_factor` samples, so the peak
+    of a signal can be up to half of that from the nearest reduced rate
+    sample. For a signal matching the template, with weights
+    w(f) = |h(f)|^2 / S(f), the fraction of its SNR kept is at least
+
+    .. math::
+        \\min_{|\\tau| \\leq D \\Delta t / 2} \\frac{\\left|\\sum_{f < f_{red}}
+        w(f) e^{2 \\pi i f \\tau}\\right|}{\\sum_f w(f)}
+
+    A signal of this template is found as long as its full rate SNR times
+    this bound is above `upsample_threshold` times the SNR threshold, so the
+    `upsample_threshold` should be chosen below the smallest bound of the
+    templates in a bank.
+
+    Parameters
+    ----------
+    htilde : FrequencySeries
+        The frequency domain template.
+    psd : {None, FrequencySeries}
+        The PSD used to weight the template, or None for white noise.
+    downsample_factor : int
+        The factor by which the reduced rate SNR is downsampled.
+    low_frequency_cutoff : {None, float}, optional
+        The frequency to begin the filter calculation.
+    high_frequency_cutoff : {None, float}, optional
+        The frequency to stop the filter calculation.
+
+    Returns
+    -------
+    bound : float
+        The smallest fraction of the SNR kept at the reduced sample rate.
+    """
+    N = (len(htilde) - 1) * 2
+    kmin, kmax = get_cutoff_indices(low_frequency_cutoff,
+                                    high_frequency_cutoff, htilde.delta_f, N)
+    kmax_red = min(kmax, N // downsample_factor - 1)
+
+    weight = abs(htilde.numpy()[kmin:kmax]) ** 2.0
+    if psd is not None:
+        weight /= psd.numpy()[kmin:kmax]
+    freqs = numpy.arange(kmin, kmax_red) * htilde.delta_f
+    low = weight[0:kmax_red - kmin]
+
+    # Sample the offsets of the peak finely within half a reduced rate sample
+    delta_t = 1.0 / (N * htilde.delta_f)
+    offsets = numpy.linspace(0, 0.5 * downsample_factor * delta_t,
+                             8 * downsample_factor + 1)
+    kept = min(abs((low * numpy.exp(2.0j * numpy.pi * freqs * t)).sum())
+               for t in offsets)
+    return kept / weight.sum()
+
 def smear(idx, factor):
     """
     This function will take as input an array of indexes and return every
@@ -1252,7 +1501,7 @@ def smear(idx, factor):
 
     s = [idx]
     for i in range(factor+1):
-        a = i - factor/2
+        a = i - factor // 2
         s += [idx + a]
     return numpy.unique(numpy.concatenate(s))
 
@@ -1784,6 +2033,7 @@ def compute_followup_snr_series(data_reader, htilde, trig_time,
 __all__ = ['match', 'matched_filter', 'sigmasq', 'sigma', 'get_cutoff_indices',
            'sigmasq_series', 'make_frequency_series', 'overlap', 'overlap_cplx',
            'matched_filter_core', 'correlate', 'MatchedFilterControl', 'LiveBatchMatchedFilter',
+           'BatchMatchedFilterControl', 'hierarchical_snr_loss_bound',
            'MatchedFilterSkyMaxControl','MatchedFilterSkyMaxControlNoPhase','compute_max_snr_over_sky_loc_stat_no_phase', 'compute_max_snr_over_sky_loc_stat',
            'compute_followup_snr_series','compute_u_val_for_sky_loc_stat_no_phase','compute_u_val_for_sky_loc_stat']
 
@@ -2,6 +2,7 @@
 # the 'get_column()' method is implemented parallel to
 # the existing pylal.SnglInspiralUtils functions
 
+import os
 import h5py
 import numpy as np
 import logging
@@ -18,6 +19,7 @@ from pycbc import version as pycbc_version
 from pycbc.tmpltbank import return_search_summary
 from pycbc.tmpltbank import return_empty_sngl
 from pycbc import events, conversions, pnutils
+from pycbc.events import veto
 
 class HFile(h5py.File):
     """ Low level extensions to the capabilities of reading an hdf5 File
@@ -186,17 +188,32 @@ class StatmapData(DictArray):
     def _return(self, data):
         return self.__class__(data=data, attrs=self.attrs, seg=self.seg)
 
-    def cluster(self, window):
+    def cluster(self, window, chunk_size=None, pool=None):
         """ Cluster the dict array, assuming it has the relevant Coinc colums,
         time1, time2, stat, and timeslide_id
+
+        If a chunk size is given, each timeslide is clustered separately in
+        chunks of at most this many coincidences, and if a pool is given the
+        timeslides are clustered by its workers.
         """
         # If no events, do nothing
         if len(self.time1) == 0 or len(self.time2) == 0:
             return self
-        from pycbc.events import cluster_coincs
+        from pycbc.events import cluster_coincs, cluster_coincs_chunked, \
+                                 cluster_coincs_parallel
         interval = self.attrs['timeslide_interval']
-        cid = cluster_coincs(self.stat, self.time1, self.time2,
-                                 self.timeslide_id, interval, window)
+        if pool is not None:
+            kwargs = {'chunk_size': chunk_size} if chunk_size else {}
+            cid = cluster_coincs_parallel(self.stat, self.time1, self.time2,
+                                          self.timeslide_id, interval, window,
+                                          pool, **kwargs)
+        elif chunk_size:
+            cid = cluster_coincs_chunked(self.stat, self.time1, self.time2,
+                                         self.timeslide_id, interval, window,
+                                         chunk_size=chunk_size)
+        else:
+            cid = cluster_coincs(self.stat, self.time1, self.time2,
+                                     self.timeslide_id, interval, window)
         return self.select(cid)
 
     def save(self, outname):
@@ -327,6 +344,208 @@ class DataFromFiles(object):
         logging.info('- got %i values' % sum(len(v) for v in vals))
         return np.concatenate(vals)
 
+class ReadByTemplate(object):
+    """ Read the triggers of a single detector trigger file one template at
+    a time, optionally after applying vetoes.
+
+    If the template bank is given, the triggers of blocks of templates set
+    by `set_block` are read together, see `set_block`. Otherwise the
+    triggers of each template are read with its region references.
+
+    Parameters
+    ----------
+    filename: str
+        The trigger file.
+    bank: {None, str}
+        The template bank file the triggers were found with.
+    segment_name: list of strs
+        The names of the veto segments to apply, one for each veto file.
+    veto_files: list of strs
+        The veto files.
+    max_waste: {0.5, float}
+        The largest fraction of a slice read for a block of templates which
+        may belong to templates outside the block.
+    """
+    def __init__(self, filename, bank=None, segment_name=[], veto_files=[],
+                 max_waste=0.5):
+        self.filename = filename
+        self._pid = None
+        self.ifo = self.file.keys()[0]
+        self.valid = None
+        self.template_num = None
+        self.max_waste = max_waste
+        self.block = {}
+        self.cache = {}
+
+        # The triggers of each template are stored contiguously, starting at
+        # 'template_boundaries' and in the hash order of the bank
+        self.boundaries = self.file['%s/template_boundaries' % self.ifo][:]
+        self.ends = None
+        self.param = {}
+        self.bank_params = {}
+        if bank:
+            bankf = h5py.File(bank, 'r')
+            order = bankf['template_hash'][:].argsort()
+            num_trigs = len(self.file['%s/end_time' % self.ifo])
+            self.ends = np.zeros(len(self.boundaries), dtype=np.int64)
+            self.ends[order] = np.append(self.boundaries[order][1:],
+                                            num_trigs)
+            cols = bankf.attrs['parameters'] if 'parameters' in bankf.attrs \
+                   else bankf.keys()
+            for col in cols:
+                self.bank_params[col] = bankf[col][:]
+            bankf.close()
+
+        # Determine the segments which define the boundaries of valid times
+        # to use triggers
+        key = '%s/search/' % self.ifo
+        s, e = self.file[key + 'start_time'][:], self.file[key + 'end_time'][:]
+        self.segs = veto.start_end_to_segments(s, e).coalesce()
+        for vfile, name in zip(veto_files, segment_name):
+            veto_segs = veto.select_segments_by_definer(vfile, ifo=self.ifo,
+                                                     segment_name=name)
+            self.segs = (self.segs - veto_segs).coalesce()
+        self.valid = veto.segments_to_start_end(self.segs)
+
+    @property
+    def file(self):
+        """ The trigger file, opened separately by each worker process """
+        if self._pid != os.getpid():
+            self._file = h5py.File(self.filename, 'r')
+            self._pid = os.getpid()
+        return self._file
+
+    def set_block(self, nums):
+        """ Set a block of templates to read together
+
+        The triggers of the templates are read from each column with as few
+        slice reads as possible. Templates which are close together in the
+        file are read with one slice, as long as at most a fraction
+        'max_waste' of the slice belongs to other templates.
+
+        Parameters
+        ----------
+        nums: list of ints
+            The template ids of the block
+        """
+        self.block = {}
+        self.cache = {}
+        self.reads = []
+        if self.ends is None:
+            return
+
+        nums = np.array(nums, dtype=np.int64)
+        empty = self.ends[nums] == self.boundaries[nums]
+        for num in nums[empty]:
+            self.block[num] = (0, 0)
+        nums = nums[np.logical_not(empty)]
+        nums = nums[self.boundaries[nums].argsort()]
+        offset = 0
+        lo = hi = used = None
+        for num in nums:
+            start, end = self.boundaries[num], self.ends[num]
+            if lo is not None and \
+                    (used + end - start) >= (1. - self.max_waste) * (end - lo):
+                hi = end
+                used += end - start
+            else:
+                if lo is not None:
+                    self.reads.append((lo, hi))
+                    offset += hi - lo
+                lo, hi, used = start, end, end - start
+                read_start = offset
+            self.block[num] = (read_start + start - lo,
+                               read_start + end - lo)
+        if lo is not None:
+            self.reads.append((lo, hi))
+
+    def get_data(self, col, num):
+        """ Get a column of data for template with id 'num'
+
+        Parameters
+        ----------
+        col: str
+            Name of column to read
+        num: int
+            The template id to read triggers for
+
+        Returns
+        -------
+        data: numpy.ndarray
+            The requested column of data
+        """
+        if num in self.block:
+            if col not in self.cache:
+                dset = self.file['%s/%s' % (self.ifo, col)]
+                if len(self.reads) > 0:
+                    self.cache[col] = np.concatenate([dset[l:r] for l, r
+                                                         in self.reads])
+                else:
+                    self.cache[col] = dset[0:0]
+            l, r = self.block[num]
+            return self.cache[col][l:r]
+        elif self.ends is not None:
+            l, r = self.boundaries[num], self.ends[num]
+            return self.file['%s/%s' % (self.ifo, col)][l:r]
+
+        ref = self.file['%s/%s_template' % (self.ifo, col)][num]
+        return self.file['%s/%s' % (self.ifo, col)][ref]
+
+    def set_template(self, num):
+        """ Set the active template to read from
+
+        Parameters
+        ----------
+        num: int
+            The template id to read triggers for
+
+        Returns
+        -------
+        trigger_id: numpy.ndarray
+            The indices of this templates triggers
+        """
+        self.template_num = num
+        times = self.get_data('end_time', num)
+
+        # Determine which of these template's triggers are kept after
+        # applying vetoes
+        if self.valid:
+            self.keep = veto.indices_within_times(times, self.valid[0], self.valid[1])
+            logging.info('applying vetoes')
+        else:
+            self.keep = np.arange(0, len(times))
+
+        for col in self.bank_params:
+            self.param[col] = self.bank_params[col][self.template_num]
+
+        # Calculate the trigger id by adding the relative offset in self.keep
+        # to the absolute beginning index of this templates triggers stored
+        # in 'template_boundaries'
+        trigger_id = self.keep + self.boundaries[num]
+        return trigger_id
+
+    def __getitem__(self, col):
+        """ Return the column of data for current active template after
+        applying vetoes
+
+        Parameters
+        ----------
+        col: str
+            Name of column to read
+
+        Returns
+        -------
+        data: numpy.ndarray
+            The requested column of data
+        """
+        if self.template_num == None:
+            raise ValueError('You must call set_template to first pick the '
+                             'template to read data from')
+        data = self.get_data(col, self.template_num)
+        data = data[self.keep] if self.valid else data
+        return data
+
+
 class SingleDetTriggers(object):
     """
     Provides easy access to the parameters of single-detector CBC triggers.
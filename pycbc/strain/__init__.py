@@ -5,6 +5,7 @@ from .strain import from_cli, from_cli_single_ifo, from_cli_multi_ifos
 from .strain import insert_strain_option_group, insert_strain_option_group_multi_ifo
 from .strain import verify_strain_options, verify_strain_options_multi_ifo
 from .strain import gate_data, StrainSegments, StrainBuffer
+from .strain import save_fourier_segments, load_fourier_segments
 
 from .gate import add_gate_option_group, gates_from_cli
 from .gate import apply_gates_to_td, apply_gates_to_fd, psd_gates_from_cli
@@ -1178,6 +1178,96 @@ class StrainSegments(object):
         for ifo in ifos:
             required_opts_multi_ifo(opt, parser, ifo, cls.required_opts_list)
 
+def save_fourier_segments(filename, segments, group='segments'):
+    """ Write frequency-domain data segments and their PSDs to an HDF file
+
+    The segments are stored along with the slices that describe them, so
+    that a job can read them back with `load_fourier_segments` instead of
+    reading and conditioning the strain again. A PSD shared by several
+    segments is stored once.
+
+    Parameters
+    ----------
+    filename : str
+        The HDF file to write to. It is created if it does not exist.
+    segments : list of FrequencySeries
+        The segments, as returned by `StrainSegments.fourier_segments`,
+        each with an associated `psd`.
+    group : {'segments', str}
+        The group of the file to write to. Any existing group of this name
+        is replaced.
+    """
+    import h5py
+    f = h5py.File(filename, 'a')
+    if group in f:
+        del f[group]
+
+    psd_ids = []
+    for i, seg in enumerate(segments):
+        if id(seg.psd) not in psd_ids:
+            ds = f.create_dataset('%s/psd/%d' % (group, len(psd_ids)),
+                                  data=seg.psd.numpy())
+            ds.attrs['delta_f'] = float(seg.psd.delta_f)
+            ds.attrs['epoch'] = float(seg.psd.epoch)
+            psd_ids.append(id(seg.psd))
+
+        ds = f.create_dataset('%s/data/%d' % (group, i), data=seg.numpy())
+        ds.attrs['delta_f'] = float(seg.delta_f)
+        ds.attrs['epoch'] = float(seg.epoch)
+        ds.attrs['analyze'] = [seg.analyze.start, seg.analyze.stop]
+        ds.attrs['seg_slice'] = [seg.seg_slice.start, seg.seg_slice.stop]
+        ds.attrs['cumulative_index'] = seg.cumulative_index
+        ds.attrs['psd'] = psd_ids.index(id(seg.psd))
+
+    # Written last, so that an incomplete group can be recognized
+    f[group].attrs['num_segments'] = len(segments)
+    f.close()
+
+def load_fourier_segments(filename, group='segments'):
+    """ Read the frequency-domain data segments written by
+    `save_fourier_segments`
+
+    Parameters
+    ----------
+    filename : str
+        The HDF file to read.
+    group : {'segments', str}
+        The group of the file to read from.
+
+    Returns
+    -------
+    segments : list of FrequencySeries or None
+        The segments, with the same properties as those returned by
+        `StrainSegments.fourier_segments` and their associated `psd`.
+        None if the file does not hold a complete set of segments.
+    """
+    import h5py
+    f = h5py.File(filename, 'r')
+    if group not in f or 'num_segments' not in f[group].attrs:
+        f.close()
+        return None
+
+    psds = {}
+    segments = []
+    for i in range(f[group].attrs['num_segments']):
+        ds = f['%s/data/%d' % (group, i)]
+        seg = FrequencySeries(ds[:], delta_f=ds.attrs['delta_f'],
+                              epoch=ds.attrs['epoch'])
+        seg.analyze = slice(*[int(i) for i in ds.attrs['analyze']])
+        seg.seg_slice = slice(*[int(i) for i in ds.attrs['seg_slice']])
+        seg.cumulative_index = int(ds.attrs['cumulative_index'])
+
+        pnum = int(ds.attrs['psd'])
+        if pnum not in psds:
+            pds = f['%s/psd/%d' % (group, pnum)]
+            psds[pnum] = FrequencySeries(pds[:], delta_f=pds.attrs['delta_f'],
+                                         epoch=pds.attrs['epoch'])
+        seg.psd = psds[pnum]
+        segments.append(seg)
+
+    f.close()
+    return segments
+
 class StrainBuffer(pycbc.frame.DataBuffer):
     def __init__(self, frame_src, channel_name, start_time,
                  max_buffer=512,
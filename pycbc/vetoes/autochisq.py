@@ -16,12 +16,125 @@
 from pycbc.filter import make_frequency_series
 from pycbc.filter import  matched_filter_core
 from pycbc.types import Array
+from pycbc.waveform.bank import SigmasqCache
+from collections import OrderedDict
 import numpy as np
 import logging
 
 BACKEND_PREFIX="pycbc.vetoes.autochisq_"
 
 
+def autochisq_lags(length, stride=1, num_points=None, oneside=None):
+    """
+    Return the offsets, from a trigger, of the points at which the
+    auto-chisq is computed.
+
+    Parameters
+    ----------
+    length: int
+        Length of the snr time series
+    stride: [int, optional; default = 1]
+        stride for points selection for autochisq
+    num_points: [int, optional; default=None]
+        Number of points used for autochisq on each side, if None all points
+        are used.
+    oneside: [str, optional; default=None]
+        If None the points are taken on both sides of the trigger, if 'left'
+        or 'right' only on that side.
+
+    Returns
+    -------
+    lags: numpy.ndarray
+        The offsets of the points from the trigger
+    num_points: int
+        The number of points used on each side
+    """
+    num_points_all = int(length/stride)
+    if num_points is None:
+        num_points = num_points_all
+    if (num_points > num_points_all):
+        num_points = num_points_all
+
+    start_point = - stride*num_points
+    end_point = stride*num_points+1
+    if oneside == 'left':
+        lags = np.arange(start_point, 0, stride)
+    elif oneside == 'right':
+        lags = np.arange(stride, end_point, stride)
+    else:
+        lags = np.append(np.arange(start_point, 0, stride),
+                         np.arange(stride, end_point, stride))
+    return lags, num_points
+
+def autochisq_at_lags(sn, corr_sn, hauto_corr_vec, lags, indices,
+                      twophase=True, maxvalued=False, block_size=2**16):
+    """
+    Compute the auto-chisq of a set of triggers, given the autocorrelation
+    of the template at the offsets from the triggers to the points used.
+    All the triggers are done at once, by gathering the correlation snr at
+    the points of each of them into a matrix, in blocks of triggers.
+
+    Parameters
+    ----------
+    sn: Array[complex]
+        normalized (!) array of complex snr for the template that produced the
+        trigger(s) being tested
+    corr_sn : Array[complex]
+        normalized (!) array of complex snr for the template that you want to
+        produce a correlation chisq test for.
+    hauto_corr_vec: numpy.ndarray
+        The normalized autocorrelation of the template at each of the lags
+    lags: numpy.ndarray
+        The offsets of the points from the triggers, see `autochisq_lags`
+    indices: Array[int]
+        compute correlation chisquare at the points specified in this array
+    twophase: Boolean, optional; default=True
+        If True calculate the auto-chisq using both phases of the filter.
+    maxvalued: Boolean, optional; default=False
+        Return the largest auto-chisq at any of the points tested if True.
+    block_size: {2**16, int}
+        The largest number of points gathered at once.
+
+    Returns
+    -------
+    autochisq: numpy.ndarray
+        The auto-chisq of each trigger
+    """
+    Nsnr = len(sn)
+    indices = np.array(indices, dtype=np.int64, ndmin=1)
+    achisq = np.zeros(len(indices))
+
+    hauto_corr_vec = np.asarray(hauto_corr_vec)
+    hauto_norm = hauto_corr_vec.real*hauto_corr_vec.real
+    # REMOVE THIS LINE TO REPRODUCE OLD RESULTS
+    hauto_norm += hauto_corr_vec.imag*hauto_corr_vec.imag
+    chisq_norm = 1.0 - hauto_norm
+
+    step = max(1, block_size // max(len(lags), 1))
+    for start in range(0, len(indices), step):
+        ind = indices[start:start + step]
+        snr = np.asarray(sn[ind])
+        snrabs = np.abs(snr)
+
+        # Wrap the points around the ends of the time series
+        points = (ind[:, None] + lags) % Nsnr
+
+        # Rotate the correlation snr by the phase of each trigger, so its
+        # real and imaginary parts are the two phases. By construction, the
+        # other "phase" of the SNR of the trigger is 0
+        dz = np.asarray(corr_sn[points]) * (snr.conj() / snrabs)[:, None]
+        dz -= hauto_corr_vec * snrabs[:, None]
+        if twophase:
+            curr_achisq = (dz.real*dz.real + dz.imag*dz.imag)/chisq_norm
+        else:
+            curr_achisq = dz.real*dz.real/chisq_norm
+
+        if maxvalued:
+            achisq[start:start + step] = curr_achisq.max(axis=1)
+        else:
+            achisq[start:start + step] = curr_achisq.sum(axis=1)
+    return achisq
+
 def autochisq_from_precomputed(sn, corr_sn, hautocorr, indices,
                        stride=1, num_points=None, oneside=None,
                        twophase=True, maxvalued=False):
@@ -65,67 +178,11 @@ def autochisq_from_precomputed(sn, corr_sn, hautocorr, indices,
         returns autochisq values and snr corresponding to the instances
         of time defined by indices
     """
-    Nsnr = len(sn)
-
-    achisq = np.zeros(len(indices))
-    num_points_all = int(Nsnr/stride)
-    if num_points is None:
-        num_points = num_points_all
-    if (num_points > num_points_all):
-        num_points = num_points_all
-
-    snrabs = np.abs(sn[indices])
-    cphi_array = (sn[indices]).real / snrabs
-    sphi_array = (sn[indices]).imag / snrabs
-
-    start_point = - stride*num_points
-    end_point = stride*num_points+1
-    if oneside == 'left':
-        achisq_idx_list = np.arange(start_point, 0, stride)
-    elif oneside == 'right':
-        achisq_idx_list = np.arange(stride, end_point, stride)
-    else:
-        achisq_idx_list_pt1 = np.arange(start_point, 0, stride)
-        achisq_idx_list_pt2 = np.arange(stride, end_point, stride)
-        achisq_idx_list = np.append(achisq_idx_list_pt1,
-                                    achisq_idx_list_pt2)
-
-    hauto_corr_vec = hautocorr[achisq_idx_list]
-    hauto_norm = hauto_corr_vec.real*hauto_corr_vec.real
-    # REMOVE THIS LINE TO REPRODUCE OLD RESULTS
-    hauto_norm += hauto_corr_vec.imag*hauto_corr_vec.imag
-    chisq_norm = 1.0 - hauto_norm
-
-    for ip,ind in enumerate(indices):
-        curr_achisq_idx_list = achisq_idx_list + ind
-
-        cphi = cphi_array[ip]
-        sphi = sphi_array[ip]
-        # By construction, the other "phase" of the SNR is 0
-        snr_ind =  sn[ind].real*cphi + sn[ind].imag*sphi
-
-        # Wrap index if needed (maybe should fail in this case?)
-        if curr_achisq_idx_list[0] < 0:
-            curr_achisq_idx_list[curr_achisq_idx_list < 0] += Nsnr
-        if curr_achisq_idx_list[-1] > (Nsnr - 1):
-            curr_achisq_idx_list[curr_achisq_idx_list > (Nsnr-1)] -= Nsnr
-
-        z = corr_sn[curr_achisq_idx_list].real*cphi + \
-             corr_sn[curr_achisq_idx_list].imag*sphi
-        dz = z - hauto_corr_vec.real*snr_ind
-        curr_achisq_list = dz*dz/chisq_norm
-
-        if twophase:
-            chisq_norm = 1.0 - hauto_norm
-            z = -corr_sn[curr_achisq_idx_list].real*sphi + \
-                 corr_sn[curr_achisq_idx_list].imag*cphi
-            dz = z - hauto_corr_vec.imag*snr_ind
-            curr_achisq_list += dz*dz/chisq_norm
-
-        if maxvalued:
-            achisq[ip] = curr_achisq_list.max()
-        else:
-            achisq[ip] = curr_achisq_list.sum()
+    lags, num_points = autochisq_lags(len(sn), stride=stride,
+                                      num_points=num_points, oneside=oneside)
+    achisq = autochisq_at_lags(sn, corr_sn, hautocorr[lags % len(hautocorr)],
+                               lags, indices, twophase=twophase,
+                               maxvalued=maxvalued)
 
     dof = num_points
     if oneside is None:
@@ -141,7 +198,7 @@ class SingleDetAutoChisq(object):
     """
     def __init__(self, stride, num_points, onesided=None, twophase=False,
                  reverse_template=False, take_maximum_value=False,
-                 maximal_value_dof=None):
+                 maximal_value_dof=None, cache_size=1000):
         """
         Initialize autochisq calculation instance
 
@@ -169,6 +226,10 @@ class SingleDetAutoChisq(object):
         maximal_value_dof : int, required if using take_maximum_value
             If using take_maximum_value the expected value is not known. This
             value specifies what to store in the cont_chisq_dof output.
+        cache_size : optional, default=1000
+            The number of templates and PSDs for which the autocorrelation
+            at the points used is kept, so that it is computed only once
+            for all the segments sharing a PSD.
         """
         if stride > 0:
             self.do = True
@@ -193,8 +254,8 @@ class SingleDetAutoChisq(object):
                     raise ValueError(err_msg)
                 self.dof = maximal_value_dof
 
-            self._autocor = None
-            self._autocor_id = None
+            self.cache_size = cache_size
+            self._autocor = OrderedDict()
         else:
             self.do = False
 
@@ -226,10 +287,18 @@ class SingleDetAutoChisq(object):
         """
         if self.do and (len(indices) > 0):
             htilde = make_frequency_series(template)
+            lags, _ = autochisq_lags(len(sn), stride=self.stride,
+                                     num_points=self.num_points,
+                                     oneside=self.one_sided)
 
-            # Check if we need to recompute the autocorrelation
-            key = (id(template), id(psd))
-            if key != self._autocor_id:
+            # Check if we need to compute the autocorrelation. Only its
+            # values at the points used are kept.
+            params = getattr(template, 'params', None)
+            tid = getattr(params, 'template_hash', None)
+            tid = id(template) if tid is None else int(tid)
+            key = (tid, SigmasqCache.psd_key(psd), len(htilde), len(sn),
+                   low_frequency_cutoff, high_frequency_cutoff)
+            if key not in self._autocor:
                 logging.info("Calculating autocorrelation")
 
                 if not self.reverse_template:
@@ -238,7 +307,6 @@ class SingleDetAutoChisq(object):
                               low_frequency_cutoff=low_frequency_cutoff,
                               high_frequency_cutoff=high_frequency_cutoff)
                     Pt = Pt * (1./ Pt[0])
-                    self._autocor = Array(Pt, copy=True)
                 else:
                     Pt, _, P_norm = matched_filter_core(htilde.conj(),
                               htilde, psd=psd,
@@ -251,8 +319,9 @@ class SingleDetAutoChisq(object):
                     #        code is really slow ... why??
                     norm_fac = P_norm / float(((template.sigmasq(psd))**0.5))
                     Pt *= norm_fac
-                    self._autocor = Array(Pt, copy=True)
-                self._autocor_id = key
+                self._autocor[key] = np.array(Pt[lags % len(Pt)])
+                if len(self._autocor) > self.cache_size:
+                    self._autocor.popitem(last=False)
 
             logging.info("...Calculating autochisquare")
             sn = sn*norm
@@ -266,14 +335,13 @@ class SingleDetAutoChisq(object):
             else:
                 correlation_snr = sn
 
-            achi_list = np.array([])
-            index_list = np.array(indices)
-            dof, achi_list, _ = autochisq_from_precomputed(sn, correlation_snr,
-                               self._autocor, index_list, stride=self.stride,
-                               num_points=self.num_points,
-                               oneside=self.one_sided, twophase=self.two_phase,
+            achi_list = autochisq_at_lags(sn, correlation_snr,
+                               self._autocor[key], lags, indices,
+                               twophase=self.two_phase,
                                maxvalued=self.take_maximum_value)
-            self.dof = dof
+            self.dof = len(lags)
+            if self.two_phase:
+                self.dof = self.dof * 2
             return achi_list
 
 class SingleDetSkyMaxAutoChisq(SingleDetAutoChisq):
@@ -21,10 +21,12 @@
 #
 # =============================================================================
 #
-import logging, numpy
+import logging, numpy, os.path, h5py, fcntl
 from pycbc.types import Array, zeros, real_same_precision_as, TimeSeries
-from pycbc.filter import overlap_cplx, matched_filter_core
+from pycbc.filter import overlap_cplx, matched_filter_core, get_cutoff_indices
 from pycbc.waveform import FilterBank
+from pycbc.waveform.bank import SigmasqCache
+from pycbc.vetoes.chisq import ChisqBinCache
 from math import sqrt
 
 def segment_snrs(filters, stilde, psd, low_frequency_cutoff):
@@ -96,6 +98,63 @@ def template_overlaps(bank_filters, template, psd, low_frequency_cutoff):
             logging.debug(errMsg)
     return overlaps
 
+def bank_filter_matrix(bank_filters, psd, low_frequency_cutoff):
+    """ This function stacks the bank veto templates, weighted by the
+    inverse psd and their normalization, into a matrix, so that their
+    overlaps with a search template are a single matrix-vector product.
+
+    Parameters
+    ----------
+    bank_filters: List of FrequencySeries
+    psd: FrequencySeries
+    low_frequency_cutoff: float
+
+    Returns
+    -------
+    matrix: numpy.ndarray
+        The complex matrix, with a row for each bank veto template, over
+        the frequency range of the overlaps.
+    kmin: int
+        The first frequency index of the matrix.
+    kmax: int
+        The frequency index after the end of the matrix.
+    """
+    kmin, kmax = get_cutoff_indices(low_frequency_cutoff, None, psd.delta_f,
+                                    (len(bank_filters[0]) - 1) * 2)
+    weight = 4 * psd.delta_f / psd.numpy()[kmin:kmax]
+    matrix = numpy.zeros((len(bank_filters), kmax - kmin),
+                         dtype=numpy.complex128)
+    for i, bank_template in enumerate(bank_filters):
+        matrix[i] = bank_template.numpy()[kmin:kmax] * weight
+        matrix[i] /= sqrt(bank_template.sigmasq(psd))
+    return matrix, kmin, kmax
+
+def template_overlaps_from_matrix(matrix, kmin, kmax, templates, psd):
+    """ This function calculates the overlaps between each of the templates
+    and the bank veto templates of a matrix from `bank_filter_matrix`. It
+    gives the same overlaps as `template_overlaps`.
+
+    Parameters
+    ----------
+    matrix: numpy.ndarray
+    kmin: int
+    kmax: int
+    templates: List of FrequencySeries
+    psd: FrequencySeries
+
+    Returns
+    -------
+    overlaps: numpy.ndarray
+        The complex overlaps, with a row for each template and a column for
+        each bank veto template.
+    """
+    tmatrix = numpy.zeros((kmax - kmin, len(templates)),
+                          dtype=numpy.complex128)
+    for i, template in enumerate(templates):
+        tmatrix[:, i] = template.numpy()[kmin:kmax].conj()
+        tmatrix[:, i] /= sqrt(template.sigmasq(psd))
+    return matrix.dot(tmatrix).T
+
 def bank_chisq_from_filters(tmplt_snr, tmplt_norm, bank_snrs, bank_norms,
         tmplt_bank_matches, indices=None):
     """ This function calculates and returns a TimeSeries object containing the
@@ -162,12 +221,69 @@ def bank_chisq_from_filters(tmplt_snr, tmplt_norm, bank_snrs, bank_norms,
         return TimeSeries(bank_chisq, delta_t=tmplt_snr.delta_t,
                           epoch=tmplt_snr.start_time, copy=False)
 
+def bank_chisq_from_matrix(tmplt_snr, tmplt_norm, bank_snrs, bank_norms,
+                           tmplt_bank_matches):
+    """ This function calculates the bank veto at a set of points of a
+    segment in one step, rather than looping over the bank veto templates.
+    It gives the same values as `bank_chisq_from_filters` at those points.
+
+    Parameters
+    ----------
+    tmplt_snr: Array
+        The SNR of the search template at the points
+    tmplt_norm: float
+        The normalization factor for the search template
+    bank_snrs: numpy.ndarray
+        The SNR of the bank veto templates at the points, with a row for
+        each bank veto template
+    bank_norms: list of floats
+        The normalization factors for the list of bank veto templates
+    tmplt_bank_matches: list of floats
+        The complex overlap between the search template and each
+        of the bank templates
+
+    Returns
+    -------
+    bank_chisq: Array of the bank veto at the points
+    """
+    tmplt_snr = numpy.asarray(tmplt_snr)
+    matches = numpy.asarray(tmplt_bank_matches)
+    # Bank templates very close to the search template are replaced by their
+    # expected contribution of 2, as in bank_chisq_from_filters
+    used = abs(matches) <= 0.99
+    matches = matches[used]
+    bank_norm = numpy.sqrt(1 - abs(matches) ** 2)
+    bank_scale = numpy.asarray(bank_norms)[used] / bank_norm
+    tmplt_scale = matches.conj() * tmplt_norm / bank_norm
+
+    diff = bank_snrs[used] * bank_scale[:, None]
+    diff -= numpy.outer(tmplt_scale, tmplt_snr)
+    bank_chisq = (diff.real ** 2 + diff.imag ** 2).sum(axis=0)
+    bank_chisq += 2. * (~used).sum()
+    dtype = numpy.float64 if tmplt_snr.dtype == numpy.complex128 \
+                          else numpy.float32
+    return Array(bank_chisq.astype(dtype), copy=False)
+
 class SingleDetBankVeto(object):
     """This class reads in a template bank file for a bank veto, handles the
        memory management of its filters internally, and calculates the bank
        veto TimeSeries.
+
+       The overlaps of the search templates with the bank veto templates can
+       be kept in an HDF5 file, keyed by template hash and PSD, and reused
+       by later jobs with the same bank veto bank. The overlaps found with
+       one PSD are reused for another of the same length and spacing when
+       their fingerprints, see `pycbc.vetoes.ChisqBinCache`, differ by no
+       more than `overlap_tolerance` in every band. The file holds a group
+       for each PSD, with the hashes of its search templates and a matrix of
+       their overlaps with the bank veto templates. It can only be used by
+       jobs with the same bank veto bank, low frequency cutoff and
+       `template_options`, the options the search templates are generated
+       with.
     """
-    def __init__(self, bank_file, flen, delta_f, f_low, cdtype, approximant=None, **kwds):
+    def __init__(self, bank_file, flen, delta_f, f_low, cdtype, approximant=None,
+                 overlap_file=None, overlap_tolerance=0, template_options=None,
+                 **kwds):
         if bank_file is not None:
             self.do = True
 
@@ -189,27 +305,208 @@ class SingleDetBankVeto(object):
 
             self.filters = list(bank_veto_bank)
             self.dof = len(bank_veto_bank) * 2
+            self.bank_hashes = numpy.array(bank_veto_bank.table.template_hash,
+                                           dtype=numpy.int64)
 
             self._overlaps_cache = {}
             self._segment_snrs_cache = {}
+            self._filter_matrix = None
+
+            self.overlap_file = overlap_file
+            self.overlap_tolerance = overlap_tolerance
+            if template_options is None:
+                template_options = {}
+            self.template_options = repr(sorted(template_options.items()))
+            # The key, frequency spacing, length and fingerprint of each PSD
+            # in the overlap file, and the overlaps of each template with it
+            self.overlap_psds = []
+            self.overlaps = {}
+            self.modified = False
+            self._read_overlaps()
         else:
             self.do = False
 
+    def _read_overlaps(self):
+        """ Read the overlaps from the overlap file, if it exists """
+        if self.overlap_file is None or not os.path.exists(self.overlap_file):
+            return
+        with h5py.File(self.overlap_file, 'r') as f:
+            if not numpy.array_equal(f['bank_veto_hash'][:],
+                                     self.bank_hashes) or \
+                    f.attrs['f_low'] != self.f_low:
+                raise ValueError("The bank veto overlap file %s was made "
+                                 "with a different bank veto bank or low "
+                                 "frequency cutoff" % self.overlap_file)
+            if f.attrs.get('template_options') != self.template_options:
+                raise ValueError("The bank veto overlap file %s was made "
+                                 "with search templates generated with "
+                                 "different options" % self.overlap_file)
+            for key in f:
+                if key == 'bank_veto_hash':
+                    continue
+                group = f[key]
+                if key not in self.overlaps:
+                    self.overlap_psds.append((key, group.attrs['delta_f'],
+                                              group.attrs['length'],
+                                              group['fingerprint'][:]))
+                    self.overlaps[key] = {}
+                overlaps = self.overlaps[key]
+                for h, o in zip(group['template_hash'][:],
+                                group['overlaps'][:]):
+                    overlaps.setdefault(int(h), o)
+
+    def save_overlaps(self):
+        """ Write the overlaps to the overlap file, keeping those which
+        were added to it by other jobs since it was read. The file is locked
+        while it is read and replaced, so that jobs, or the worker processes
+        of one job, saving at the same time do not lose each other's
+        overlaps.
+        """
+        if self.overlap_file is None or not self.modified:
+            return
+        lockfile = open(self.overlap_file + '.lock', 'w')
+        fcntl.lockf(lockfile, fcntl.LOCK_EX)
+        try:
+            self._read_overlaps()
+            tmpname = '%s.%s.tmp' % (self.overlap_file, os.getpid())
+            with h5py.File(tmpname, 'w') as f:
+                f['bank_veto_hash'] = self.bank_hashes
+                f.attrs['f_low'] = self.f_low
+                f.attrs['template_options'] = self.template_options
+                for key, delta_f, length, fingerprint in self.overlap_psds:
+                    entries = sorted(self.overlaps[key].items())
+                    if not entries:
+                        continue
+                    group = f.create_group(key)
+                    group.attrs['delta_f'] = delta_f
+                    group.attrs['length'] = length
+                    group['fingerprint'] = fingerprint
+                    group['template_hash'] = numpy.array(
+                                    [e[0] for e in entries], dtype=numpy.int64)
+                    group['overlaps'] = numpy.array([e[1] for e in entries])
+            os.rename(tmpname, self.overlap_file)
+        finally:
+            fcntl.lockf(lockfile, fcntl.LOCK_UN)
+            lockfile.close()
+        self.modified = False
+
+    def psd_key(self, psd):
+        """ Return the key of the PSD whose overlaps are used for this PSD,
+        adding the PSD if there is none
+        """
+        if getattr(psd, '_bank_veto_owner', None) is not self:
+            key = SigmasqCache.psd_key(psd)
+            match = [k for k, _, _, _ in self.overlap_psds if k == key]
+            if not match and self.overlap_tolerance > 0:
+                fingerprint = ChisqBinCache.fingerprint(psd)
+                match = [k for k, df, l, fp in self.overlap_psds
+                         if df == psd.delta_f and l == len(psd) and
+                         len(fp) == len(fingerprint) and
+                         (abs(fp / fingerprint - 1) <=
+                          self.overlap_tolerance).all()]
+            if match:
+                key = match[0]
+            else:
+                self.overlap_psds.append((key, psd.delta_f, len(psd),
+                                          ChisqBinCache.fingerprint(psd)))
+                self.overlaps[key] = {}
+            psd._bank_veto_owner = self
+            psd._bank_veto_key = key
+        return psd._bank_veto_key
+
+    def filter_matrix(self, psd):
+        """ Return the matrix of the bank veto templates weighted by this
+        PSD, see `bank_filter_matrix`. Only the matrix of the latest PSD is
+        kept.
+        """
+        if self._filter_matrix is None or self._filter_matrix[0] is not psd:
+            self._filter_matrix = (psd,) + bank_filter_matrix(self.filters,
+                                                        psd, self.f_low)
+        return self._filter_matrix[1:]
+
+    def precompute_overlaps(self, templates, psd):
+        """ Calculate the overlaps of each of the templates with the bank
+        veto templates for this PSD, as a single matrix product, and add
+        them to the overlaps to be saved
+
+        Parameters
+        ----------
+        templates: list of FrequencySeries
+            Search templates, from a FilterBank.
+        psd: FrequencySeries
+
+        Returns
+        -------
+        overlaps: numpy.ndarray
+            The complex overlaps, with a row for each template.
+        """
+        key = self.psd_key(psd)
+        overlaps = template_overlaps_from_matrix(*(self.filter_matrix(psd) +
+                                                   (templates, psd)))
+        for template, row in zip(templates, overlaps):
+            self.overlaps[key][int(template.params.template_hash)] = row
+        self.modified = True
+        return overlaps
+
     def cache_segment_snrs(self, stilde, psd):
         key = (id(stilde), id(psd))
         if key not in self._segment_snrs_cache:
             logging.info("Precalculate the bank veto template snrs")
-            data = segment_snrs(self.filters, stilde, psd, self.f_low)
-            self._segment_snrs_cache[key] = data
-        return self._segment_snrs_cache[key]
+            snrs, norms = segment_snrs(self.filters, stilde, psd, self.f_low)
+            # The snrs are held as the rows of a matrix, so that they can be
+            # read at the points of the triggers all at once
+            matrix = numpy.array([snr.numpy() for snr in snrs])
+            snrs = [TimeSeries(row, delta_t=snr.delta_t,
+                               epoch=snr.start_time, copy=False)
+                    for row, snr in zip(matrix, snrs)]
+            self._segment_snrs_cache[key] = (snrs, norms, matrix)
+        return self._segment_snrs_cache[key][0:2]
 
     def cache_overlaps(self, template, psd):
-        key = (id(template.params), id(psd))
-        if key not in self._overlaps_cache:
-            logging.info("...Calculate bank veto overlaps")
-            o = template_overlaps(self.filters, template, psd, self.f_low)
-            self._overlaps_cache[key] = o
-        return self._overlaps_cache[key]
+        return self.cache_overlaps_block([template], psd)[0]
+
+    def cache_overlaps_block(self, templates, psd):
+        """ Return the overlaps of several templates with the bank veto
+        templates for one PSD.
+
+        Overlaps are kept for each template and PSD, and in the overlaps
+        read from the overlap file. Those not found in either are calculated
+        together by `precompute_overlaps`.
+        """
+        psd_key = self.psd_key(psd)
+        overlaps = [None] * len(templates)
+        missing = []
+        for i, template in enumerate(templates):
+            key = (id(template.params), id(psd))
+            template_hash = int(template.params.template_hash)
+            if key in self._overlaps_cache:
+                overlaps[i] = self._overlaps_cache[key]
+            elif template_hash in self.overlaps[psd_key]:
+                overlaps[i] = self._overlaps_cache[key] = \
+                    self.overlaps[psd_key][template_hash]
+            else:
+                missing.append(i)
+
+        if missing:
+            logging.info("...Calculate bank veto overlaps of %d templates",
+                         len(missing))
+            block = self.precompute_overlaps([templates[i] for i in missing],
+                                             psd)
+            for i, o in zip(missing, block):
+                template = templates[i]
+                for j in numpy.flatnonzero(abs(o) > 0.99):
+                    logging.debug("Overlap > 0.99 between bank template and "
+                                  "filter, the expected value will be added "
+                                  "to the bank chisq instead. Masses of "
+                                  "filter template: %e %e, of bank filter "
+                                  "template: %e %e, overlap: %e",
+                                  template.params.mass1,
+                                  template.params.mass2,
+                                  self.filters[j].params.mass1,
+                                  self.filters[j].params.mass2, abs(o[j]))
+                overlaps[i] = self._overlaps_cache[(id(template.params),
+                                                    id(psd))] = o
+        return overlaps
 
     def values(self, template, psd, stilde, snrv, norm, indices):
         """
@@ -225,8 +522,14 @@ class SingleDetBankVeto(object):
             logging.info("...Doing bank veto")
             overlaps = self.cache_overlaps(template, psd)
             bank_veto_snrs, bank_veto_norms = self.cache_segment_snrs(stilde, psd)
-            chisq = bank_chisq_from_filters(snrv, norm, bank_veto_snrs,
-                                            bank_veto_norms, overlaps, indices)
+            if indices is not None:
+                matrix = self._segment_snrs_cache[(id(stilde), id(psd))][2]
+                chisq = bank_chisq_from_matrix(snrv, norm,
+                                               matrix[:, indices],
+                                               bank_veto_norms, overlaps)
+            else:
+                chisq = bank_chisq_from_filters(snrv, norm, bank_veto_snrs,
+                                                bank_veto_norms, overlaps)
             dof = numpy.repeat(self.dof, len(chisq))
             return chisq, dof
         else:
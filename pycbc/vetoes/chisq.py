@@ -21,11 +21,13 @@
 #
 # =============================================================================
 #
-import numpy, logging, math, pycbc.fft
+import numpy, logging, math, time, os.path, glob, h5py, pycbc.fft
 
 from pycbc.types import zeros, real_same_precision_as, TimeSeries, complex_same_precision_as
+from pycbc.types import Array
 from pycbc.filter import sigmasq_series, make_frequency_series, matched_filter_core, get_cutoff_indices
 from pycbc.scheme import schemed
+from pycbc.waveform.bank import SigmasqCache, save_cache_files
 import pycbc.pnutils
 
 BACKEND_PREFIX="pycbc.vetoes.chisq_"
@@ -59,6 +61,221 @@ def power_chisq_bins_from_sigmasq_series(sigmasq_series, num_bins, kmin, kmax):
     bins += kmin
     return numpy.append(bins, kmax)
 
+def power_chisq_bins_block(sigmasq_series, num_bins, kmin, kmax):
+    """Returns the bins of equal power of many templates at once
+
+    The bins of each template are those given by
+    `power_chisq_bins_from_sigmasq_series` for its num_bins, kmin and kmax,
+    but are found for all templates with a single search of the cumulative
+    series.
+
+    Parameters
+    ----------
+    sigmasq_series: FrequencySeries
+        A frequency series containing the cumulative power, preweighted by a
+        psd, shared by the templates, eg. the `sigmasq_vec` of an
+        approximant with an analytic normalization.
+    num_bins: int or array of ints
+        The number of chisq bins of each template.
+    kmin: array of ints
+        The first frequency index of each template.
+    kmax: array of ints
+        The frequency index after the end of each template.
+
+    Returns
+    -------
+    bins: list of arrays
+        The edges of the bins of each template.
+    """
+    series = numpy.array(sigmasq_series, copy=False)
+    kmin = numpy.array(kmin, dtype=int)
+    kmax = numpy.array(kmax, dtype=int)
+    num_bins = numpy.zeros(len(kmin), dtype=int) + num_bins
+
+    # The lower edge of bin j of each template, one after another
+    tmplt = numpy.repeat(numpy.arange(len(kmin)), num_bins)
+    first = numpy.cumsum(num_bins) - num_bins
+    j = numpy.arange(num_bins.sum()) - numpy.repeat(first, num_bins)
+    edge_vec = j * series[kmax - 1][tmplt] / num_bins[tmplt]
+
+    # The series is non-decreasing, so searching all of it and clipping to
+    # the range of each template is a search within that range
+    edges = numpy.searchsorted(series, edge_vec, side='right')
+    edges = numpy.clip(edges, kmin[tmplt], kmax[tmplt])
+    return [numpy.append(edges[f:f + n], k)
+            for f, n, k in zip(first, num_bins, kmax)]
+
+class ChisqBinCache(object):
+    """ A cache of power chisq bins, keyed by template hash and PSD, which
+    can be kept on disk and shared between jobs.
+
+    A PSD is identified by the hash of its content and frequency spacing,
+    and by a fingerprint: its mean in logarithmically spaced frequency
+    bands. The bins found with one PSD are reused for another of the same
+    length and spacing when the fractional difference of their fingerprints
+    in every band is no more than the tolerance. The bins of a template also
+    depend on its number of bins and frequency range, which are part of its
+    key.
+
+    If a directory is given, the bins of each PSD are kept in a file there,
+    replaced in the same way as those of `pycbc.waveform.SigmasqCache`, so
+    they are reused by later jobs with the same, or similar, PSDs.
+
+    Parameters
+    ----------
+    tolerance : {0, float}
+        The largest fractional difference of two PSD fingerprints for which
+        bins are shared. If 0, bins are only shared by identical PSDs.
+    directory : {None, str}
+        The cache directory, which is created if needed. If None, the bins
+        are only held in memory.
+    max_files : {1000, int}
+        The maximum number of PSD files to keep in the directory.
+    """
+    num_bands = 64
+
+    def __init__(self, tolerance=0, directory=None, max_files=1000):
+        self.tolerance = tolerance
+        self.directory = directory
+        self.max_files = max_files
+        # The key, frequency spacing, length and fingerprint of each PSD
+        self.psds = []
+        self.bins = {}
+        self.modified = set()
+        self._scanned = False
+        if directory is not None and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another job may have just created it
+                if not os.path.isdir(directory):
+                    raise
+
+    @classmethod
+    def fingerprint(cls, psd):
+        """ Return the mean of the PSD in logarithmically spaced bands,
+        from its first non-zero sample to its end
+        """
+        data = psd.numpy()
+        nonzero = numpy.flatnonzero(data)
+        kmin = max(nonzero[0], 1) if len(nonzero) else 1
+        edges = numpy.logspace(numpy.log10(kmin), numpy.log10(len(data)),
+                               cls.num_bands + 1).astype(int)
+        edges = numpy.unique(edges[:-1])
+        sums = numpy.add.reduceat(data, edges)
+        return sums / numpy.diff(numpy.append(edges, len(data)))
+
+    def _filename(self, key):
+        return os.path.join(self.directory, 'chisq_bins_%s.hdf' % key)
+
+    def _scan(self):
+        """ Read the fingerprints of the PSDs in the cache directory """
+        self._scanned = True
+        if self.directory is None:
+            return
+        for fname in glob.glob(os.path.join(self.directory,
+                                            'chisq_bins_*.hdf')):
+            key = os.path.basename(fname)[len('chisq_bins_'):-len('.hdf')]
+            try:
+                with h5py.File(fname, 'r') as f:
+                    self.psds.append((key, f.attrs['delta_f'],
+                                      f.attrs['length'], f['fingerprint'][:]))
+            except (IOError, OSError, KeyError):
+                pass
+
+    def _read(self, key):
+        bins = {}
+        if self.directory is None:
+            return bins
+
+        fname = self._filename(key)
+        try:
+            with h5py.File(fname, 'r') as f:
+                offsets = f['bin_offsets'][:]
+                edges = f['bin_edges'][:]
+                for i, k in enumerate(zip(f['template_hash'][:],
+                                          f['num_bins'][:], f['kmin'][:],
+                                          f['kmax'][:])):
+                    bins[tuple(int(v) for v in k)] = \
+                        edges[offsets[i]:offsets[i+1]]
+            # Mark the file as recently used
+            os.utime(fname, None)
+        except (IOError, OSError, KeyError):
+            pass
+        return bins
+
+    def psd_key(self, psd):
+        """ Return the key of the cached PSD whose bins are used for this
+        PSD, adding the PSD to the cache if there is none
+        """
+        if getattr(psd, '_chisq_bin_cache', None) is not self:
+            if not self._scanned:
+                self._scan()
+            key = SigmasqCache.psd_key(psd)
+            match = [k for k, _, _, _ in self.psds if k == key]
+            if not match and self.tolerance > 0:
+                fingerprint = self.fingerprint(psd)
+                match = [k for k, df, l, fp in self.psds
+                         if df == psd.delta_f and l == len(psd) and
+                         len(fp) == len(fingerprint) and
+                         (abs(fp / fingerprint - 1) <= self.tolerance).all()]
+            if match:
+                key = match[0]
+            else:
+                self.psds.append((key, psd.delta_f, len(psd),
+                                  self.fingerprint(psd)))
+            psd._chisq_bin_cache = self
+            psd._chisq_bin_key = key
+        return psd._chisq_bin_key
+
+    def _bins(self, psd):
+        key = self.psd_key(psd)
+        if key not in self.bins:
+            self.bins[key] = self._read(key)
+        return key, self.bins[key]
+
+    def get(self, psd, template_hash, num_bins, kmin, kmax):
+        """ Return the cached bins of a template, or None if they are not
+        in the cache
+        """
+        _, bins = self._bins(psd)
+        return bins.get((int(template_hash), int(num_bins), int(kmin),
+                         int(kmax)))
+
+    def set(self, psd, template_hash, num_bins, kmin, kmax, bins):
+        """ Add the bins of a template to the cache """
+        key, cached = self._bins(psd)
+        cached[(int(template_hash), int(num_bins), int(kmin), int(kmax))] = \
+            numpy.array(bins, dtype=numpy.int64)
+        self.modified.add(key)
+
+    def save(self):
+        """ Write the bins added since the last save to the cache directory
+        and remove the least recently used files if there are too many
+        """
+        if self.directory is None:
+            self.modified.clear()
+            return
+
+        def write(f, key, entries):
+            _, delta_f, length, fingerprint = [p for p in self.psds
+                                               if p[0] == key][0]
+            f.attrs['delta_f'] = delta_f
+            f.attrs['length'] = length
+            f['fingerprint'] = fingerprint
+            for i, name in enumerate(['template_hash', 'num_bins',
+                                      'kmin', 'kmax']):
+                f[name] = numpy.array([e[0][i] for e in entries],
+                                      dtype=numpy.int64)
+            f['bin_offsets'] = numpy.cumsum([0] + [len(e[1])
+                                                   for e in entries])
+            f['bin_edges'] = numpy.concatenate([e[1] for e in entries])
+
+        save_cache_files(self.directory, 'chisq_bins_', self.max_files,
+                         dict((key, self.bins[key]) for key in self.modified),
+                         self._read, write)
+        self.modified.clear()
+
 def power_chisq_bins(htilde, num_bins, psd, low_frequency_cutoff=None,
                      high_frequency_cutoff=None):
     """Returns bins of equal power for use with the chisq functions
@@ -131,6 +348,72 @@ def power_chisq_at_points_from_precomputed(corr, snr, snr_norm, bins, indices):
     chisq = shift_sum(corr, indices, bins) # pylint:disable=assignment-from-no-return
     return (chisq * num_bins - (snr.conj() * snr).real) * (snr_norm ** 2.0)
 
+@schemed(BACKEND_PREFIX)
+def shift_sum_block(corr_block, rows, shifts, bin_edges, bin_offsets):
+    """ Calculate the time shifted sum of the bins of many correlation
+    vectors, summing the squared magnitude of each bin.
+
+    Parameters
+    ----------
+    corr_block: numpy.ndarray
+        A 2-d array, each row of which is the correlation vector of a template.
+    rows: numpy.ndarray
+        The row of `corr_block` of each point.
+    shifts: numpy.ndarray
+        The time index of each point.
+    bin_edges: numpy.ndarray
+        The edges of the bins of all the rows, one after another.
+    bin_offsets: numpy.ndarray
+        The edges of the bins of row i are
+        bin_edges[bin_offsets[i]:bin_offsets[i+1]].
+
+    Returns
+    -------
+    sums: numpy.ndarray
+        The sum over the bins of its row of each point.
+    """
+    pass
+
+def power_chisq_at_points_block(corr_block, rows, snrv, snr_norms, bins,
+                                indices):
+    """Calculate the chisq of many templates at select points in one pass.
+
+    This is `power_chisq_at_points_from_precomputed` for the points of many
+    templates, whose correlation vectors are the rows of one 2-d array, such
+    as the correlation memory of a `BatchMatchedFilterControl`. The points
+    of all the templates are evaluated by a single call to a parallel
+    kernel.
+
+    Parameters
+    ----------
+    corr_block: numpy.ndarray
+        A 2-d array, each row of which is the correlation vector of a template.
+    rows: numpy.ndarray
+        The row of `corr_block` of each point.
+    snrv: numpy.ndarray
+        The unnormalized snr at each point.
+    snr_norms: numpy.ndarray
+        The snr normalization of each row.
+    bins: list of arrays
+        The edges of the equal power bins of each row. Rows without points
+        can be given a single edge, ie. no bins.
+    indices: numpy.ndarray
+        The index of each point, relative to the correlation vectors.
+
+    Returns
+    -------
+    chisq: numpy.ndarray
+        The chisq at each point.
+    """
+    rows = numpy.array(rows, dtype=int)
+    bin_offsets = numpy.cumsum([0] + [len(b) for b in bins])
+    bin_edges = numpy.concatenate([numpy.array(b, dtype=int) for b in bins])
+    num_bins = numpy.array([len(b) - 1 for b in bins])[rows]
+    chisq = shift_sum_block(corr_block, rows, indices, bin_edges, bin_offsets) # pylint:disable=assignment-from-no-return
+    snrv = numpy.array(snrv)
+    return (chisq * num_bins - (snrv.conj() * snrv).real) * \
+           (numpy.array(snr_norms)[rows] ** 2.0)
+
 _q_l = None
 _qtilde_l = None
 _chisq_l = None
@@ -252,6 +535,60 @@ def fastest_power_chisq_at_points(corr, snr, snrv, snr_norm, bins, indices):
                                             indices=indices)
 
 
+class PowerChisqCostModel(object):
+    """Chooses the faster way to calculate the power chisq at a set of points.
+
+    The chisq can be found by a direct time shift and sum of the bins at each
+    point, whose cost grows with the number of points and the number of
+    frequency samples in the bins, or by an inverse FFT of each bin, whose
+    cost grows with the number of bins and the length of the FFT. The cost of
+    each, per point and frequency sample and per bin, is measured the first
+    time a correlation vector of a given length and type is seen.
+    """
+    def __init__(self, num_points=16, repeats=3):
+        self.num_points = num_points
+        self.repeats = repeats
+        self.costs = {}
+
+    def _time(self, fn):
+        best = None
+        for _ in range(self.repeats):
+            start = time.time()
+            fn()
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def measure(self, corr, snr):
+        """ Return the cost of the direct method per point and frequency
+        sample, and the cost of the FFT method per bin, for correlation
+        vectors like `corr`.
+        """
+        key = (len(corr), corr.dtype)
+        if key not in self.costs:
+            kmax = len(corr) // 2
+            indices = numpy.arange(self.num_points) * (len(corr) // \
+                                                       self.num_points)
+            snrv = numpy.zeros(self.num_points, dtype=corr.dtype)
+            direct = self._time(lambda: power_chisq_at_points_from_precomputed(
+                                corr, snrv, 1.0, [0, kmax], indices))
+            fft = self._time(lambda: power_chisq_from_precomputed(
+                                corr, snr, 1.0, [0, kmax], indices=indices))
+            self.costs[key] = (direct / (self.num_points * kmax), fft)
+            logging.info("Power chisq costs for length %s: %.3g s per point "
+                         "and sample, %.3g s per FFT", len(corr),
+                         self.costs[key][0], self.costs[key][1])
+        return self.costs[key]
+
+    def use_fft(self, corr, snr, bins, num_points):
+        """ Return True if the FFT method is expected to be faster than the
+        direct method for `num_points` points of a template with the given
+        bins.
+        """
+        point_cost, fft_cost = self.measure(corr, snr)
+        num_samples = bins[-1] - bins[0]
+        return fft_cost * (len(bins) - 1) < point_cost * num_points * num_samples
+
 def power_chisq(template, data, num_bins, psd,
                 low_frequency_cutoff=None,
                 high_frequency_cutoff=None,
@@ -299,7 +636,7 @@ class SingleDetPowerChisq(object):
     """Class that handles precomputation and memory management for efficiently
     running the power chisq in a single detector inspiral analysis.
     """
-    def __init__(self, num_bins=0, snr_threshold=None):
+    def __init__(self, num_bins=0, snr_threshold=None, bin_cache=None):
         if not (num_bins == "0" or num_bins == 0):
             self.do = True
             self.column_name = "chisq"
@@ -308,6 +645,8 @@ class SingleDetPowerChisq(object):
         else:
             self.do = False
         self.snr_threshold = snr_threshold
+        self.bin_cache = bin_cache
+        self.cost_model = PowerChisqCostModel()
 
     @staticmethod
     def parse_option(row, arg):
@@ -318,31 +657,84 @@ class SingleDetPowerChisq(object):
         return eval(arg, {"__builtins__":None}, safe_dict)
 
     def cached_chisq_bins(self, template, psd):
+        return self.cached_chisq_bins_block([template], psd)[0]
+
+    def cached_chisq_bins_block(self, templates, psd):
+        """ Return the chisq bins of several templates for one PSD.
+
+        Bins are kept on each template, keyed by the PSD, and in the bin
+        cache if there is one. The bins not found in either are computed
+        together for the templates whose approximant has a cumulative
+        sigmasq series for the PSD, and one at a time for the others.
+        """
         key = id(psd)
         if not hasattr(psd, '_chisq_cached_key'):
             psd._chisq_cached_key = {}
 
-        if not hasattr(template, '_bin_cache'):
-            template._bin_cache = {}
+        bins = [None] * len(templates)
+        missing = []
+        for i, template in enumerate(templates):
+            if not hasattr(template, '_bin_cache'):
+                template._bin_cache = {}
+
+            if key in template._bin_cache and \
+                    id(template.params) in psd._chisq_cached_key:
+                bins[i] = template._bin_cache[key]
+                continue
 
-        if key not in template._bin_cache or id(template.params) not in psd._chisq_cached_key:
             psd._chisq_cached_key[id(template.params)] = True
             num_bins = int(self.parse_option(template, self.num_bins))
-
-            if hasattr(psd, 'sigmasq_vec') and template.approximant in psd.sigmasq_vec:
-                kmin = int(template.f_lower / psd.delta_f)
-                kmax = template.end_idx
-                bins = power_chisq_bins_from_sigmasq_series(
-                    psd.sigmasq_vec[template.approximant], num_bins, kmin, kmax)
+            kmin = int(template.f_lower / psd.delta_f)
+            kmax = template.end_idx
+            if self.bin_cache is not None:
+                bins[i] = self.bin_cache.get(psd, template.params.template_hash,
+                                             num_bins, kmin, kmax)
+            if bins[i] is None:
+                missing.append((i, num_bins, kmin, kmax))
+            template._bin_cache[key] = bins[i]
+
+        sigmasq_vec = getattr(psd, 'sigmasq_vec', {})
+        approximants = set(templates[m[0]].approximant for m in missing)
+        for approximant in approximants:
+            sel = [m for m in missing
+                   if templates[m[0]].approximant == approximant]
+            if approximant in sigmasq_vec:
+                block = power_chisq_bins_block(sigmasq_vec[approximant],
+                                               [m[1] for m in sel],
+                                               [m[2] for m in sel],
+                                               [m[3] for m in sel])
             else:
-                bins = power_chisq_bins(template, num_bins, psd, template.f_lower)
-            template._bin_cache[key] = bins
-
-        return template._bin_cache[key]
+                block = [power_chisq_bins(templates[i], num_bins, psd,
+                                          templates[i].f_lower)
+                         for i, num_bins, _, _ in sel]
+
+            for (i, num_bins, kmin, kmax), tbins in zip(sel, block):
+                bins[i] = templates[i]._bin_cache[key] = tbins
+                if self.bin_cache is not None:
+                    self.bin_cache.set(psd, templates[i].params.template_hash,
+                                       num_bins, kmin, kmax, tbins)
+        return bins
 
-    def values(self, corr, snrv, snr_norm, psd, indices, template):
+    def use_fft(self, corr, snr, bins, num_points):
+        """ Return True if the chisq at num_points points is faster to
+        calculate with inverse FFTs of the bins than directly. The FFT method
+        needs the full rate snr time series. The costs are only measured for
+        the cpu, other schemes always calculate the chisq directly.
+        """
+        if snr is None or len(snr) != len(corr):
+            return False
+        import pycbc.scheme
+        if not isinstance(pycbc.scheme.mgr.state, pycbc.scheme.CPUScheme):
+            return False
+        return self.cost_model.use_fft(corr, snr, bins, num_points)
+
+    def values(self, corr, snrv, snr_norm, psd, indices, template, snr=None):
         """ Calculate the chisq at points given by indices.
 
+        If the snr time series is given, the chisq is calculated with
+        inverse FFTs of the bins rather than directly at each point when
+        the measured costs of each predict this to be faster.
+
         Returns
         -------
         chisq: Array
@@ -370,7 +762,12 @@ class SingleDetPowerChisq(object):
             if num_above > 0:
                 bins = self.cached_chisq_bins(template, psd)
                 dof = (len(bins) - 1) * 2 - 2
-                chisq = power_chisq_at_points_from_precomputed(corr,
+                if self.use_fft(corr, snr, bins, num_above):
+                    chisq = power_chisq_from_precomputed(corr, snr, snr_norm,
+                                            bins, indices=above_indices)
+                    chisq = chisq.numpy()
+                else:
+                    chisq = power_chisq_at_points_from_precomputed(corr,
                                      above_snrv, snr_norm, bins, above_indices)
 
             if self.snr_threshold:
@@ -383,6 +780,102 @@ class SingleDetPowerChisq(object):
         else:
             return None, None
 
+    def batch_values(self, corr_block, rows, snrvs, snr_norms, psd, indices,
+                     templates, snrs=None):
+        """ Calculate the chisq of several templates filtered against the
+        same segment at once.
+
+        The points of all templates which are cheaper to evaluate directly
+        are evaluated together by `power_chisq_at_points_block`; the
+        remaining templates use inverse FFTs of their bins, as in `values`.
+
+        Parameters
+        ----------
+        corr_block: numpy.ndarray
+            A 2-d array whose rows hold the correlation vectors of the
+            templates, such as the `corr_block` of a
+            `BatchMatchedFilterControl`.
+        rows: list of ints
+            The row of `corr_block` of each template.
+        snrvs: list of arrays
+            The unnormalized snr at the trigger points of each template.
+        snr_norms: list of floats
+            The snr normalization of each template.
+        psd: FrequencySeries
+            The PSD of the segment.
+        indices: list of arrays
+            The trigger points of each template, relative to the correlation
+            vectors.
+        templates: list of FrequencySeries
+            The templates.
+        snrs: {None, list of TimeSeries}
+            The snr time series of each template, needed by the FFT method.
+
+        Returns
+        -------
+        values: list of tuples
+            The (chisq, chisq_dof) of each template, as returned by `values`.
+        """
+        if not self.do:
+            return [(None, None)] * len(templates)
+
+        aboves = []
+        for i in range(len(templates)):
+            above = numpy.ones(len(indices[i]), dtype=bool)
+            if self.snr_threshold:
+                above = abs(numpy.array(snrvs[i]) * snr_norms[i]) > \
+                        self.snr_threshold
+                logging.info('%s above chisq activation threshold',
+                             above.sum())
+            aboves.append(above)
+
+        # The bins of all the templates are found together
+        active = [i for i, above in enumerate(aboves) if above.any()]
+        all_bins = dict(zip(active, self.cached_chisq_bins_block(
+                                [templates[i] for i in active], psd)))
+
+        results = []
+        block = []
+        for i, above in enumerate(aboves):
+            dof = -100
+            chisq = numpy.zeros(len(indices[i]), dtype=numpy.float32)
+
+            if above.any():
+                bins = all_bins[i]
+                dof = (len(bins) - 1) * 2 - 2
+                corr = Array(corr_block[rows[i]], copy=False)
+                snr = None if snrs is None else snrs[i]
+                if self.use_fft(corr, snr, bins, above.sum()):
+                    chisq[above] = power_chisq_from_precomputed(corr, snr,
+                                        snr_norms[i], bins,
+                                indices=numpy.array(indices[i])[above]).numpy()
+                else:
+                    block.append((i, above, bins))
+            results.append((chisq, numpy.repeat(dof, len(indices[i]))))
+
+        if block:
+            # The points of these templates are evaluated in one call
+            norms = numpy.zeros(len(corr_block))
+            row_bins = [[0]] * len(corr_block)
+            points = []
+            for i, above, bins in block:
+                norms[rows[i]] = snr_norms[i]
+                row_bins[rows[i]] = bins
+                points.append(numpy.flatnonzero(above))
+            chisq = power_chisq_at_points_block(corr_block,
+                numpy.concatenate([numpy.repeat(rows[i], len(p))
+                                   for (i, _, _), p in zip(block, points)]),
+                numpy.concatenate([numpy.array(snrvs[i])[p]
+                                   for (i, _, _), p in zip(block, points)]),
+                norms, row_bins,
+                numpy.concatenate([numpy.array(indices[i])[p]
+                                   for (i, _, _), p in zip(block, points)]))
+            bounds = numpy.cumsum([0] + [len(p) for p in points])
+            for (i, _, _), p, lo, hi in zip(block, points, bounds[:-1],
+                                             bounds[1:]):
+                results[i][0][p] = chisq[lo:hi]
+        return results
+
 class SingleDetSkyMaxPowerChisq(SingleDetPowerChisq):
     """Class that handles precomputation and memory management for efficiently
     running the power chisq in a single detector inspiral analysis when
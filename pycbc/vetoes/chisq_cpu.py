@@ -23,6 +23,7 @@
 #
 from __future__ import absolute_import
 import numpy, pycbc
+import pycbc.scheme
 from pycbc.types import real_same_precision_as
 from pycbc.weave import inline
 from pycbc import WEAVE_FLAGS
@@ -34,6 +35,15 @@ else:
     omp_libs = []
     omp_flags = []
 
+def num_threads():
+    """ The number of threads used by the kernels, as set by the processing
+    scheme in use
+    """
+    return max(1, int(getattr(pycbc.scheme.mgr.state, 'num_threads', 1)))
+
+# Vectors shorter than this are accumulated by a single thread
+chisq_accum_min_parallel = 2 ** 16
+
 def chisq_accum_bin_numpy(chisq, q):
     chisq += q.squared_norm()
 
@@ -42,107 +52,104 @@ def chisq_accum_bin_inline(chisq, q):
     chisq = numpy.array(chisq.data, copy=False)
     q = numpy.array(q.data, copy=False)
     N = len(chisq) # pylint:disable=unused-variable
+    nthreads = num_threads() if N >= chisq_accum_min_parallel else 1
     code = """
-        #pragma omp parallel for
+        #pragma omp parallel for schedule(static) num_threads(nthreads)
         for (int i=0; i<N; i++){
             chisq[i] += q[i].real()*q[i].real()+q[i].imag()*q[i].imag();
         }
     """
-    inline(code, ['chisq', 'q', 'N'],
+    inline(code, ['chisq', 'q', 'N', 'nthreads'],
                     extra_compile_args=[WEAVE_FLAGS] + omp_flags,
                     libraries=omp_libs
           )
 
 chisq_accum_bin = chisq_accum_bin_inline
 
+# Each bin is split into nthreads pieces, and the pieces of all the bins are
+# summed in parallel. Each piece keeps its own partial sums, which are added
+# together in order afterwards, so the result does not depend on which
+# thread ran which piece.
 point_chisq_code = """
-    int num_parallel_regions = 16;
+    int ntasks = blen * nthreads;
+    TYPE* partr = (TYPE*) malloc(sizeof(TYPE) * n * ntasks);
+    TYPE* parti = (TYPE*) malloc(sizeof(TYPE) * n * ntasks);
+
+    #pragma omp parallel for schedule(dynamic) num_threads(nthreads)
+    for (int t=0; t<ntasks; t++){
+        unsigned int r = t / nthreads;
+        unsigned int k = t % nthreads;
+        unsigned long bstart = bins[r];
+        unsigned long bwidth = bins[r+1] - bstart;
+        unsigned int start = bwidth * k / nthreads + bstart;
+        unsigned int end = bwidth * (k + 1) / nthreads + bstart;
+
+        TYPE* outr_tmp = partr + (long) t * n;
+        TYPE* outi_tmp = parti + (long) t * n;
+
+        //start the cumulative rotations at the offset point
+        TYPE* pr = (TYPE*) malloc(sizeof(TYPE)*n);
+        TYPE* pi = (TYPE*) malloc(sizeof(TYPE)*n);
+        TYPE* vsr = (TYPE*) malloc(sizeof(TYPE)*n);
+        TYPE* vsi = (TYPE*) malloc(sizeof(TYPE)*n);
 
-    for (unsigned int r=0; r<blen; r++){
-        int bstart = bins[r];
-        int bend = bins[r+1];
-        int blen = bend - bstart;
-
-        TYPE* outr = (TYPE*) malloc(sizeof(TYPE)*n);
-        TYPE* outi = (TYPE*) malloc(sizeof(TYPE)*n);
         for (int i=0; i<n; i++){
-            outr[i] = 0;
-            outi[i] = 0;
+            pr[i] = cos(2 * 3.141592653 * shifts[i] * (start) / slen);
+            pi[i] = sin(2 * 3.141592653 * shifts[i] * (start) / slen);
+            vsr[i] = cos(2 * 3.141592653 * shifts[i] / slen);
+            vsi[i] = sin(2 * 3.141592653 * shifts[i] / slen);
+            outr_tmp[i] = 0;
+            outi_tmp[i] = 0;
         }
 
-        #pragma omp parallel for
-        for (unsigned int k=0; k<num_parallel_regions; k++){
-            unsigned int start = blen * k / num_parallel_regions + bstart;
-            unsigned int end = blen * (k + 1) / num_parallel_regions + bstart;
-
-            //start the cumulative rotations at the offset point
-            TYPE* pr = (TYPE*) malloc(sizeof(TYPE)*n);
-            TYPE* pi = (TYPE*) malloc(sizeof(TYPE)*n);
-            TYPE* vsr = (TYPE*) malloc(sizeof(TYPE)*n);
-            TYPE* vsi = (TYPE*) malloc(sizeof(TYPE)*n);
-            TYPE* outr_tmp = (TYPE*) malloc(sizeof(TYPE)*n);
-            TYPE* outi_tmp = (TYPE*) malloc(sizeof(TYPE)*n);
+        TYPE t1, t2, k1, k2, k3, vs, va;
 
+        for (unsigned int j=start; j<end; j++){
+            std::complex<TYPE> v = v1[j];
+            TYPE vr = v.real();
+            TYPE vi = v.imag();
+            vs = vr + vi;
+            va = vi - vr;
 
             for (int i=0; i<n; i++){
-                pr[i] = cos(2 * 3.141592653 * shifts[i] * (start) / slen);
-                pi[i] = sin(2 * 3.141592653 * shifts[i] * (start) / slen);
-                vsr[i] = cos(2 * 3.141592653 * shifts[i] / slen);
-                vsi[i] = sin(2 * 3.141592653 * shifts[i] / slen);
-                outr_tmp[i] = 0;
-                outi_tmp[i] = 0;
-            }
-
-            TYPE t1, t2, k1, k2, k3, vs, va;
-
-            for (unsigned int j=start; j<end; j++){
-                std::complex<TYPE> v = v1[j];
-                TYPE vr = v.real();
-                TYPE vi = v.imag();
-                vs = vr + vi;
-                va = vi - vr;
+                t1 = pr[i];
+                t2 = pi[i];
 
-                for (int i=0; i<n; i++){
-                    t1 = pr[i];
-                    t2 = pi[i];
+                // Complex multiply pr[i] * v
+                k1 = vr * (t1 + t2);
+                k2 = t1 * va;
+                k3 = t2 * vs;
 
-                    // Complex multiply pr[i] * v
-                    k1 = vr * (t1 + t2);
-                    k2 = t1 * va;
-                    k3 = t2 * vs;
+                outr_tmp[i] += k1 - k3;
+                outi_tmp[i] += k1 + k2;
 
-                    outr_tmp[i] += k1 - k3;
-                    outi_tmp[i] += k1 + k2;
-
-                    // phase shift for the next time point
-                    pr[i] = t1 * vsr[i] - t2 * vsi[i];
-                    pi[i] = t1 * vsi[i] + t2 * vsr[i];
-                }
-            }
-
-            #pragma omp critical
-            {
-                for (unsigned int i=0; i<n; i++){
-                    outr[i] += outr_tmp[i];
-                    outi[i] += outi_tmp[i];
-                }
+                // phase shift for the next time point
+                pr[i] = t1 * vsr[i] - t2 * vsi[i];
+                pi[i] = t1 * vsi[i] + t2 * vsr[i];
             }
-
-            free(pr);
-            free(pi);
-            free(outr_tmp);
-            free(outi_tmp);
-            free(vsr);
-            free(vsi);
-
         }
 
-        for (unsigned int i=0; i<n; i++){
-            chisq[i] += outr[i]*outr[i] + outi[i]*outi[i];
+        free(pr);
+        free(pi);
+        free(vsr);
+        free(vsi);
+    }
+
+    for (unsigned int r=0; r<blen; r++){
+        for (int i=0; i<n; i++){
+            TYPE outr = 0;
+            TYPE outi = 0;
+            for (int k=0; k<nthreads; k++){
+                long t = (long) r * nthreads + k;
+                outr += partr[t * n + i];
+                outi += parti[t * n + i];
+            }
+            chisq[i] += outr*outr + outi*outi;
         }
-        free(outr);
-        free(outi);
     }
+
+    free(partr);
+    free(parti);
 """
 
 point_chisq_code_single = point_chisq_code.replace('TYPE', 'float')
@@ -156,6 +163,7 @@ def shift_sum(v1, shifts, bins):
     blen = len(bins) - 1 # pylint:disable=unused-variable
     v1 = numpy.array(v1.data, copy=False)
     slen = len(v1) # pylint:disable=unused-variable
+    nthreads = num_threads() # pylint:disable=unused-variable
 
     if v1.dtype.name == 'complex64':
         code = point_chisq_code_single
@@ -167,9 +175,143 @@ def shift_sum(v1, shifts, bins):
     # Create some output memory
     chisq =  numpy.zeros(n, dtype=real_type)
 
-    inline(code, ['v1', 'n', 'chisq', 'slen', 'shifts', 'bins', 'blen'],
+    inline(code, ['v1', 'n', 'chisq', 'slen', 'shifts', 'bins', 'blen',
+                  'nthreads'],
                     extra_compile_args=[WEAVE_FLAGS] + omp_flags,
                     libraries=omp_libs
           )
 
     return  chisq
+
+def shift_sum_block_numpy(corr_block, rows, shifts, bin_edges, bin_offsets):
+    real_type = numpy.float32 if corr_block.dtype == numpy.complex64 \
+                else numpy.float64
+    slen = corr_block.shape[1]
+    chisq = numpy.zeros(len(shifts), dtype=numpy.float64)
+    for row in numpy.unique(rows):
+        sel = numpy.flatnonzero(rows == row)
+        edges = bin_edges[bin_offsets[row]:bin_offsets[row+1]]
+        for kstart, kend in zip(edges[:-1], edges[1:]):
+            # Work through each bin in pieces to bound the memory used
+            total = numpy.zeros(len(sel), dtype=numpy.complex128)
+            for k in range(kstart, kend, 4096):
+                kvec = numpy.arange(k, min(k + 4096, kend))
+                phase = numpy.outer(shifts[sel].astype(numpy.int64), kvec)
+                phase = numpy.exp(2.0j * numpy.pi * (phase % slen) / slen)
+                total += numpy.dot(phase, corr_block[row, kvec])
+            chisq[sel] += total.real ** 2 + total.imag ** 2
+    return chisq.astype(real_type)
+
+block_chisq_code = """
+    #pragma omp parallel for schedule(dynamic) num_threads(nthreads)
+    for (int t=0; t<ntasks; t++){
+        int pstart = task_starts[t];
+        int np = task_starts[t+1] - pstart;
+        int row = rows[pstart];
+        std::complex<TYPE>* v = corr + (long) row * slen;
+
+        double* pr = (double*) malloc(sizeof(double)*np);
+        double* pi = (double*) malloc(sizeof(double)*np);
+        double* vsr = (double*) malloc(sizeof(double)*np);
+        double* vsi = (double*) malloc(sizeof(double)*np);
+        double* outr = (double*) malloc(sizeof(double)*np);
+        double* outi = (double*) malloc(sizeof(double)*np);
+
+        for (int i=0; i<np; i++){
+            double step = 2 * 3.141592653589793 * shifts[pstart+i] / slen;
+            vsr[i] = cos(step);
+            vsi[i] = sin(step);
+        }
+
+        for (int b=bin_offsets[row]; b<bin_offsets[row+1]-1; b++){
+            long bstart = bin_edges[b];
+            long bend = bin_edges[b+1];
+
+            // start the cumulative rotations at the first sample of the bin
+            for (int i=0; i<np; i++){
+                long shift = shifts[pstart+i];
+                double phase = 2 * 3.141592653589793 * ((shift * bstart) % slen) / slen;
+                pr[i] = cos(phase);
+                pi[i] = sin(phase);
+                outr[i] = 0;
+                outi[i] = 0;
+            }
+
+            for (long j=bstart; j<bend; j++){
+                double vr = v[j].real();
+                double vi = v[j].imag();
+                for (int i=0; i<np; i++){
+                    double t1 = pr[i];
+                    double t2 = pi[i];
+                    outr[i] += t1 * vr - t2 * vi;
+                    outi[i] += t1 * vi + t2 * vr;
+
+                    // phase shift for the next frequency
+                    pr[i] = t1 * vsr[i] - t2 * vsi[i];
+                    pi[i] = t1 * vsi[i] + t2 * vsr[i];
+                }
+            }
+
+            for (int i=0; i<np; i++){
+                chisq[pstart+i] += outr[i]*outr[i] + outi[i]*outi[i];
+            }
+        }
+
+        free(pr);
+        free(pi);
+        free(vsr);
+        free(vsi);
+        free(outr);
+        free(outi);
+    }
+"""
+
+block_chisq_code_single = block_chisq_code.replace('TYPE', 'float')
+block_chisq_code_double = block_chisq_code.replace('TYPE', 'double')
+
+# The number of points of one template which are evaluated together. Each
+# pass over the frequencies of a bin is shared by this many points.
+block_chisq_points = 32
+
+def shift_sum_block_inline(corr_block, rows, shifts, bin_edges, bin_offsets):
+    real_type = numpy.float32 if corr_block.dtype == numpy.complex64 \
+                else numpy.float64
+
+    # Sort the points by template, and split the points of each template
+    # into tasks which are run in parallel
+    order = numpy.argsort(rows, kind='mergesort')
+    rows = numpy.array(rows, dtype=numpy.int32)[order]
+    shifts = numpy.array(shifts, dtype=numpy.int64)[order]
+    starts = numpy.flatnonzero(numpy.diff(rows)) + 1
+    starts = numpy.concatenate([[0], starts, [len(rows)]])
+    task_starts = [numpy.arange(s, e, block_chisq_points)
+                   for s, e in zip(starts[:-1], starts[1:])]
+    task_starts = numpy.concatenate(task_starts + [[len(rows)]])
+    task_starts = task_starts.astype(numpy.int32)
+    ntasks = len(task_starts) - 1 # pylint:disable=unused-variable
+
+    bin_edges = numpy.array(bin_edges, dtype=numpy.int64)
+    bin_offsets = numpy.array(bin_offsets, dtype=numpy.int32)
+    corr = numpy.ascontiguousarray(corr_block).reshape(-1)
+    slen = corr_block.shape[1] # pylint:disable=unused-variable
+    nthreads = num_threads() # pylint:disable=unused-variable
+
+    if corr.dtype.name == 'complex64':
+        code = block_chisq_code_single
+    else:
+        code = block_chisq_code_double
+
+    chisq = numpy.zeros(len(rows), dtype=numpy.float64)
+    if len(rows):
+        inline(code, ['corr', 'slen', 'rows', 'shifts', 'task_starts',
+                      'ntasks', 'bin_edges', 'bin_offsets', 'chisq',
+                      'nthreads'],
+                        extra_compile_args=[WEAVE_FLAGS] + omp_flags,
+                        libraries=omp_libs
+              )
+
+    out = numpy.zeros(len(rows), dtype=real_type)
+    out[order] = chisq
+    return out
+
+shift_sum_block = shift_sum_block_inline
@@ -2,13 +2,54 @@
 
 import numpy
 import logging
+from collections import OrderedDict
 
-from pycbc.waveform.utils import apply_fseries_time_shift
-from pycbc.filter import sigma
-from pycbc.waveform import sinegauss
+from pycbc.waveform.bank import SigmasqCache
 from pycbc.vetoes.chisq import SingleDetPowerChisq
 from pycbc.events import newsnr
 
+def sine_gaussian_tile(quality, central_frequency, flow, fhigh, delta_f, psd):
+    """ Return a unit amplitude Fourier domain sine-Gaussian, normalized
+    by its sigma for the PSD, over its frequency range only. The values are
+    the same as those of `pycbc.waveform.sinegauss.fd_sine_gaussian` from
+    flow, normalized by `pycbc.filter.sigma` between flow and fhigh.
+
+    Parameters
+    ----------
+    quality: float
+        The quality factor
+    central_frequency: float
+        The central frequency of the sine-Gaussian
+    flow: float
+        The lowest frequency of the tile
+    fhigh: float
+        The frequency at which the tile ends
+    delta_f: float
+        The size of the frequency step
+    psd: pycbc.types.FrequencySeries
+        The power spectral density of the data
+
+    Returns
+    -------
+    kmin: int
+        The first frequency index of the tile
+    kmax: int
+        The frequency index after the end of the tile
+    tile: numpy.ndarray
+        The normalized tile between kmin and kmax
+    """
+    kmin = int(flow / delta_f)
+    kmax = int(fhigh / delta_f)
+    f = flow + numpy.arange(kmax - kmin) * delta_f
+    tau = quality / 2 / numpy.pi / central_frequency
+    A = numpy.pi ** 0.5 / 2 * tau
+    d = A * numpy.exp(-(numpy.pi  * tau  * (f - central_frequency))**2.0)
+    d *= (1 + numpy.exp(-quality ** 2.0 * f / central_frequency))
+    d = d.astype(numpy.float32)
+    gsigma = (4.0 * delta_f * (d.astype(numpy.float64) ** 2 /
+                               psd.numpy()[kmin:kmax]).sum()) ** 0.5
+    return kmin, kmax, d / gsigma
+
 class SingleDetSGChisq(SingleDetPowerChisq):
     """Class that handles precomputation and memory management for efficiently
     running the sine-Gaussian chisq
@@ -17,7 +58,8 @@ class SingleDetSGChisq(SingleDetPowerChisq):
 
     def __init__(self, bank, num_bins=0,
                        snr_threshold=None,
-                       chisq_locations=None):
+                       chisq_locations=None,
+                       tile_cache_size=10000):
         """ Create sine-Gaussian Chisq Calculator
 
         Parameters
@@ -34,7 +76,14 @@ class SingleDetSGChisq(SingleDetPowerChisq):
             The offset is relative to the end frequency of the approximant.
             The region is a boolean expresion such as 'mtotal>40' and indicates
             where to apply this set of sine-Gaussians.
+        tile_cache_size: int
+            The number of sine-Gaussian tiles to keep, keyed by their
+            parameters and the PSD. The tiles of a template are the same for
+            all templates with the same peak frequency.
         """
+        self.bin_cache = None
+        self.tile_cache_size = tile_cache_size
+        self._tiles = OrderedDict()
         if snr_threshold is not None:
             self.do = True
             self.num_bins = num_bins
@@ -105,74 +154,115 @@ class SingleDetSGChisq(SingleDetPowerChisq):
         # Get the chisq bins to use as the frequency reference point
         bins = self.cached_chisq_bins(template, psd)
 
-        # This is implemented slowly, so let's not call it often, OK?
         chisq = numpy.ones(len(snrv))
-        for i, snrvi in enumerate(snrv):
-            #Skip if newsnr too low
-            snr = abs(snrvi * snr_norm)
-            nsnr = newsnr(snr, bchisq[i] / bchisq_dof[i])
-            if nsnr < self.snr_threshold:
-                continue
-
-            N = (len(template) - 1) * 2
-            dt = 1.0 / (N * template.delta_f)
-            kmin = int(template.f_lower / psd.delta_f)
-            time = float(template.epoch) + dt * indices[i]
-            # Shift the time of interest to be centered on 0
-            stilde_shift = apply_fseries_time_shift(stilde, -time)
-
-            # Only apply the sine-Gaussian in a +-50 Hz range around the
-            # central frequency
-            qwindow = 50
-            chisq[i] = 0
-
-            # Estimate the maximum frequency up to which the waveform has
-            # power by approximating power per frequency
-            # as constant over the last 2 chisq bins. We cannot use the final
-            # chisq bin edge as it does not have to be where the waveform
-            # terminates.
-            fstep = (bins[-2] - bins[-3])
-            fpeak = (bins[-2] + fstep) * template.delta_f
-
-            # This is 90% of the Nyquist frequency of the data
-            # This allows us to avoid issues near Nyquist due to resample
-            # Filtering
-            fstop = len(stilde) * stilde.delta_f * 0.9
-
-            dof = 0
-            # Calculate the sum of SNR^2 for the sine-Gaussians specified
-            for descr in values:
-                # Get the q and frequency offset from the descriptor
-                q, offset = descr.split('-')
-                q, offset = float(q), float(offset)
-                fcen = fpeak + offset
-                flow = max(kmin * template.delta_f, fcen - qwindow)
-                fhigh = fcen + qwindow
-
-                # If any sine-gaussian tile has an upper frequency near
-                # nyquist return 1 instead.
-                if fhigh > fstop:
-                    return numpy.ones(len(snrv))
-
-                kmin = int(flow / template.delta_f)
-                kmax = int(fhigh / template.delta_f)
-
-                #Calculate sine-gaussian tile
-                gtem = sinegauss.fd_sine_gaussian(1.0, q, fcen, flow,
-                                      len(template) * template.delta_f,
-                                      template.delta_f).astype(numpy.complex64)
-                gsigma = sigma(gtem, psd=psd,
-                                     low_frequency_cutoff=flow,
-                                     high_frequency_cutoff=fhigh)
-                #Calculate the SNR of the tile
-                gsnr = (gtem[kmin:kmax] * stilde_shift[kmin:kmax]).sum()
-                gsnr *= 4.0 * gtem.delta_f / gsigma
-                chisq[i] += abs(gsnr)**2.0
-                dof += 2
-            if dof == 0:
-                chisq[i] = 1
-            else:
-                chisq[i] /= dof
-            logging.info('Found chisq %s', chisq[i])
+        #Skip if newsnr too low
+        snr = abs(numpy.array(snrv, ndmin=1) * snr_norm)
+        nsnr = newsnr(snr, numpy.array(bchisq, ndmin=1) /
+                           numpy.array(bchisq_dof, ndmin=1))
+        above = numpy.flatnonzero(nsnr >= self.snr_threshold)
+        if len(above) == 0:
+            return chisq
+
+        tiles = self.template_tiles(template, psd, stilde, bins, values)
+        if tiles is None:
+            return chisq
+        if len(tiles) == 0:
+            # No sine-Gaussians, so the chisq is 1
+            return chisq
+
+        N = (len(template) - 1) * 2
+        dt = 1.0 / (N * template.delta_f)
+        times = float(template.epoch) + dt * numpy.array(indices)[above]
+
+        # The SNR of a tile at the time of a trigger is its inner product
+        # with the data, shifted so the time is centered on 0. The tiles are
+        # stacked into a matrix over their frequency range, so the SNRs of
+        # all tiles at a block of triggers are a single matrix product.
+        kstart = min(t[0] for t in tiles)
+        kend = max(t[1] for t in tiles)
+        k = numpy.arange(kstart, kend)
+        matrix = numpy.zeros((len(tiles), kend - kstart),
+                             dtype=numpy.complex128)
+        data = stilde.numpy()
+        for i, (kmin, kmax, tile) in enumerate(tiles):
+            matrix[i, kmin - kstart:kmax - kstart] = tile * data[kmin:kmax]
+        matrix *= 4.0 * template.delta_f
+
+        # The time shift only depends on the fractional number of cycles
+        # of the frequency step, which is kept accurate for large times
+        cycles = numpy.mod(times * template.delta_f, 1.0)
+        step = max(1, 2**20 // len(k))
+        for start in range(0, len(above), step):
+            shift = numpy.exp(2.0j * numpy.pi *
+                              numpy.outer(cycles[start:start + step], k))
+            gsnr = shift.dot(matrix.T)
+            chisq[above[start:start + step]] = \
+                (abs(gsnr) ** 2.0).sum(axis=1) / (2 * len(tiles))
+        logging.info('Found sine-Gaussian chisq for %s triggers', len(above))
         return chisq
 
+    def template_tiles(self, template, psd, stilde, bins, values):
+        """ Return the sine-Gaussian tiles of a template, or None if any
+        tile reaches too close to the Nyquist frequency of the data
+
+        Parameters
+        ----------
+        template: pycbc.types.Frequencyseries
+            The waveform template being analyzed
+        psd: pycbc.types.Frequencyseries
+            The power spectral density of the data
+        stilde: pycbc.types.Frequencyseries
+            The overwhitened strain
+        bins: numpy.ndarray
+            The power chisq bins of the template
+        values: list of strs
+            The 'q-offset' descriptors of the tiles
+
+        Returns
+        -------
+        tiles: list of tuples
+            The first and end frequency index and normalized values of each
+            tile, see `sine_gaussian_tile`.
+        """
+        # Only apply the sine-Gaussian in a +-50 Hz range around the
+        # central frequency
+        qwindow = 50
+
+        # Estimate the maximum frequency up to which the waveform has
+        # power by approximating power per frequency
+        # as constant over the last 2 chisq bins. We cannot use the final
+        # chisq bin edge as it does not have to be where the waveform
+        # terminates.
+        fstep = (bins[-2] - bins[-3])
+        fpeak = (bins[-2] + fstep) * template.delta_f
+
+        # This is 90% of the Nyquist frequency of the data
+        # This allows us to avoid issues near Nyquist due to resample
+        # Filtering
+        fstop = len(stilde) * stilde.delta_f * 0.9
+
+        kmin = int(template.f_lower / psd.delta_f)
+        tiles = []
+        for descr in values:
+            # Get the q and frequency offset from the descriptor
+            q, offset = descr.split('-')
+            q, offset = float(q), float(offset)
+            fcen = fpeak + offset
+            flow = max(kmin * template.delta_f, fcen - qwindow)
+            fhigh = fcen + qwindow
+
+            # If any sine-gaussian tile has an upper frequency near
+            # nyquist return 1 instead.
+            if fhigh > fstop:
+                return None
+
+            key = (SigmasqCache.psd_key(psd), template.delta_f, q, fcen,
+                   flow, fhigh)
+            if key not in self._tiles:
+                self._tiles[key] = sine_gaussian_tile(q, fcen, flow, fhigh,
+                                                      template.delta_f, psd)
+                if len(self._tiles) > self.tile_cache_size:
+                    self._tiles.popitem(last=False)
+            tiles.append(self._tiles[key])
+            kmin = tiles[-1][0]
+        return tiles
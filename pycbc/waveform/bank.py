@@ -27,11 +27,15 @@ This module provides classes that describe banks of waveforms
 """
 import types
 import logging
-import os.path
+import os.path, glob
+import hashlib
+import threading, time
 import h5py
 from copy import copy
 import numpy as np
+from six.moves import queue
 from glue.ligolw import ligolw, table, lsctables, utils as ligolw_utils
+import pycbc.scheme
 import pycbc.waveform
 import pycbc.pnutils
 import pycbc.waveform.compress
@@ -48,6 +52,17 @@ def sigma_cached(self, psd):
 
     if key not in self._sigmasq or id(self) not in psd._sigma_cached_key:
         psd._sigma_cached_key[id(self)] = True
+
+        # Check for a value stored by this or an earlier job
+        cache = getattr(self, 'sigmasq_cache', None)
+        if cache is not None:
+            cached = cache.get(psd, self.params.template_hash,
+                               self.approximant, self.f_lower,
+                               self.sigmasq_options)
+            if cached is not None:
+                self._sigmasq[key] = cached
+                return cached
+
         # If possible, we precalculate the sigmasq vector for all possible waveforms
         if pycbc.waveform.waveform_norm_exists(self.approximant):
             if not hasattr(psd, 'sigmasq_vec'):
@@ -82,8 +97,201 @@ def sigma_cached(self, psd):
                 psd.invsqrt = 1.0 / psd[self.sslice]
 
             self._sigmasq[key] = self.sigma_view.inner(psd.invsqrt)
+
+        if cache is not None:
+            cache.set(psd, self.params.template_hash, self.approximant,
+                      self.f_lower, self.sigmasq_options, self._sigmasq[key])
     return self._sigmasq[key]
 
+def sigmasq_options_hash(end_idx, min_f_lower, options):
+    """ Return a hash of the generation options of a template which change
+    its sigmasq, other than its parameters, approximant and lower frequency
+    cutoff.
+
+    Parameters
+    ----------
+    end_idx : int
+        The frequency bin the template ends at.
+    min_f_lower : {None, float}
+        The lowest frequency cutoff of the bank.
+    options : dict
+        The other options the template is generated with, such as the
+        taper or phase order.
+
+    Returns
+    -------
+    key : str
+        The hash of the options.
+    """
+    if min_f_lower is not None:
+        min_f_lower = float(min_f_lower)
+    key = repr((int(end_idx), min_f_lower, sorted(options.items())))
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def save_cache_files(directory, prefix, max_files, entries, read, write):
+    """ Write the entries of a cache kept in a directory, with a file for
+    each PSD, and remove the least recently used files if there are too
+    many.
+
+    The entries of a PSD are merged with those written to its file by other
+    jobs since it was read, and the file is replaced atomically. Caches
+    touch their files when they read them, so the files removed are those
+    least recently read or written.
+
+    Parameters
+    ----------
+    directory : str
+        The cache directory.
+    prefix : str
+        The start of the names of the cache's files, so that caches can
+        share a directory.
+    max_files : int
+        The maximum number of files of the cache to keep.
+    entries : dict
+        The entries to write, a dict for each PSD key.
+    read : function
+        Returns the entries in the file of a PSD key, or an empty dict.
+    write : function
+        Writes a sorted list of the items of the entries of a PSD key to an
+        open HDF file, called with the file, the key and the list.
+    """
+    for key in entries:
+        # Keep entries written by other jobs since this PSD was read
+        merged = read(key)
+        merged.update(entries[key])
+        fname = os.path.join(directory, '%s%s.hdf' % (prefix, key))
+        tmpname = '%s.%s.tmp' % (fname, os.getpid())
+        with h5py.File(tmpname, 'w') as f:
+            write(f, key, sorted(merged.items()))
+        os.rename(tmpname, fname)
+
+    files = glob.glob(os.path.join(directory, prefix + '*.hdf'))
+    if len(files) > max_files:
+        def mtime(fname):
+            try:
+                return os.path.getmtime(fname)
+            except OSError:
+                return 0
+        files.sort(key=mtime)
+        for fname in files[:len(files) - max_files]:
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+
+class SigmasqCache(object):
+    """ A cache of template normalizations (sigmasq) which can be kept on
+    disk and shared between jobs which use the same PSDs.
+
+    The values for each PSD are kept in a file of the cache directory, named
+    `sigmasq_` and a hash of the PSD content and frequency spacing. Within
+    it a value is identified by the template hash, approximant, lower
+    frequency cutoff and a hash of the other generation options (see
+    `sigmasq_options_hash`). When there are more than max_files of these
+    files in the directory, the least recently used ones are removed, see
+    `save_cache_files`. Files are replaced atomically, so jobs may share a
+    directory; if two jobs save values for the same PSD at the same time,
+    the values of one of them may be lost, which only costs their
+    recomputation later.
+
+    Parameters
+    ----------
+    directory : {None, str}
+        The cache directory, which is created if needed. If None, the
+        values are only held in memory.
+    max_files : {1000, int}
+        The maximum number of PSD files to keep in the directory.
+    """
+    def __init__(self, directory=None, max_files=1000):
+        self.directory = directory
+        self.max_files = max_files
+        self.values = {}
+        self.modified = set()
+        if directory is not None and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another job may have just created it
+                if not os.path.isdir(directory):
+                    raise
+
+    @staticmethod
+    def psd_key(psd):
+        """ Return the hash identifying the given PSD """
+        if not hasattr(psd, '_sigmasq_cache_key'):
+            key = hashlib.sha1(psd.numpy().tobytes())
+            key.update(repr(float(psd.delta_f)).encode())
+            psd._sigmasq_cache_key = key.hexdigest()
+        return psd._sigmasq_cache_key
+
+    def _filename(self, key):
+        return os.path.join(self.directory, 'sigmasq_%s.hdf' % key)
+
+    def _read(self, key):
+        values = {}
+        if self.directory is None:
+            return values
+
+        fname = self._filename(key)
+        try:
+            with h5py.File(fname, 'r') as f:
+                for h, a, fl, o, s in zip(f['template_hash'][:],
+                                          f['approximant'][:],
+                                          f['f_lower'][:], f['options'][:],
+                                          f['sigmasq'][:]):
+                    values[(int(h), a.decode(), float(fl),
+                            o.decode())] = float(s)
+            # Mark the file as recently used
+            os.utime(fname, None)
+        except (IOError, OSError, KeyError):
+            pass
+        return values
+
+    def _values(self, psd):
+        key = self.psd_key(psd)
+        if key not in self.values:
+            self.values[key] = self._read(key)
+        return key, self.values[key]
+
+    def get(self, psd, template_hash, approximant, f_lower, options):
+        """ Return the cached sigmasq of a template, or None if it is not
+        in the cache
+        """
+        _, values = self._values(psd)
+        return values.get((int(template_hash), approximant, float(f_lower),
+                           options))
+
+    def set(self, psd, template_hash, approximant, f_lower, options,
+            sigmasq):
+        """ Add the sigmasq of a template to the cache """
+        key, values = self._values(psd)
+        values[(int(template_hash), approximant, float(f_lower),
+                options)] = float(sigmasq)
+        self.modified.add(key)
+
+    def save(self):
+        """ Write the values added since the last save to the cache directory
+        and remove the least recently used files if there are too many
+        """
+        if self.directory is None:
+            self.modified.clear()
+            return
+
+        def write(f, key, entries):
+            f['template_hash'] = np.array([e[0][0] for e in entries],
+                                          dtype=np.int64)
+            f['approximant'] = np.array([e[0][1] for e in entries],
+                                        dtype='S')
+            f['f_lower'] = np.array([e[0][2] for e in entries])
+            f['options'] = np.array([e[0][3] for e in entries], dtype='S')
+            f['sigmasq'] = np.array([e[1] for e in entries])
+
+        save_cache_files(self.directory, 'sigmasq_', self.max_files,
+                         dict((key, self.values[key])
+                              for key in self.modified),
+                         self._read, write)
+        self.modified.clear()
+
 # dummy class needed for loading LIGOLW files
 class LIGOLWContentHandler(ligolw.LIGOLWContentHandler):
     pass
@@ -594,6 +802,7 @@ class FilterBank(TemplateBank):
                  enable_compressed_waveforms=True,
                  low_frequency_cutoff=None,
                  waveform_decompression_method=None,
+                 sigmasq_cache=None,
                  **kwds):
         self.out = out
         self.dtype = dtype
@@ -606,6 +815,7 @@ class FilterBank(TemplateBank):
         self.max_template_length = max_template_length
         self.enable_compressed_waveforms = enable_compressed_waveforms
         self.waveform_decompression_method = waveform_decompression_method
+        self.sigmasq_cache = sigmasq_cache
 
         super(FilterBank, self).__init__(filename, approximant=approximant,
             parameters=parameters, **kwds)
@@ -688,27 +898,178 @@ class FilterBank(TemplateBank):
         return htilde
 
     def __getitem__(self, index):
+        return self.generate_template(index, out=self.out)
+
+    def generation_options(self):
+        """Return the options, other than the template parameters, which
+        change the templates generated by this bank.
+        """
+        options = dict(self.extra_args)
+        if self.has_compressed_waveforms and self.enable_compressed_waveforms:
+            options['waveform_decompression_method'] = \
+                self.waveform_decompression_method
+        return options
+
+    def time_domain_approximants(self, indices=None):
+        """Return the approximants of templates which are generated in the
+        time domain, and so transformed with an FFT when generated.
+
+        Parameters
+        ----------
+        indices : {None, array of ints}
+            The bank indices of the templates. If None, all of the templates.
+
+        Returns
+        -------
+        approximants : list of strs
+            The time domain approximants, empty if the templates are
+            generated in the frequency domain or read from compressed
+            waveforms.
+        """
+        if self.has_compressed_waveforms and self.enable_compressed_waveforms:
+            return []
+        if indices is None:
+            indices = np.arange(len(self))
+        state = pycbc.scheme.mgr.state
+        frequency_domain = set(pycbc.waveform.filter_approximants(state)) | \
+                           set(pycbc.waveform.fd_approximants(state))
+        return sorted(set(self.approximant(np.array(indices, dtype=int))) -
+                      frequency_domain)
+
+    def start_frequency(self, index, approximant=None):
+        """Return the frequency the template with the given index starts at.
+
+        This is the bank's low frequency cutoff, or the template's own
+        `f_lower` if the bank has none, raised if needed so the template
+        is no longer than `max_template_length`.
+        """
+        if approximant is None:
+            approximant = self.approximant(index)
+        if self.f_lower is None:
+            return self.table[index].f_lower
+        elif self.max_template_length is not None:
+            return find_variable_start_frequency(approximant,
+                                                 self.table[index],
+                                                 self.f_lower,
+                                                 self.max_template_length)
+        else:
+            return self.f_lower
+
+    def template_durations(self, indices=None):
+        """Return the duration of templates without generating them.
+
+        The `template_duration` column of the bank is used where it is set,
+        otherwise the duration is estimated from the start frequency of the
+        template. Templates whose approximant has no estimate of its length
+        are given an infinite duration.
+
+        Parameters
+        ----------
+        indices : {None, array of ints}
+            The bank indices of the templates. If None, all of the templates.
+
+        Returns
+        -------
+        durations : numpy.ndarray
+            The duration of each template in seconds.
+        """
+        if indices is None:
+            indices = np.arange(len(self))
+        durations = np.zeros(len(indices))
+        for i, index in enumerate(indices):
+            duration = self.table['template_duration'][index]
+            if not duration:
+                approximant = self.approximant(index)
+                duration = pycbc.waveform.get_waveform_filter_length_in_time(
+                               approximant, self.table[index],
+                               f_lower=self.start_frequency(index, approximant))
+            durations[i] = np.inf if duration is None else duration
+        return durations
+
+    def duration_groups(self, max_durations, indices=None):
+        """Assign templates to groups by their duration.
+
+        Each template is placed in the first group whose maximum duration it
+        does not exceed. Templates longer than all of them are placed in a
+        final group, numbered `len(max_durations)`.
+
+        Parameters
+        ----------
+        max_durations : list of floats
+            The longest template, in seconds, of each group, in increasing
+            order.
+        indices : {None, array of ints}
+            The bank indices of the templates. If None, all of the templates.
+
+        Returns
+        -------
+        groups : numpy.ndarray
+            The group number of each template.
+        """
+        max_durations = np.array(max_durations, dtype=float)
+        if (np.diff(max_durations) < 0).any():
+            raise ValueError("The maximum durations must be increasing")
+        return np.searchsorted(max_durations, self.template_durations(indices))
+
+    def with_filter_length(self, filter_length, delta_f, out=None):
+        """Return a view of the bank which generates its templates with a
+        different length and frequency step.
+
+        The view shares the template table, and the sigmasq cache, with
+        this bank, so templates of one bank can be filtered against data
+        segments of several lengths.
+
+        Parameters
+        ----------
+        filter_length : int
+            The length of the frequency domain templates.
+        delta_f : float
+            The frequency step of the templates.
+        out : {None, Array}
+            Memory for the view's `__getitem__` to write templates into.
+
+        Returns
+        -------
+        bank : FilterBank
+            The bank with the new filter length.
+        """
+        bank = copy(self)
+        bank.out = out
+        bank.delta_f = delta_f
+        bank.filter_length = filter_length
+        bank.N = (filter_length - 1) * 2
+        bank.delta_t = 1.0 / (bank.N * delta_f)
+        return bank
+
+    def generate_template(self, index, out=None):
+        """Generate the filter for the template with the given index.
+
+        Parameters
+        ----------
+        index : int
+            The index of the template in the bank.
+        out : {None, Array}
+            Memory to write the template into. This must be at least
+            `filter_length` long. If None, new memory is allocated.
+
+        Returns
+        -------
+        htilde : FrequencySeries
+            The frequency domain template, with the metadata needed by the
+            matched filter and signal consistency tests attached.
+        """
         # Make new memory for templates if we aren't given output memory
-        if self.out is None:
+        if out is None:
             tempout = zeros(self.filter_length, dtype=self.dtype)
         else:
-            tempout = self.out
+            tempout = out
 
         approximant = self.approximant(index)
         f_end = self.end_frequency(index)
         if f_end is None or f_end >= (self.filter_length * self.delta_f):
             f_end = (self.filter_length-1) * self.delta_f
 
-        # Find the start frequency, if variable
-        if self.f_lower is None:
-            f_low = self.table[index].f_lower
-        elif self.max_template_length is not None:
-            f_low = find_variable_start_frequency(approximant,
-                                                  self.table[index],
-                                                  self.f_lower,
-                                                  self.max_template_length)
-        else:
-            f_low = self.f_lower
+        f_low = self.start_frequency(index, approximant)
         logging.info('%s: generating %s from %s Hz' % (index, approximant, f_low))
 
         # Clear the storage memory
@@ -751,8 +1112,232 @@ class FilterBank(TemplateBank):
         # Add sigmasq as a method of this instance
         htilde.sigmasq = types.MethodType(sigma_cached, htilde)
         htilde._sigmasq = {}
+        htilde.sigmasq_cache = self.sigmasq_cache
+        if self.sigmasq_cache is not None:
+            htilde.sigmasq_options = sigmasq_options_hash(htilde.end_idx,
+                                        self.min_f_lower,
+                                        self.generation_options())
         return htilde
 
+    def _template_params(self, indices, approximant):
+        """ Return the parameters of many templates as arrays, with the
+        bank's extra generation arguments
+        """
+        params = dict((name, self.table[name][indices])
+                      for name in self.table.fieldnames)
+        params.update(self.extra_args)
+        params['approximant'] = approximant
+        return params
+
+    def template_sigmasq(self, psd, indices=None):
+        """Return the sigmasq of many templates against one PSD.
+
+        For approximants with an analytic normalization (see
+        `pycbc.waveform.waveform_norm_exists`) the cumulative sigmasq series
+        of the PSD is computed once, and the sigmasq of each template is its
+        difference between the start and end frequencies of the template.
+        Templates of other approximants are generated one at a time. Values
+        found in the bank's sigmasq cache are not recomputed, and new values
+        are added to it.
+
+        Parameters
+        ----------
+        psd : FrequencySeries
+            The PSD, of length `filter_length`.
+        indices : {None, array of ints}
+            The bank indices of the templates. If None, all of the templates.
+
+        Returns
+        -------
+        sigmasq : numpy.ndarray
+            The sigmasq of each template.
+        """
+        if indices is None:
+            indices = np.arange(len(self))
+        indices = np.array(indices, dtype=int)
+        sigmasq = np.zeros(len(indices))
+        approximants = np.array([self.approximant(i) for i in indices])
+
+        if self.f_lower is None:
+            f_lower = self.table['f_lower'][indices]
+        elif self.max_template_length is not None:
+            f_lower = np.array([find_variable_start_frequency(
+                                    approximants[i], self.table[index],
+                                    self.f_lower, self.max_template_length)
+                                for i, index in enumerate(indices)])
+        else:
+            f_lower = np.zeros(len(indices)) + self.f_lower
+
+        # The same end frequency as used by generate_template
+        f_max = (self.filter_length - 1) * self.delta_f
+        kend = np.zeros(len(indices), dtype=int)
+        for approximant in np.unique(approximants):
+            sel = np.where(approximants == approximant)[0]
+            if pycbc.waveform.waveform_norm_exists(approximant):
+                f_end = pycbc.waveform.get_waveform_end_frequency(
+                            **self._template_params(indices[sel], approximant))
+                f_end = f_max if f_end is None else np.minimum(f_end, f_max)
+            elif self.sigmasq_cache is not None:
+                # Only needed to look up the cached values
+                f_end = [self.end_frequency(indices[i]) for i in sel]
+                f_end = np.array([f_max if f is None else min(f, f_max)
+                                  for f in f_end])
+            else:
+                continue
+            kend[sel] = (np.zeros(len(sel)) + f_end) / self.delta_f
+
+        missing = np.ones(len(indices), dtype=bool)
+        if self.sigmasq_cache is not None:
+            generation_options = self.generation_options()
+            options = [sigmasq_options_hash(k, self.min_f_lower,
+                                            generation_options)
+                       for k in kend]
+            for i, index in enumerate(indices):
+                cached = self.sigmasq_cache.get(psd,
+                                        self.table['template_hash'][index],
+                                        approximants[i], f_lower[i],
+                                        options[i])
+                if cached is not None:
+                    sigmasq[i] = cached
+                    missing[i] = False
+
+        for approximant in np.unique(approximants[missing]):
+            sel = np.where(missing & (approximants == approximant))[0]
+            if not pycbc.waveform.waveform_norm_exists(approximant):
+                tempout = zeros(self.filter_length, dtype=self.dtype)
+                for i in sel:
+                    htilde = self.generate_template(indices[i], out=tempout)
+                    sigmasq[i] = htilde.sigmasq(psd)
+                continue
+
+            params = self._template_params(indices[sel], approximant)
+            amp_norm = pycbc.waveform.get_template_amplitude_norm(**params)
+            amp_norm = 1 if amp_norm is None else amp_norm
+            scale = (DYN_RANGE_FAC * amp_norm) ** 2.0
+
+            # The cumulative series from the lowest start frequency
+            kmin = (f_lower[sel] / psd.delta_f).astype(int)
+            norm = pycbc.waveform.get_waveform_filter_norm(approximant, psd,
+                                len(psd), psd.delta_f, f_lower[sel].min())
+            start = np.where(kmin > kmin.min(), norm[kmin - 1], 0)
+            sigmasq[sel] = scale * np.maximum(norm[kend[sel] - 1] - start, 0)
+
+            if self.sigmasq_cache is not None:
+                for i in sel:
+                    self.sigmasq_cache.set(psd,
+                                           self.table['template_hash'][indices[i]],
+                                           approximant, f_lower[i],
+                                           options[i], sigmasq[i])
+        return sigmasq
+
+class FilterBankPrefetcher(object):
+    """ Iterate over templates of a FilterBank, generating them ahead of use.
+
+    A background thread generates the templates into a ring of preallocated
+    buffers, so that the next templates are ready while the current one is
+    filtered. A buffer is reused once the iteration has moved past the
+    template in it, so each template must only be used until the next one
+    is requested. The background thread is stopped by `close`, which is
+    also called on leaving the prefetcher when used as a context manager.
+
+    Only templates generated in the frequency domain, or read from
+    compressed waveforms, can be prefetched. Time domain approximants are
+    transformed with an FFT, and planning it in the background thread is
+    not safe while the filtering plans its own transforms.
+
+    Parameters
+    ----------
+    bank : FilterBank
+        The bank to generate templates from.
+    indices : list of ints
+        The bank indices of the templates, in the order they will be used.
+    num_buffers : {2, int}
+        The number of template buffers. Up to num_buffers - 1 templates are
+        generated ahead of the one in use.
+
+    Attributes
+    ----------
+    generation_time : float
+        The time in seconds spent generating templates.
+    wait_time : float
+        The time in seconds spent waiting for a template to be generated.
+    """
+    def __init__(self, bank, indices, num_buffers=2):
+        if num_buffers < 2:
+            raise ValueError("At least two template buffers are needed")
+        self.bank = bank
+        self.indices = list(indices)
+        time_domain = bank.time_domain_approximants(self.indices)
+        if time_domain:
+            raise ValueError("Templates of the time domain approximants %s "
+                             "can not be prefetched"
+                             % ', '.join(time_domain))
+        self.generation_time = 0
+        self.wait_time = 0
+        self.num_returned = 0
+        self.current = None
+        self.stopped = False
+
+        self.free = queue.Queue()
+        for i in range(num_buffers):
+            self.free.put(zeros(bank.filter_length, dtype=bank.dtype))
+        self.ready = queue.Queue()
+
+        self.thread = threading.Thread(target=self._generate)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _generate(self):
+        for index in self.indices:
+            out = self.free.get()
+            if out is None or self.stopped:
+                return
+            start = time.time()
+            try:
+                htilde = self.bank.generate_template(index, out=out)
+            except Exception as err: # pylint:disable=broad-except
+                self.ready.put((index, err, out))
+                return
+            self.generation_time += time.time() - start
+            self.ready.put((index, htilde, out))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """ Return the next bank index and template """
+        if self.current is not None:
+            self.free.put(self.current)
+            self.current = None
+
+        if self.num_returned == len(self.indices):
+            raise StopIteration
+
+        start = time.time()
+        index, htilde, self.current = self.ready.get()
+        self.wait_time += time.time() - start
+        if isinstance(htilde, Exception):
+            raise htilde
+
+        self.num_returned += 1
+        return index, htilde
+
+    __next__ = next
+
+    def close(self):
+        """ Stop generating templates and wait for the background thread to
+        finish
+        """
+        self.stopped = True
+        self.free.put(None)
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
 def find_variable_start_frequency(approximant, parameters, f_start, max_length,
                                   delta_f = 1):
     """ Find a frequency value above the starting frequency that results in a
@@ -190,6 +190,32 @@ class TestAutochisquare(unittest.TestCase):
 	#   self.assertTrue(achi_list[i,2] > 2.e3)
 
 
+    def test_gather(self):
+        n = 4096
+        sn = np.random.normal(size=n) + np.random.normal(size=n) * 1.0j
+        corr = np.random.normal(size=n) + np.random.normal(size=n) * 1.0j
+        hauto = (np.random.normal(size=n) + np.random.normal(size=n) * 1.0j) * 0.1
+        indx = np.array([0, 5, 2000, n - 3, n - 1])
+        lags, num_points = autochisq_lags(n, stride=3, num_points=40)
+        self.assertEqual(num_points, 40)
+        self.assertEqual(len(lags), 80)
+
+        achisq = autochisq_at_lags(sn, corr, hauto[lags], lags, indx)
+        blocked = autochisq_at_lags(sn, corr, hauto[lags], lags, indx,
+                                    block_size=100)
+        self.assertTrue((achisq == blocked).all())
+
+        # Compare against a direct evaluation at each trigger
+        for i, ind in enumerate(indx):
+            phase = sn[ind] / abs(sn[ind])
+            points = (ind + lags) % n
+            z = corr[points] * phase.conjugate()
+            norm = 1.0 - abs(hauto[lags]) ** 2
+            expected = ((z.real - hauto[lags].real * abs(sn[ind])) ** 2 +
+                        (z.imag - hauto[lags].imag * abs(sn[ind])) ** 2)
+            self.assertAlmostEqual(achisq[i] / (expected / norm).sum(), 1,
+                                   places=10)
+
 
 suite = unittest.TestSuite()
 suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestAutochisquare))
@@ -0,0 +1,243 @@
+"""
+These are the unittests for the FilterBank of pycbc.waveform.bank
+"""
+import unittest
+import os, tempfile, shutil
+import numpy
+from pycbc.types import FrequencySeries, zeros, complex64
+from pycbc.psd import from_string
+from pycbc.waveform import FilterBank, FilterBankPrefetcher, SigmasqCache
+from utils import parse_args_cpu_only, simple_exit, write_random_bank
+
+parse_args_cpu_only("FilterBank")
+
+class TestFilterBank(unittest.TestCase):
+    def setUp(self, *args):
+        self.dir = tempfile.mkdtemp()
+        numpy.random.seed(0)
+        self.fname = write_random_bank(os.path.join(self.dir, 'bank.hdf'),
+                                       12)
+        self.delta_f = 1.0 / 256
+        self.flen = 2048 * 256 + 1
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def make_bank(self, **kwds):
+        return FilterBank(self.fname, self.flen, self.delta_f, complex64,
+                          approximant='SPAtmplt', low_frequency_cutoff=30.0,
+                          **kwds)
+
+    def test_prefetch(self):
+        bank = self.make_bank()
+        indices = [5, 0, 3, 11, 7, 1, 2]
+        direct = [bank.generate_template(i) for i in indices]
+        with FilterBankPrefetcher(bank, indices, num_buffers=3) as prefetch:
+            found = []
+            for index, htilde in prefetch:
+                found.append(index)
+                expected = direct[len(found) - 1]
+                self.assertTrue(numpy.array_equal(htilde.numpy(),
+                                                  expected.numpy()))
+                self.assertEqual(htilde.params.template_hash,
+                                 expected.params.template_hash)
+                self.assertEqual(htilde.chirp_length, expected.chirp_length)
+        self.assertEqual(found, indices)
+        self.assertFalse(prefetch.thread.is_alive())
+
+    def test_template_sigmasq(self):
+        psd = from_string("aLIGOZeroDetHighPower", self.flen, self.delta_f, 20)
+        cache = SigmasqCache()
+        bank = self.make_bank(sigmasq_cache=cache)
+        sigmasq = bank.template_sigmasq(psd)
+
+        # The values match the normalization of each template, and are
+        # found in the cache when the templates are generated
+        direct = self.make_bank()
+        for i in range(len(bank)):
+            expected = direct.generate_template(i).sigmasq(psd)
+            self.assertAlmostEqual(sigmasq[i] / expected, 1, places=5)
+            htilde = bank.generate_template(i)
+            key = (bank.table['template_hash'][i], 'SPAtmplt', 30.0,
+                   htilde.sigmasq_options)
+            self.assertEqual(cache.get(psd, *key), sigmasq[i])
+            self.assertEqual(htilde.sigmasq(psd), sigmasq[i])
+
+        # The values are only used for templates generated with the same
+        # options
+        key = (bank.table['template_hash'][0], 'SPAtmplt', 30.0,
+               bank.generate_template(0).sigmasq_options)
+        cache.set(psd, *(key + (-1.0,)))
+        self.assertEqual(bank.template_sigmasq(psd, [0])[0], -1.0)
+        other = self.make_bank(sigmasq_cache=cache, phase_order=4)
+        self.assertNotEqual(other.generate_template(0).sigmasq_options,
+                            key[3])
+        self.assertAlmostEqual(other.template_sigmasq(psd, [0])[0] /
+                               sigmasq[0], 1, places=5)
+        short = bank.with_filter_length(2048 * 2 + 1, 1.0)
+        self.assertNotEqual(short.generate_template(0).sigmasq_options,
+                            key[3])
+
+    def test_prefetch_time_domain(self):
+        # Time domain templates are transformed with an FFT, which can not
+        # be planned in the background thread
+        self.assertEqual(self.make_bank().time_domain_approximants(), [])
+        bank = FilterBank(self.fname, self.flen, self.delta_f, complex64,
+                          approximant='TaylorT4', low_frequency_cutoff=30.0)
+        self.assertEqual(bank.time_domain_approximants([0, 1]), ['TaylorT4'])
+        self.assertRaises(ValueError, FilterBankPrefetcher, bank, [0, 1])
+
+    def test_prefetch_close(self):
+        # Closing part way through stops the background thread
+        bank = self.make_bank()
+        prefetch = FilterBankPrefetcher(bank, range(len(bank)))
+        next(prefetch)
+        prefetch.close()
+        self.assertFalse(prefetch.thread.is_alive())
+
+    def test_template_durations(self):
+        bank = self.make_bank()
+        durations = bank.template_durations()
+        self.assertEqual(len(durations), len(bank))
+
+        # The estimates match the length of the generated templates
+        direct = self.make_bank()
+        for i in range(len(bank)):
+            expected = direct.generate_template(i).chirp_length
+            self.assertAlmostEqual(durations[i] / expected, 1, places=5)
+
+        # The template_duration column is used where it is set
+        bank.table['template_duration'][3] = 1000.0
+        self.assertEqual(list(bank.template_durations([3, 0])),
+                         [1000.0, durations[0]])
+
+    def test_duration_groups(self):
+        bank = self.make_bank()
+        durations = bank.template_durations()
+        max_durations = [numpy.percentile(durations, 25),
+                         numpy.percentile(durations, 60)]
+        expected = []
+        for d in durations:
+            group = len(max_durations)
+            for g, m in enumerate(max_durations):
+                if d <= m:
+                    group = g
+                    break
+            expected.append(group)
+        groups = bank.duration_groups(max_durations)
+        self.assertEqual(list(groups), expected)
+        self.assertEqual(set(groups), set([0, 1, 2]))
+
+        indices = [7, 2, 5]
+        self.assertEqual(list(bank.duration_groups(max_durations, indices)),
+                         [expected[i] for i in indices])
+        self.assertEqual(list(bank.duration_groups([])), [0] * len(bank))
+        self.assertRaises(ValueError, bank.duration_groups, [10.0, 5.0])
+
+    def test_with_filter_length(self):
+        bank = self.make_bank()
+        flen = 2048 * 128 + 1
+        delta_f = 1.0 / 128
+        out = zeros(flen, dtype=complex64)
+        short = bank.with_filter_length(flen, delta_f, out=out)
+
+        # The view generates the templates of a bank made with that length
+        direct = FilterBank(self.fname, flen, delta_f, complex64,
+                            approximant='SPAtmplt', low_frequency_cutoff=30.0)
+        for i in [0, 4, 9]:
+            htilde = short[i]
+            expected = direct.generate_template(i)
+            self.assertEqual(len(htilde), flen)
+            self.assertEqual(htilde.delta_f, delta_f)
+            self.assertTrue(numpy.array_equal(htilde.numpy(),
+                                              expected.numpy()))
+            self.assertTrue(numpy.array_equal(out.numpy()[0:flen],
+                                              expected.numpy()))
+        self.assertAlmostEqual(short.delta_t, bank.delta_t)
+
+        # The original bank is unchanged and shares the template table
+        self.assertEqual(bank.filter_length, self.flen)
+        self.assertEqual(bank.delta_f, self.delta_f)
+        self.assertEqual(len(bank.generate_template(0)), self.flen)
+        self.assertTrue(short.table is bank.table)
+
+class TestSigmasqCache(unittest.TestCase):
+    def setUp(self, *args):
+        self.dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.dir, 'cache')
+        numpy.random.seed(0)
+        self.psds = [FrequencySeries(numpy.random.uniform(1, 2, size=1025),
+                                     delta_f=0.25) for i in range(3)]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_get_set(self):
+        cache = SigmasqCache(self.cache_dir)
+        psd = self.psds[0]
+        self.assertEqual(cache.get(psd, 12345, 'SPAtmplt', 20.0, 'a'), None)
+        cache.set(psd, 12345, 'SPAtmplt', 20.0, 'a', 3.5)
+        self.assertEqual(cache.get(psd, 12345, 'SPAtmplt', 20.0, 'a'), 3.5)
+        # Any difference in the key is a miss
+        self.assertEqual(cache.get(psd, 12346, 'SPAtmplt', 20.0, 'a'), None)
+        self.assertEqual(cache.get(psd, 12345, 'TaylorF2', 20.0, 'a'), None)
+        self.assertEqual(cache.get(psd, 12345, 'SPAtmplt', 25.0, 'a'), None)
+        self.assertEqual(cache.get(psd, 12345, 'SPAtmplt', 20.0, 'b'), None)
+        self.assertEqual(cache.get(self.psds[1], 12345, 'SPAtmplt', 20.0,
+                                   'a'), None)
+        # A PSD with the same content has the same key
+        same = FrequencySeries(psd.numpy().copy(), delta_f=0.25)
+        self.assertEqual(cache.get(same, 12345, 'SPAtmplt', 20.0, 'a'), 3.5)
+        other_df = FrequencySeries(psd.numpy().copy(), delta_f=0.5)
+        self.assertEqual(cache.get(other_df, 12345, 'SPAtmplt', 20.0, 'a'),
+                         None)
+
+    def test_save(self):
+        cache = SigmasqCache(self.cache_dir)
+        cache.set(self.psds[0], 1, 'SPAtmplt', 20.0, 'a', 2.0)
+        cache.save()
+
+        # Values saved by another job are kept
+        other = SigmasqCache(self.cache_dir)
+        other.set(self.psds[0], 2, 'SPAtmplt', 20.0, 'a', 4.0)
+        other.save()
+
+        new = SigmasqCache(self.cache_dir)
+        self.assertEqual(new.get(self.psds[0], 1, 'SPAtmplt', 20.0, 'a'), 2.0)
+        self.assertEqual(new.get(self.psds[0], 2, 'SPAtmplt', 20.0, 'a'), 4.0)
+
+    def test_eviction(self):
+        cache = SigmasqCache(self.cache_dir, max_files=2)
+        # The files of other caches sharing the directory are kept
+        other = os.path.join(self.cache_dir, 'chisq_bins_0.hdf')
+        open(other, 'w').close()
+        fnames = [os.path.join(self.cache_dir, 'sigmasq_%s.hdf' %
+                               SigmasqCache.psd_key(psd))
+                  for psd in self.psds]
+        for i, psd in enumerate(self.psds[0:2]):
+            cache.set(psd, 1, 'SPAtmplt', 20.0, 'a', float(i))
+            cache.save()
+            # Give the files distinct modification times
+            os.utime(fnames[i], (1000000 + i, 1000000 + i))
+
+        # Reading a file marks it as recently used
+        SigmasqCache(self.cache_dir).get(self.psds[0], 1, 'SPAtmplt', 20.0,
+                                         'a')
+        cache.set(self.psds[2], 1, 'SPAtmplt', 20.0, 'a', 2.0)
+        cache.save()
+
+        self.assertEqual(sorted(os.listdir(self.cache_dir)),
+                         sorted([os.path.basename(f) for f in
+                                 [other, fnames[0], fnames[2]]]))
+        new = SigmasqCache(self.cache_dir)
+        self.assertEqual(new.get(self.psds[0], 1, 'SPAtmplt', 20.0, 'a'), 0.0)
+        self.assertEqual(new.get(self.psds[1], 1, 'SPAtmplt', 20.0, 'a'), None)
+        self.assertEqual(new.get(self.psds[2], 1, 'SPAtmplt', 20.0, 'a'), 2.0)
+
+suite = unittest.TestSuite()
+suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestFilterBank))
+suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestSigmasqCache))
+
+if __name__ == '__main__':
+    results = unittest.TextTestRunner(verbosity=2).run(suite)
+    simple_exit(results)
@@ -0,0 +1,132 @@
+"""
+These are the unittests for the bank veto of pycbc.vetoes.bank_chisq
+"""
+import unittest
+import os, tempfile, shutil
+import numpy
+from pycbc.types import Array, complex64, float32
+from pycbc.psd import from_string
+from pycbc.waveform import FilterBank
+from pycbc.vetoes.bank_chisq import template_overlaps, bank_filter_matrix
+from pycbc.vetoes.bank_chisq import template_overlaps_from_matrix
+from pycbc.vetoes import bank_chisq_from_filters, bank_chisq_from_matrix
+from pycbc.vetoes import SingleDetBankVeto
+from utils import parse_args_cpu_only, simple_exit, write_random_bank
+
+parse_args_cpu_only("Bank Veto")
+
+class TestBankVeto(unittest.TestCase):
+    def setUp(self, *args):
+        self.dir = tempfile.mkdtemp()
+        numpy.random.seed(0)
+        self.veto_file = os.path.join(self.dir, 'veto_bank.hdf')
+        self.search_file = os.path.join(self.dir, 'bank.hdf')
+        for fname, num in [(self.veto_file, 5), (self.search_file, 8)]:
+            write_random_bank(fname, num, mass1=(1.2, 5), mass2=(1.2, 3),
+                              max_spin=0)
+        self.delta_f = 1.0 / 64
+        self.flen = 2048 * 64 + 1
+        self.f_low = 30.0
+        self.psd = from_string("aLIGOZeroDetHighPower", self.flen,
+                               self.delta_f, 20).astype(float32)
+        search = FilterBank(self.search_file, self.flen, self.delta_f,
+                            complex64, approximant='SPAtmplt',
+                            low_frequency_cutoff=self.f_low)
+        self.templates = [search.generate_template(i)
+                          for i in range(len(search))]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def make_veto(self, **kwds):
+        return SingleDetBankVeto(self.veto_file, self.flen, self.delta_f,
+                                 self.f_low, complex64,
+                                 approximant='SPAtmplt', **kwds)
+
+    def test_overlaps_from_matrix(self):
+        filters = self.make_veto().filters
+        matrix, kmin, kmax = bank_filter_matrix(filters, self.psd, self.f_low)
+        overlaps = template_overlaps_from_matrix(matrix, kmin, kmax,
+                                                 self.templates, self.psd)
+        self.assertEqual(overlaps.shape, (len(self.templates), len(filters)))
+        for template, row in zip(self.templates, overlaps):
+            expected = template_overlaps(filters, template, self.psd,
+                                         self.f_low)
+            self.assertTrue(numpy.allclose(row, expected, rtol=1e-4,
+                                           atol=1e-6))
+
+    def test_bank_chisq_matrix(self):
+        n = 2**12
+        bank_snrs = numpy.random.normal(size=(5, n)) + \
+                    numpy.random.normal(size=(5, n)) * 1.0j
+        bank_snrs = bank_snrs.astype(numpy.complex64)
+        bank_norms = numpy.random.uniform(0.5, 2, size=5)
+        # One bank template is too close to the search template to be used
+        matches = numpy.random.uniform(-0.5, 0.5, size=5) * (1 + 1.0j)
+        matches[3] = 0.995
+        indices = numpy.random.randint(0, n, size=100)
+        snrv = numpy.random.normal(size=100) + \
+               numpy.random.normal(size=100) * 1.0j
+        snrv = snrv.astype(numpy.complex64)
+
+        expected = bank_chisq_from_filters(snrv, 0.7,
+                                           [Array(b) for b in bank_snrs],
+                                           bank_norms, matches,
+                                           indices=indices)
+        chisq = bank_chisq_from_matrix(snrv, 0.7, bank_snrs[:, indices],
+                                       bank_norms, matches)
+        self.assertTrue(numpy.allclose(chisq.numpy(), expected.numpy(),
+                                       rtol=1e-4))
+
+    def test_cache_overlaps_block(self):
+        # Calculating the overlaps of a block of templates at once gives
+        # those of each template on its own
+        veto = self.make_veto()
+        block = veto.cache_overlaps_block(self.templates, self.psd)
+        single = self.make_veto()
+        for template, o in zip(self.templates, block):
+            expected = single.cache_overlaps(template, self.psd)
+            self.assertTrue(numpy.allclose(o, expected, rtol=1e-6,
+                                           atol=1e-8))
+            self.assertTrue(veto.cache_overlaps(template, self.psd) is o)
+
+    def test_save_overlaps(self):
+        fname = os.path.join(self.dir, 'overlaps.hdf')
+        veto = self.make_veto(overlap_file=fname)
+        first = veto.cache_overlaps_block(self.templates[0:5], self.psd)
+        veto.save_overlaps()
+        self.assertFalse(veto.modified)
+
+        # Overlaps saved by another job are kept
+        other = self.make_veto(overlap_file=fname)
+        rest = other.cache_overlaps_block(self.templates[3:], self.psd)
+        other.save_overlaps()
+        expected = first + rest[2:]
+
+        new = self.make_veto(overlap_file=fname)
+        key = new.psd_key(self.psd)
+        self.assertEqual(len(new.overlaps[key]), len(self.templates))
+        for template, o in zip(self.templates, expected):
+            saved = new.overlaps[key][int(template.params.template_hash)]
+            self.assertTrue(numpy.array_equal(saved, o))
+
+        # The saved overlaps are used, and nothing new needs saving
+        found = new.cache_overlaps_block(self.templates, self.psd)
+        for o, e in zip(found, expected):
+            self.assertTrue(numpy.array_equal(o, e))
+        self.assertFalse(new.modified)
+
+        # The file can only be used with the same bank veto bank,
+        self.assertRaises(ValueError, SingleDetBankVeto, self.veto_file,
+                          self.flen, self.delta_f, 25.0, complex64,
+                          approximant='SPAtmplt', overlap_file=fname)
+        # and search templates generated with the same options
+        self.assertRaises(ValueError, self.make_veto, overlap_file=fname,
+                          template_options={'taper': 'start'})
+
+suite = unittest.TestSuite()
+suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestBankVeto))
+
+if __name__ == '__main__':
+    results = unittest.TextTestRunner(verbosity=2).run(suite)
+    simple_exit(results)
@@ -25,6 +25,7 @@
 These are the unittests for the pycbc.waveform module
 """
 import sys
+import os, tempfile, shutil
 import pycbc
 import unittest
 import numpy
@@ -34,8 +35,15 @@ from utils import parse_args_all_schemes, simple_exit
 
 _scheme, _context = parse_args_all_schemes("correlate")
 
-from pycbc.vetoes.chisq_cpu import chisq_accum_bin_numpy
+from pycbc.vetoes.chisq_cpu import chisq_accum_bin_numpy, shift_sum
 from pycbc.vetoes import chisq_accum_bin
+from pycbc.vetoes import power_chisq_at_points_from_precomputed
+from pycbc.vetoes import power_chisq_at_points_block
+from pycbc.vetoes import power_chisq_bins_from_sigmasq_series
+from pycbc.vetoes import power_chisq_bins_block
+from pycbc.vetoes import SingleDetPowerChisq, ChisqBinCache
+from pycbc.vetoes import power_chisq_bins
+from pycbc.waveform import SigmasqCache
 trusted_accum = chisq_accum_bin_numpy
 
 class TestChisq(unittest.TestCase):
@@ -57,8 +65,218 @@ class TestChisq(unittest.TestCase):
                 chisq_accum_bin(z, self.x)
             self.assertTrue(self.z.almost_equal_elem(z, self.tolerance))
 
+    def test_block_chisq(self):
+        # The batched kernel is only implemented for the cpu
+        if self.scheme != 'cpu':
+            return
+        n = 2**12
+        block = numpy.random.normal(size=(3, n)) + \
+                numpy.random.normal(size=(3, n)) * 1.0j
+        block = block.astype(numpy.complex64)
+        bins = [[10, 100, 700, 2000], [0], [5, 50, 60, 1500, 2049]]
+        norms = numpy.array([0.5, 1.0, 2.0])
+        rows = numpy.array([2, 0, 2, 0, 2, 2])
+        indices = numpy.array([0, 17, n - 1, 1000, 33, 2048])
+        snrv = numpy.random.normal(size=6) + numpy.random.normal(size=6) * 1.0j
+
+        with self.context:
+            chisq = power_chisq_at_points_block(block, rows, snrv, norms,
+                                                bins, indices)
+            for i, row in enumerate(rows):
+                expected = power_chisq_at_points_from_precomputed(
+                                Array(block[row]), snrv[i:i+1], norms[row],
+                                bins[row], indices[i:i+1])
+                self.assertAlmostEqual(chisq[i] / expected[0], 1, places=4)
+
+    def test_shift_sum(self):
+        if self.scheme != 'cpu':
+            return
+        n = 2**14
+        corr = numpy.random.normal(size=n) + numpy.random.normal(size=n) * 1.0j
+        shifts = numpy.random.randint(0, n, size=20)
+        bins = [3, 40, 41, 900, 4000, 8193]
+
+        expected = numpy.zeros(len(shifts))
+        for kstart, kend in zip(bins[:-1], bins[1:]):
+            k = numpy.arange(kstart, kend)
+            phase = numpy.exp(2.0j * numpy.pi * numpy.outer(shifts, k) / n)
+            expected += abs(numpy.dot(phase, corr[k])) ** 2
+
+        with self.context:
+            chisq = shift_sum(Array(corr, dtype=complex128), shifts, bins)
+            self.assertTrue(numpy.allclose(chisq, expected, rtol=1e-4))
+
+    def test_block_bins(self):
+        series = numpy.zeros(5000)
+        series[40:] = numpy.cumsum(numpy.random.uniform(size=4960))
+        kmin = numpy.random.randint(40, 300, size=50)
+        kmax = numpy.random.randint(1000, 5000, size=50)
+        num_bins = numpy.random.randint(2, 20, size=50)
+        bins = power_chisq_bins_block(series, num_bins, kmin, kmax)
+        for b, n, k0, k1 in zip(bins, num_bins, kmin, kmax):
+            expected = power_chisq_bins_from_sigmasq_series(series, n, k0, k1)
+            self.assertTrue((b == expected).all())
+
+    def test_use_fft(self):
+        chisq = SingleDetPowerChisq(num_bins='4')
+        corr = zeros(2**12, dtype=complex64)
+        snr = zeros(2**12, dtype=complex64)
+        bins = [0, 100, 200, 300, 2**11]
+        # Set the measured costs so the FFT method is the faster one
+        chisq.cost_model.costs[(len(corr), corr.dtype)] = (1.0, 1.0)
+        with self.context:
+            self.assertFalse(chisq.use_fft(corr, None, bins, 10))
+            self.assertFalse(chisq.use_fft(corr, snr[0:100], bins, 10))
+            # Only the cpu uses the costs, other schemes calculate the
+            # chisq directly
+            self.assertEqual(chisq.use_fft(corr, snr, bins, 10),
+                             self.scheme == 'cpu')
+
+class TestChisqBinCache(unittest.TestCase):
+    def setUp(self, *args):
+        self.dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.dir, 'cache')
+        numpy.random.seed(0)
+        self.delta_f = 0.25
+        f = numpy.arange(4097) * self.delta_f
+        self.psds = [FrequencySeries(((f + 10) / 100.0) ** -4 + 1 +
+                                     numpy.random.uniform(0, 0.1, size=4097),
+                                     delta_f=self.delta_f, dtype=float32)
+                     for i in range(3)]
+
+        # Templates with a range of start and end frequencies
+        f[0] = 1.0
+        hashes = numpy.random.randint(0, 2**30, size=10)
+        params = numpy.rec.fromarrays([hashes], names='template_hash')
+        self.templates = []
+        for i in range(10):
+            flow = numpy.random.uniform(20, 40)
+            fend = numpy.random.uniform(300, 1000)
+            data = f ** (-7.0 / 6) * numpy.exp(1.0j * f)
+            data[(f < flow) | (f >= fend)] = 0
+            t = FrequencySeries(data, delta_f=self.delta_f, dtype=complex64)
+            t.f_lower = flow
+            t.end_idx = int(fend / self.delta_f)
+            t.approximant = 'SPAtmplt' if i % 2 else 'TaylorF2'
+            t.params = params[i]
+            self.templates.append(t)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_get_set(self):
+        cache = ChisqBinCache(directory=self.cache_dir)
+        psd = self.psds[0]
+        self.assertEqual(cache.get(psd, 12345, 8, 80, 1600), None)
+        cache.set(psd, 12345, 8, 80, 1600, [80, 100, 200, 1600])
+        self.assertEqual(list(cache.get(psd, 12345, 8, 80, 1600)),
+                         [80, 100, 200, 1600])
+        # Any difference in the key is a miss
+        self.assertEqual(cache.get(psd, 12346, 8, 80, 1600), None)
+        self.assertEqual(cache.get(psd, 12345, 9, 80, 1600), None)
+        self.assertEqual(cache.get(psd, 12345, 8, 81, 1600), None)
+        self.assertEqual(cache.get(psd, 12345, 8, 80, 1601), None)
+        self.assertEqual(cache.get(self.psds[1], 12345, 8, 80, 1600), None)
+
+    def test_save(self):
+        cache = ChisqBinCache(directory=self.cache_dir)
+        cache.set(self.psds[0], 1, 4, 80, 1600, [80, 90, 100, 200, 1600])
+        cache.save()
+
+        # Bins saved by another job are kept
+        other = ChisqBinCache(directory=self.cache_dir)
+        other.set(self.psds[0], 2, 2, 80, 1600, [80, 150, 1600])
+        other.save()
+
+        new = ChisqBinCache(directory=self.cache_dir)
+        self.assertEqual(list(new.get(self.psds[0], 1, 4, 80, 1600)),
+                         [80, 90, 100, 200, 1600])
+        self.assertEqual(list(new.get(self.psds[0], 2, 2, 80, 1600)),
+                         [80, 150, 1600])
+
+    def test_tolerance(self):
+        psd = self.psds[0]
+        close = FrequencySeries(psd.numpy() * 1.0001, delta_f=self.delta_f)
+        far = FrequencySeries(psd.numpy() * 1.01, delta_f=self.delta_f)
+        other_df = FrequencySeries(psd.numpy() * 1.0001, delta_f=0.5)
+
+        exact = ChisqBinCache(directory=self.cache_dir)
+        exact.set(psd, 1, 2, 80, 1600, [80, 150, 1600])
+        exact.save()
+        self.assertEqual(exact.get(close, 1, 2, 80, 1600), None)
+
+        # A PSD within the tolerance shares the bins, also through the
+        # fingerprints saved in the cache directory
+        for cache in [ChisqBinCache(tolerance=1e-3),
+                      ChisqBinCache(tolerance=1e-3,
+                                    directory=self.cache_dir)]:
+            cache.set(psd, 1, 2, 80, 1600, [80, 150, 1600])
+            self.assertEqual(list(cache.get(close, 1, 2, 80, 1600)),
+                             [80, 150, 1600])
+            self.assertEqual(cache.get(far, 1, 2, 80, 1600), None)
+            self.assertEqual(cache.get(other_df, 1, 2, 80, 1600), None)
+
+    def test_eviction(self):
+        cache = ChisqBinCache(directory=self.cache_dir, max_files=2)
+        for i, psd in enumerate(self.psds):
+            cache.set(psd, 1, 2, 80, 1600, [80, 100 + i, 1600])
+            cache.save()
+            # Give the files distinct modification times
+            fname = os.path.join(self.cache_dir, 'chisq_bins_%s.hdf' %
+                                 SigmasqCache.psd_key(psd))
+            os.utime(fname, (1000000 + i, 1000000 + i))
+
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+        new = ChisqBinCache(directory=self.cache_dir)
+        self.assertEqual(new.get(self.psds[0], 1, 2, 80, 1600), None)
+        self.assertEqual(list(new.get(self.psds[2], 1, 2, 80, 1600)),
+                         [80, 102, 1600])
+
+    def expected_bins(self, psd, num_bins):
+        bins = []
+        for t in self.templates:
+            if t.approximant in getattr(psd, 'sigmasq_vec', {}):
+                bins.append(power_chisq_bins_from_sigmasq_series(
+                                psd.sigmasq_vec[t.approximant], num_bins,
+                                int(t.f_lower / psd.delta_f), t.end_idx))
+            else:
+                bins.append(power_chisq_bins(t, num_bins, psd, t.f_lower))
+        return bins
+
+    def test_cached_bins(self):
+        psd = self.psds[0]
+        # Only one of the approximants has a cumulative sigmasq series
+        f = numpy.arange(len(psd)) * self.delta_f
+        f[0] = 1.0
+        psd.sigmasq_vec = {'SPAtmplt': numpy.cumsum(f ** (-7.0 / 3) /
+                                                    psd.numpy())}
+        expected = self.expected_bins(psd, 8)
+
+        bin_cache = ChisqBinCache(directory=self.cache_dir)
+        for cache in [None, bin_cache, bin_cache]:
+            chisq = SingleDetPowerChisq(num_bins='8', bin_cache=cache)
+            for t in self.templates:
+                t.__dict__.pop('_bin_cache', None)
+            bins = chisq.cached_chisq_bins_block(self.templates, psd)
+            self.assertEqual(len(bins), len(expected))
+            for b, e in zip(bins, expected):
+                self.assertEqual(list(b), list(e))
+            # The bins are kept on the templates
+            bins = [chisq.cached_chisq_bins(t, psd) for t in self.templates]
+            for b, e in zip(bins, expected):
+                self.assertEqual(list(b), list(e))
+
+        # and in the bin cache, for other jobs
+        bin_cache.save()
+        new = ChisqBinCache(directory=self.cache_dir)
+        for t, e in zip(self.templates, expected):
+            b = new.get(psd, t.params.template_hash, 8,
+                        int(t.f_lower / psd.delta_f), t.end_idx)
+            self.assertEqual(list(b), list(e))
+
 suite = unittest.TestSuite()
 suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestChisq))
+suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestChisqBinCache))
 
 if __name__ == '__main__':
     results = unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,221 @@
+"""
+These are the unittests for the coincidence functions of pycbc.events.coinc
+"""
+import unittest
+import itertools
+import os, tempfile, shutil
+import numpy
+import h5py
+from pycbc.events.coinc import time_coincidence, time_multi_coincidence
+from pycbc.events.coinc import time_coincidence_chunks
+from pycbc.events.coinc import cluster_coincs, cluster_coincs_chunked
+from pycbc.events.coinc import cluster_coincs_parallel
+from pycbc.events.coinc import calculate_n_louder, RemovableBackground
+from pycbc.events.stat import NewSNRStatistic, PhaseTDStatistic
+from pycbc.pool import SinglePool
+from utils import parse_args_cpu_only, simple_exit
+
+parse_args_cpu_only("Coinc")
+
+def brute_force_coincs(times, windows, slide_step, slides):
+    """ Return the set of the largest coincidences of each timeslide """
+    ndet = len(times)
+    coincs = set()
+    for slide in slides:
+        shifted = [t + slide * k * slide_step for k, t in enumerate(times)]
+        found = []
+        for num in range(2, ndet + 1):
+            for dets in itertools.combinations(range(ndet), num):
+                ranges = [range(len(times[d])) for d in dets]
+                for idx in itertools.product(*ranges):
+                    pos = dict(zip(dets, idx))
+                    if all([abs(shifted[j][pos[j]] - shifted[k][pos[k]])
+                            <= windows[j, k]
+                            for j, k in itertools.combinations(dets, 2)]):
+                        found.append(tuple([pos.get(d, -1)
+                                            for d in range(ndet)]))
+        for row in found:
+            larger = [other for other in found if other != row and
+                      all([r == -1 or r == o for r, o in zip(row, other)])]
+            if not larger:
+                coincs.add(row + (slide,))
+    return coincs
+
+class TestCoincidence(unittest.TestCase):
+    def setUp(self, *args):
+        numpy.random.seed(0)
+        self.t1 = numpy.random.uniform(0, 1000, size=3000)
+        self.t2 = numpy.random.uniform(0, 1000, size=2000)
+
+    def test_chunks(self):
+        for step in [0, 0.7]:
+            idx1, idx2, slide = time_coincidence(self.t1, self.t2, 0.05, step)
+            pairs = set(zip(idx1, idx2, slide))
+            self.assertEqual(len(pairs), len(idx1))
+            for chunk_size in [1, 100, 2**22]:
+                chunks = list(time_coincidence_chunks(self.t1, self.t2, 0.05,
+                                                      step, chunk_size))
+                found = numpy.concatenate([c[0] for c in chunks])
+                self.assertTrue((found == idx1).all())
+                # Only the pairs of the last trigger may exceed the size
+                for c in chunks:
+                    if len(c[0]) > 0:
+                        last = (c[0] == c[0][-1]).sum()
+                        self.assertTrue(len(c[0]) - last < chunk_size)
+                c = time_coincidence(self.t1, self.t2, 0.05, step,
+                                     chunk_size=chunk_size)
+                self.assertEqual(set(zip(*c)), pairs)
+
+    def test_keep(self):
+        keep = lambda i1, i2, s: (s == 0) | (self.t1[i1] > self.t2[i2])
+        idx1, idx2, slide = time_coincidence(self.t1, self.t2, 0.05, 0.7)
+        kept = time_coincidence(self.t1, self.t2, 0.05, 0.7, keep=keep,
+                                chunk_size=50)
+        mask = keep(idx1, idx2, slide)
+        for a, b in zip([idx1, idx2, slide], kept):
+            self.assertTrue((a[mask] == b).all())
+
+class TestClusterCoincs(unittest.TestCase):
+    def setUp(self, *args):
+        numpy.random.seed(0)
+        num = 20000
+        self.time1 = numpy.random.uniform(1e9, 1e9 + 1e4, size=num)
+        self.time2 = self.time1 + numpy.random.uniform(-0.01, 0.01, size=num)
+        self.timeslide_id = numpy.random.randint(-20, 21, size=num)
+        self.stat = numpy.random.exponential(size=num) + 8
+        # Include some equal statistic values
+        self.stat[::5] = 9
+        self.expected = cluster_coincs(self.stat, self.time1, self.time2,
+                                       self.timeslide_id, 0.1, 10.0)
+
+    def test_chunked(self):
+        for chunk_size in [1, 7, 100, 2**20]:
+            cid = cluster_coincs_chunked(self.stat, self.time1, self.time2,
+                                         self.timeslide_id, 0.1, 10.0,
+                                         chunk_size=chunk_size)
+            self.assertTrue((cid == self.expected).all())
+
+    def test_parallel(self):
+        cid = cluster_coincs_parallel(self.stat, self.time1, self.time2,
+                                      self.timeslide_id, 0.1, 10.0,
+                                      SinglePool(), chunk_size=1000)
+        self.assertTrue((cid == self.expected).all())
+
+class TestRemovableBackground(unittest.TestCase):
+    def setUp(self, *args):
+        numpy.random.seed(0)
+        self.bstat = numpy.random.exponential(size=5000) + 8
+        self.dec = numpy.random.randint(1, 4, size=5000)
+        self.fstat = numpy.random.exponential(size=300) * 2 + 7
+
+    def test_remove(self):
+        background = RemovableBackground(self.bstat, self.dec)
+        alive = numpy.ones(len(self.bstat), dtype=bool)
+        for num in [1, 10, 500, 3000, 1489]:
+            remove = numpy.random.choice(numpy.flatnonzero(alive), num,
+                                         replace=False)
+            # Removing an event twice has no further effect
+            background.remove(remove)
+            background.remove(remove[:5])
+            alive[remove] = False
+            self.assertEqual(len(background), alive.sum())
+            if alive.any():
+                back_cnum, fnlouder = calculate_n_louder(self.bstat[alive],
+                                                         self.fstat,
+                                                         self.dec[alive])
+                self.assertTrue((background.cumulative() == back_cnum).all())
+            else:
+                fnlouder = numpy.zeros(len(self.fstat))
+            self.assertTrue((background.n_louder(self.fstat) == fnlouder).all())
+
+class TestMultiCoincidence(unittest.TestCase):
+    def setUp(self, *args):
+        numpy.random.seed(0)
+
+    def random_times(self, ndet):
+        return [numpy.random.uniform(0, 20, size=numpy.random.randint(0, 8))
+                for i in range(ndet)]
+
+    def test_two_detectors(self):
+        t1, t2 = numpy.random.uniform(0, 100, size=(2, 200))
+        i1, i2, slide = time_coincidence(t1, t2, 0.2, 1.0)
+        ids, mslide = time_multi_coincidence([t1, t2], {(0, 1): 0.2}, 1.0)
+        expected = set(zip(i1, i2, slide))
+        self.assertEqual(set(zip(ids[:, 0], ids[:, 1], mslide)), expected)
+        self.assertEqual(len(ids), len(i1))
+
+    def test_zerolag(self):
+        for trial in range(10):
+            times = self.random_times(4)
+            windows = dict([(pair, numpy.random.uniform(0.1, 0.5)) for pair
+                            in itertools.combinations(range(4), 2)])
+            ids, slide = time_multi_coincidence(times, windows)
+            found = set([tuple(r) + (s,) for r, s in zip(ids.tolist(),
+                                                         slide.tolist())])
+            self.assertEqual(len(found), len(ids))
+            self.assertEqual(found, brute_force_coincs(times, windows, 0, [0]))
+
+    def test_timeslides(self):
+        for trial in range(10):
+            times = self.random_times(3)
+            windows = dict([(pair, numpy.random.uniform(0.05, 0.3)) for pair
+                            in itertools.combinations(range(3), 2)])
+            ids, slide = time_multi_coincidence(times, windows, 1.0)
+            found = set([tuple(r) + (s,) for r, s in zip(ids.tolist(),
+                                                         slide.tolist())])
+            self.assertEqual(len(found), len(ids))
+            self.assertEqual(found, brute_force_coincs(times, windows, 1.0,
+                                                       range(-40, 41)))
+
+class TestMultiStatistic(unittest.TestCase):
+    def setUp(self, *args):
+        self.dir = tempfile.mkdtemp()
+        self.stat_file = os.path.join(self.dir, 'phasetd.hdf')
+        f = h5py.File(self.stat_file, 'w')
+        f['map'] = numpy.ones((2, 2, 2, 2, 2))
+        for name in ['tbins', 'pbins', 'sbins', 'rbins']:
+            f[name] = numpy.array([0.0, 1.0, 2.0])
+        f.attrs['stat'] = 'phasetd_newsnr'
+        f.attrs['ifo0'] = 'H1'
+        f.attrs['ifo1'] = 'L1'
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_any_detectors(self):
+        rank = NewSNRStatistic([])
+        rank.check_ifos(['H1', 'L1', 'V1'])
+        singles = [numpy.array([3.0, 4.0]), numpy.array([4.0, 0.0]),
+                   numpy.array([12.0, 3.0])]
+        c = rank.coinc_multi(singles, ['H1', 'L1', 'V1'],
+                             numpy.zeros(2), [0, 1, 2])
+        self.assertTrue(numpy.allclose(c, [13.0, 5.0]))
+
+    def test_detector_pair(self):
+        # The histogram is only used for the pair it was made for
+        rank = PhaseTDStatistic([self.stat_file])
+        rank.check_ifos(['H1', 'L1'])
+        rank.check_ifos(['L1', 'H1'])
+        self.assertRaises(ValueError, rank.check_ifos, ['H1', 'V1'])
+        self.assertRaises(ValueError, rank.check_ifos, ['H1', 'L1', 'V1'])
+
+        singles = numpy.zeros(1, dtype=rank.single_dtype)
+        singles['snglstat'] = 5
+        singles['sigmasq'] = 1
+        c = rank.coinc_multi([singles, singles], ['H1', 'L1'],
+                             numpy.zeros(1), [0, 1])
+        self.assertTrue(numpy.allclose(c, 50 ** 0.5))
+        self.assertRaises(ValueError, rank.coinc_multi, [singles, singles],
+                          ['H1', 'V1'], numpy.zeros(1), [0, 1])
+
+suite = unittest.TestSuite()
+suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestCoincidence))
+suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestClusterCoincs))
+suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestRemovableBackground))
+suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestMultiCoincidence))
+suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestMultiStatistic))
+
+if __name__ == '__main__':
+    results = unittest.TextTestRunner(verbosity=2).run(suite)
+    simple_exit(results)
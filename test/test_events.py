@@ -0,0 +1,420 @@
+"""
+These are the unittests for the trigger handling of the pycbc.events module
+"""
+import unittest
+import argparse
+import os, tempfile, shutil
+import numpy
+import h5py
+from pycbc.types import complex64, float32
+from pycbc.events import EventManager, TriggerStore, HDFTriggerStream, newsnr
+from pycbc.events import findchirp_cluster_over_window
+from utils import parse_args_cpu_only, simple_exit
+
+parse_args_cpu_only("Events")
+
+class TestTriggerStore(unittest.TestCase):
+    def setUp(self, *args):
+        self.dtype = [('template_id', int), ('snr', complex64),
+                      ('chisq', float32)]
+        numpy.random.seed(0)
+        self.chunks = []
+        for i in range(200):
+            chunk = numpy.zeros(numpy.random.randint(0, 20), dtype=self.dtype)
+            chunk['template_id'] = i
+            chunk['snr'] = numpy.random.normal(size=len(chunk)) * 1.0j
+            chunk['chisq'] = numpy.random.uniform(size=len(chunk))
+            self.chunks.append(chunk)
+        self.all_events = numpy.concatenate(self.chunks)
+
+    def test_append(self):
+        store = TriggerStore(self.dtype, capacity=1)
+        for chunk in self.chunks:
+            store.append(chunk)
+        self.assertEqual(len(store), len(self.all_events))
+        self.assertTrue(store.capacity >= len(store))
+        self.assertTrue((store.array() == self.all_events).all())
+        self.assertTrue((store.column('snr') == self.all_events['snr']).all())
+
+        store.clear()
+        self.assertEqual(len(store), 0)
+        self.assertEqual(len(store.array()), 0)
+
+    def test_event_manager(self):
+        names = ['snr', 'chisq']
+        mgr = EventManager(None, names, [complex64, float32])
+        for chunk in self.chunks[0:100]:
+            mgr.new_template(tmplt=None, sigmasq=1.0)
+            mgr.add_template_events(names, [chunk[n] for n in names])
+            mgr.finalize_template_events()
+
+        # Replacing the events must be seen by later appends
+        num = len(mgr.events)
+        mgr.events = mgr.events[0:num // 2]
+        for chunk in self.chunks[100:]:
+            mgr.new_template(tmplt=None, sigmasq=1.0)
+            mgr.add_template_events(names, [chunk[n] for n in names])
+            mgr.finalize_template_events()
+
+        first = numpy.concatenate(self.chunks[0:100])[0:num // 2]
+        expected = numpy.concatenate([first] + self.chunks[100:])
+        self.assertEqual(len(mgr.events), len(expected))
+        self.assertTrue((mgr.events['snr'] == expected['snr']).all())
+        self.assertTrue((mgr.events['template_id'] ==
+                         expected['template_id']).all())
+
+    def test_merge_events(self):
+        names = ['snr', 'chisq']
+        mgrs = [EventManager(None, names, [complex64, float32])
+                for i in range(3)]
+        for i, chunk in enumerate(self.chunks):
+            for mgr in [mgrs[0], mgrs[1 + i // 100]]:
+                mgr.new_template(tmplt=None, sigmasq=float(i))
+                mgr.add_template_events(names, [chunk[n] for n in names])
+                mgr.finalize_template_events()
+
+        mgrs[1].merge_events(mgrs[2].events, mgrs[2].template_params)
+        self.assertTrue((mgrs[1].events == mgrs[0].events).all())
+        self.assertEqual(mgrs[1].template_params, mgrs[0].template_params)
+        self.assertEqual(mgrs[1].template_index, mgrs[0].template_index)
+
+class TestTriggerStream(unittest.TestCase):
+    def setUp(self, *args):
+        self.dir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.dir, 'stream.hdf')
+        self.names = ['snr', 'chisq']
+        self.types = [complex64, float32]
+        self.tmplt = numpy.rec.fromarrays([numpy.arange(10) * 7,
+                                           numpy.ones(10)],
+                                names='template_hash,template_duration')
+        numpy.random.seed(2)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def add_templates(self, mgr, start, end, commit=True):
+        for i in range(start, end):
+            n = numpy.random.randint(0, 30)
+            mgr.new_template(tmplt=self.tmplt[i], sigmasq=float(i))
+            mgr.add_template_events(self.names,
+                        [numpy.random.normal(size=n) * 1.0j,
+                         numpy.random.uniform(size=n)])
+            mgr.finalize_template_events()
+            if commit:
+                mgr.checkpoint(i)
+
+    def test_stream(self):
+        mgr = EventManager(None, self.names, self.types)
+        self.assertEqual(mgr.stream_to_hdf(self.fname), -1)
+        self.add_templates(mgr, 0, 10)
+        streamed = mgr.events
+
+        ref = EventManager(None, self.names, self.types)
+        numpy.random.seed(2)
+        self.add_templates(ref, 0, 10)
+        self.assertTrue((streamed == ref.events).all())
+        self.assertEqual(len(mgr.template_params), 10)
+
+    def test_resume(self):
+        mgr = EventManager(None, self.names, self.types)
+        mgr.stream_to_hdf(self.fname)
+        self.add_templates(mgr, 0, 6)
+        # Templates which are not committed are discarded on resume
+        self.add_templates(mgr, 6, 8, commit=False)
+        mgr.stream.close()
+
+        mgr = EventManager(None, self.names, self.types)
+        last = mgr.stream_to_hdf(self.fname, resume=True)
+        self.assertEqual(last, 5)
+        self.assertEqual(mgr.template_index, 5)
+        self.add_templates(mgr, last + 1, 10)
+
+        ref = EventManager(None, self.names, self.types)
+        numpy.random.seed(2)
+        self.add_templates(ref, 0, 6)
+        self.add_templates(ref, 6, 8)
+        ref.events = ref.events[ref.events['template_id'] < 6]
+        ref.template_index = 5
+        ref.template_params = ref.template_params[0:6]
+        self.add_templates(ref, 6, 10)
+
+        self.assertEqual(len(mgr.events), len(ref.events))
+        self.assertTrue((mgr.events == ref.events).all())
+        for p, r in zip(mgr.template_params, ref.template_params):
+            self.assertEqual(p['tmplt'].template_hash,
+                             r['tmplt'].template_hash)
+            self.assertEqual(p['sigmasq'], r['sigmasq'])
+
+        stream = HDFTriggerStream(self.fname, mgr.event_dtype, resume=True)
+        self.assertEqual(stream.num_templates, 10)
+        self.assertEqual(stream.last_template, 9)
+
+    def test_buffer(self):
+        mgr = EventManager(None, self.names, self.types)
+        mgr.stream_to_hdf(self.fname)
+        mgr.stream.buffer_size = 40
+        self.add_templates(mgr, 0, 5, commit=False)
+        # Triggers are only written once the buffer is full
+        written = len(mgr.stream.f['events/snr'])
+        self.assertTrue(mgr.num_events >= 40)
+        self.assertTrue(0 < written <= mgr.num_events < written + 40)
+        mgr.checkpoint(4)
+        self.assertEqual(len(mgr.stream.f['events/snr']), mgr.num_events)
+        self.assertEqual(len(mgr.stream.f['templates/sigmasq']), 5)
+
+    def test_modify_events(self):
+        mgr = EventManager(None, self.names, self.types)
+        mgr.stream_to_hdf(self.fname)
+        ref = EventManager(None, self.names, self.types)
+        for m in (mgr, ref):
+            numpy.random.seed(2)
+            self.add_templates(m, 0, 5)
+            m.events = m.events[m.events['template_id'] != 3]
+            m.events['chisq'][0] = -1
+            self.add_templates(m, 5, 8)
+
+        # Modified events are written back when triggers are added
+        self.assertEqual(len(mgr.events), len(ref.events))
+        self.assertTrue((mgr.events == ref.events).all())
+        self.assertEqual(mgr.events['chisq'][0], -1)
+
+        # and when the file is committed
+        mgr.events = mgr.events[mgr.events['template_id'] < 6]
+        mgr.checkpoint(7)
+        self.assertEqual(len(mgr.stream.f['events/snr']), mgr.num_events)
+        self.assertTrue(mgr.events['template_id'].max() < 6)
+
+    def test_write_from_stream(self):
+        names = ['snr', 'chisq', 'chisq_dof', 'bank_chisq', 'bank_chisq_dof',
+                 'cont_chisq', 'time_index']
+        types = [complex64, float32, int, float32, int, float32, int]
+        opt = argparse.Namespace(channel_name='H1:STRAIN', sample_rate=4096,
+                                 gps_start_time=1000000000,
+                                 gps_end_time=1000002048,
+                                 autochi_number_points=0,
+                                 autochi_onesided=None,
+                                 autochi_two_phase=False,
+                                 autochi_max_valued_dof=None,
+                                 psdvar_short_segment=None,
+                                 trig_start_time=0, trig_end_time=0,
+                                 segment_start_pad=64, segment_end_pad=16)
+        outputs = []
+        for stream in [False, True]:
+            numpy.random.seed(3)
+            mgr = EventManager(opt, names, types)
+            if stream:
+                mgr.stream_to_hdf(self.fname)
+                mgr.stream.buffer_size = 20
+            for i in range(10):
+                n = numpy.random.randint(0, 30)
+                mgr.new_template(tmplt=self.tmplt[i], sigmasq=float(i))
+                vectors = [numpy.random.uniform(size=n) * 1.0j] + \
+                          [numpy.random.randint(1, 100, size=n)
+                           for name in names[1:]]
+                mgr.add_template_events(names, vectors)
+                mgr.finalize_template_events()
+            mgr.checkpoint(9)
+            outname = os.path.join(self.dir, 'out%d.hdf' % stream)
+            mgr.write_to_hdf(outname)
+            # The streamed triggers are not read back all at once
+            self.assertEqual(mgr._events is None, stream)
+            outputs.append(h5py.File(outname, 'r'))
+
+        # Only the order of the triggers of each template may differ
+        ref, new = outputs
+        self.assertEqual(sorted(ref['H1'].keys()), sorted(new['H1'].keys()))
+        keys = [key for key in sorted(ref['H1'].keys())
+                if isinstance(ref['H1'][key], h5py.Dataset)]
+        rows = []
+        for f in outputs:
+            columns = [f['H1'][key][:] for key in keys]
+            order = numpy.lexsort(columns[::-1])
+            rows.append([c[order] for c in columns])
+        for r, n in zip(*rows):
+            self.assertTrue(numpy.array_equal(r, n))
+        for f in outputs:
+            f.close()
+        mgr.stream.close()
+
+# The original, loop based, implementations of the EventManager trigger cuts
+def legacy_chisq_threshold(events, value, delta=0):
+    remove = []
+    for i, event in enumerate(events):
+        xi = event['chisq'] / (event['chisq_dof'] / 2 + 1 + delta * event['snr'].conj() * event['snr'])
+        if xi > value:
+            remove.append(i)
+    return numpy.delete(events, remove)
+
+def legacy_newsnr_threshold(events, threshold):
+    remove = [i for i, e in enumerate(events) if \
+        newsnr(abs(e['snr']), e['chisq'] / e['chisq_dof']) < threshold]
+    return numpy.delete(events, remove)
+
+def legacy_keep_loudest_in_interval(events, window, num_keep):
+    e = events
+    stat = newsnr(abs(e['snr']), e['chisq'] / e['chisq_dof'])
+    time = e['time_index']
+
+    wtime = (time / window).astype(numpy.int32)
+    bins = numpy.unique(wtime)
+
+    keep = []
+    for b in bins:
+        bloc = numpy.where((wtime == b))[0]
+        bloudest = stat[bloc].argsort()[-num_keep:]
+        keep.append(bloc[bloudest])
+    keep = numpy.concatenate(keep)
+    return e[keep]
+
+def legacy_maximize_over_bank(events, opt, tcolumn, column, window):
+    events = numpy.sort(events, order=tcolumn)
+    cvec = events[column]
+    tvec = events[tcolumn]
+
+    indices = []
+    gps = tvec.astype(numpy.float64) / opt.sample_rate + opt.gps_start_time
+    gps_sec  = numpy.floor(gps)
+    gps_nsec = (gps - gps_sec) * 1e9
+
+    wnsec = int(window * 1e9 / opt.sample_rate)
+    win = gps_nsec.astype(int) // wnsec
+
+    indices.append(0)
+    for i in range(len(tvec)):
+        if gps_sec[i] == gps_sec[indices[-1]] and  win[i] == win[indices[-1]]:
+            if abs(cvec[i]) > abs(cvec[indices[-1]]):
+                indices[-1] = i
+        else:
+            indices.append(i)
+    return numpy.take(events, indices)
+
+class TestTriggerCuts(unittest.TestCase):
+    def setUp(self, *args):
+        self.opt = argparse.Namespace(chisq_bins=16, sample_rate=4096,
+                                      gps_start_time=1000000000)
+        self.names = ['snr', 'chisq', 'chisq_dof', 'time_index']
+        self.types = [complex64, float32, int, int]
+        numpy.random.seed(1)
+
+    def event_manager(self, num):
+        mgr = EventManager(self.opt, self.names, self.types)
+        ntemplates = 50
+        tid = numpy.random.randint(0, ntemplates, size=num)
+        for i in range(ntemplates):
+            n = (tid == i).sum()
+            snr = numpy.random.uniform(5.5, 20, size=n) * \
+                  numpy.exp(1.0j * numpy.random.uniform(0, 6.28, size=n))
+            chisq = numpy.random.uniform(0, 100, size=n)
+            dof = numpy.repeat(30, n)
+            time = numpy.random.randint(0, 4096 * 100, size=n)
+            mgr.new_template(tmplt=None, sigmasq=1.0)
+            mgr.add_template_events(self.names, [snr, chisq, dof, time])
+            mgr.finalize_template_events()
+        return mgr
+
+    def assertSameEvents(self, a, b):
+        self.assertEqual(len(a), len(b))
+        for name in a.dtype.names:
+            self.assertTrue((a[name] == b[name]).all())
+
+    def test_chisq_threshold(self):
+        for delta in [0, 0.01]:
+            mgr = self.event_manager(10000)
+            expected = legacy_chisq_threshold(mgr.events, 1.5, delta)
+            mgr.chisq_threshold(1.5, 16, delta)
+            self.assertTrue(0 < len(mgr.events) < 10000)
+            self.assertSameEvents(mgr.events, expected)
+
+    def test_newsnr_threshold(self):
+        mgr = self.event_manager(10000)
+        expected = legacy_newsnr_threshold(mgr.events, 8)
+        mgr.newsnr_threshold(8)
+        self.assertTrue(0 < len(mgr.events) < 10000)
+        self.assertSameEvents(mgr.events, expected)
+
+    def test_keep_loudest_in_interval(self):
+        for num_keep in [1, 3]:
+            mgr = self.event_manager(10000)
+            expected = legacy_keep_loudest_in_interval(mgr.events,
+                                                       4096 * 2, num_keep)
+            mgr.keep_loudest_in_interval(4096 * 2, num_keep)
+            self.assertSameEvents(mgr.events, expected)
+
+    def test_maximize_over_bank(self):
+        for window in [1, 41, 4096]:
+            mgr = self.event_manager(10000)
+            expected = legacy_maximize_over_bank(mgr.events, self.opt,
+                                                 'time_index', 'snr', window)
+            mgr.maximize_over_bank('time_index', 'snr', window)
+            self.assertSameEvents(mgr.events, expected)
+
+    def test_maximize_over_bank_ties(self):
+        mgr = self.event_manager(10000)
+        e = mgr.events
+        # Events of equal snr, some at the same time in different templates
+        e['snr'][5000:] = e['snr'][:5000]
+        e['time_index'][5000:7500] = e['time_index'][:2500]
+        mgr.events = e
+        expected = legacy_maximize_over_bank(mgr.events, self.opt,
+                                             'time_index', 'snr', 41)
+        mgr.maximize_over_bank('time_index', 'snr', 41)
+        self.assertSameEvents(mgr.events, expected)
+
+    def test_findchirp_cluster_over_window(self):
+        times = numpy.sort(numpy.random.randint(0, 100000, size=5000))
+        values = numpy.random.uniform(0, 10, size=5000)
+        values[1::3] = values[0::3][:len(values[1::3])]
+        indices = findchirp_cluster_over_window(times, values, 100)
+
+        expected = [0]
+        for i in range(len(times)):
+            if times[i] - times[expected[-1]] > 100:
+                expected.append(i)
+            elif values[i] > values[expected[-1]]:
+                expected[-1] = i
+        self.assertEqual(list(indices), expected)
+
+    def test_deferred_vetoes(self):
+        def cuts(mgr):
+            mgr.chisq_threshold(2.0, 16)
+            mgr.keep_loudest_in_interval(4096, 2)
+            mgr.events = mgr.events[mgr.events['time_index'] % 3 != 0]
+            mgr.maximize_over_bank('time_index', 'snr', 4096)
+
+        ref = self.event_manager(10000)
+        chisq = ref.events['chisq'].copy()
+        cuts(ref)
+
+        numpy.random.seed(1)
+        mgr = self.event_manager(10000)
+        mgr.events['chisq'] = 0
+        def compute_vetoes(events, positions):
+            events['chisq'][positions] = chisq[positions]
+        def passes(events):
+            xi = events['chisq'] / (events['chisq_dof'] / 2 + 1)
+            return ~(xi > 2.0)
+        keep = mgr.events['time_index'] % 3 != 0
+        num = mgr.compute_deferred_vetoes(compute_vetoes, passes,
+                                          loudest=(4096, 2), keep=keep,
+                                          maximization_window=4096)
+        self.assertTrue(num < 10000)
+        cuts(mgr)
+        self.assertSameEvents(numpy.sort(mgr.events, order='time_index'),
+                              numpy.sort(ref.events, order='time_index'))
+
+    def test_empty(self):
+        mgr = self.event_manager(0)
+        mgr.chisq_threshold(1.5, 16)
+        mgr.newsnr_threshold(8)
+        mgr.keep_loudest_in_interval(4096, 1)
+        mgr.maximize_over_bank('time_index', 'snr', 41)
+        self.assertEqual(len(mgr.events), 0)
+
+suite = unittest.TestSuite()
+suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestTriggerStore))
+suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestTriggerStream))
+suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestTriggerCuts))
+
+if __name__ == '__main__':
+    results = unittest.TextTestRunner(verbosity=2).run(suite)
+    simple_exit(results)
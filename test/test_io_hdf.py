@@ -0,0 +1,148 @@
+"""
+These are the unittests for reading the triggers of blocks of templates with
+pycbc.io.hdf.ReadByTemplate
+"""
+import unittest
+import os, tempfile, shutil
+import numpy
+import h5py
+from pycbc.io.hdf import ReadByTemplate
+from pycbc.pool import choose_pool
+from utils import parse_args_cpu_only, simple_exit
+
+parse_args_cpu_only("ReadByTemplate")
+
+def read_templates(reader, nums):
+    """ Return the trigger ids and columns of each template """
+    found = []
+    for num in nums:
+        tid = reader.set_template(num)
+        found.append((tid, reader['end_time'], reader['snr']))
+    return found
+
+# The reader of the worker processes, which is inherited when they are forked
+_reader = None
+
+def read_block(nums):
+    _reader.set_block(nums)
+    return read_templates(_reader, nums)
+
+class TestReadByTemplate(unittest.TestCase):
+    def setUp(self, *args):
+        self.dir = tempfile.mkdtemp()
+        numpy.random.seed(0)
+        num = 30
+        self.bank = os.path.join(self.dir, 'bank.hdf')
+        hashes = numpy.random.randint(0, 2**30, size=num)
+        f = h5py.File(self.bank, 'w')
+        f['template_hash'] = hashes
+        f['mass1'] = numpy.random.uniform(1, 10, size=num)
+        f.attrs['parameters'] = ['template_hash', 'mass1']
+        f.close()
+
+        # The triggers of each template are stored in the hash order of the
+        # bank, some templates have none
+        counts = numpy.random.randint(0, 20, size=num)
+        counts[numpy.random.randint(0, num, size=8)] = 0
+        self.boundaries = numpy.zeros(num, dtype=numpy.uint32)
+        start = 0
+        for t in hashes.argsort():
+            self.boundaries[t] = start
+            start += counts[t]
+        self.counts = counts
+        self.end_time = numpy.random.uniform(1000, 2000, size=start)
+        self.snr = numpy.random.uniform(5, 20, size=start).astype(numpy.float32)
+
+        self.trigs = os.path.join(self.dir, 'trigs.hdf')
+        f = h5py.File(self.trigs, 'w')
+        f['H1/end_time'] = self.end_time
+        f['H1/snr'] = self.snr
+        f['H1/template_boundaries'] = self.boundaries
+        ref_dtype = h5py.special_dtype(ref=h5py.RegionReference)
+        for col in ['end_time', 'snr']:
+            dset = f['H1/%s' % col]
+            refs = f.create_dataset('H1/%s_template' % col, (num,),
+                                    dtype=ref_dtype)
+            for t in range(num):
+                l = self.boundaries[t]
+                refs[t] = dset.regionref[l:l + counts[t]]
+        f['H1/search/start_time'] = numpy.array([900.0, 1500.0])
+        f['H1/search/end_time'] = numpy.array([1400.0, 2100.0])
+        f.close()
+        self.nums = numpy.arange(num)[hashes.argsort()]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def expected(self, nums):
+        found = []
+        for num in nums:
+            l = self.boundaries[num]
+            sl = slice(l, l + self.counts[num])
+            keep = numpy.flatnonzero((self.end_time[sl] < 1400) |
+                                     (self.end_time[sl] >= 1500))
+            found.append((keep + l, self.end_time[sl][keep],
+                          self.snr[sl][keep]))
+        return found
+
+    def assertTriggersEqual(self, found, expected):
+        self.assertEqual(len(found), len(expected))
+        for f, e in zip(found, expected):
+            for a, b in zip(f, e):
+                self.assertEqual(len(a), len(b))
+                self.assertTrue(numpy.array_equal(a, b))
+
+    def test_template(self):
+        # One template at a time, with and without the bank
+        nums = numpy.random.permutation(len(self.nums))
+        self.assertTriggersEqual(read_templates(
+                                 ReadByTemplate(self.trigs, self.bank), nums),
+                                 self.expected(nums))
+        self.assertTriggersEqual(read_templates(
+                                 ReadByTemplate(self.trigs), nums),
+                                 self.expected(nums))
+
+        reader = ReadByTemplate(self.trigs, self.bank)
+        reader.set_template(7)
+        self.assertEqual(reader.param['mass1'],
+                         h5py.File(self.bank, 'r')['mass1'][7])
+
+    def test_block(self):
+        # Blocks in the file order, of part of the bank, and scattered
+        # templates give the triggers read one template at a time
+        blocks = [self.nums[0:10], self.nums[10:30], self.nums[5:12],
+                  self.nums[::4], numpy.array([3, 17, 4, 29, 0])]
+        for max_waste in [0, 0.5, 1.0]:
+            reader = ReadByTemplate(self.trigs, self.bank,
+                                    max_waste=max_waste)
+            for block in blocks:
+                reader.set_block(block)
+                if max_waste == 0:
+                    # Only contiguous templates are merged
+                    self.assertEqual(sum(r - l for l, r in reader.reads),
+                                     self.counts[block].sum())
+                elif max_waste == 1.0:
+                    self.assertTrue(len(reader.reads) <= 1)
+                self.assertTriggersEqual(read_templates(reader, block),
+                                         self.expected(block))
+                # Templates outside the block are still read
+                self.assertTriggersEqual(read_templates(reader, [1, 2]),
+                                         self.expected([1, 2]))
+
+    def test_pool(self):
+        # Blocks read by worker processes give the same triggers
+        global _reader
+        _reader = ReadByTemplate(self.trigs, self.bank)
+        blocks = [self.nums[i:i + 7] for i in range(0, len(self.nums), 7)]
+        pool = choose_pool(2)
+        results = pool.map(read_block, blocks)
+        self.assertEqual(len(results), len(blocks))
+        for found, block in zip(results, blocks):
+            self.assertTriggersEqual(found, self.expected(block))
+
+suite = unittest.TestSuite()
+suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestReadByTemplate))
+
+if __name__ == '__main__':
+    results = unittest.TextTestRunner(verbosity=2).run(suite)
+    simple_exit(results)
@@ -126,6 +126,49 @@ class TestMatchedFilter(unittest.TestCase):
             o,i = match(self.filtD,self.filt2D)
             self.assertAlmostEqual(sqrt(0.5),o,places=3)
 
+    def test_batch_matched_filter(self):
+        # Batched correlation is only implemented for the CPU
+        if self.scheme == 'cuda':
+            return
+        with self.context:
+            tlen = 4096 * 4
+            flen = tlen / 2 + 1
+            delta_f = 1.0
+            numpy.random.seed(0)
+            def rand_fs():
+                v = numpy.random.normal(size=flen) + \
+                    1.0j * numpy.random.normal(size=flen)
+                return FrequencySeries(v, delta_f=delta_f, dtype=complex64)
+
+            seg = rand_fs()
+            seg.analyze = slice(tlen / 4, 3 * tlen / 4)
+            norms = [1.0, 0.9, 1.1]
+            thresh = 4.0 * delta_f * 5.0 * sqrt(flen)
+
+            for cluster_function in ['symmetric', 'findchirp']:
+                tmem = zeros(tlen, dtype=complex64)
+                single = MatchedFilterControl(10, None, thresh, tlen, delta_f,
+                                              complex64, [seg], tmem, True,
+                                              cluster_function=cluster_function)
+                batch = BatchMatchedFilterControl(10, None, thresh, tlen,
+                                                  delta_f, complex64, [seg],
+                                                  4, True,
+                                                  cluster_function=cluster_function)
+                templates = [rand_fs() for n in norms]
+                for t, out in zip(templates, batch.template_outputs):
+                    out[0:flen] = t
+                results = batch.matched_filter_and_cluster(0, norms, 64)
+                self.assertEqual(len(results), len(norms))
+
+                for t, n, res in zip(templates, norms, results):
+                    tmem[0:flen] = t
+                    _, norm, _, idx, snrv = \
+                        single.matched_filter_and_cluster(0, n, 64)
+                    self.assertTrue(len(idx) > 0)
+                    self.assertAlmostEqual(norm, res[1], places=6)
+                    self.assertTrue((numpy.array(idx) == res[3]).all())
+                    self.assertTrue(numpy.allclose(snrv, res[4], rtol=1e-5))
+
     def test_errors(self):
         with self.context:
             #Check that an incompatible data and filter produce an error
@@ -142,8 +185,152 @@ class TestMatchedFilter(unittest.TestCase):
             self.assertRaises(ValueError,match,self.filt,self.filt[0:len(self.filt)-1])
 
 
+class TestHierarchicalMatchedFilter(unittest.TestCase):
+    def setUp(self, *args):
+        self.context = _context
+        self.scheme = _scheme
+        # Two chirp-like templates with different phase evolution in white
+        # noise, each injected into the data at a different time
+        self.tlen = 4096 * 16
+        self.flen = self.tlen / 2 + 1
+        self.delta_f = 1.0 / 16
+        self.delta_t = 1.0 / 4096
+        self.flow = 30.0
+        f = numpy.arange(self.flen) * self.delta_f
+        f[0] = 1.0
+        amp = f ** (-7.0 / 6)
+        amp[f < self.flow] = 0
+        self.templates = []
+        for c in [1.0, 1.3]:
+            phase = 2 * numpy.pi * 20 * c * (f / self.flow) ** (-5.0 / 3)
+            self.templates.append(amp * numpy.exp(-1.0j * phase))
+        self.norms = [4 * self.delta_f * (abs(h) ** 2).sum()
+                      for h in self.templates]
+        self.f = f
+
+        self.times = [4.0, 10.0]
+        self.segments = [self.segment(zip(self.templates, self.times), 30.0),
+                         # A signal just before the analysis region
+                         self.segment([(self.templates[0], 2.0 - self.delta_t)],
+                                      30.0)]
+
+    def segment(self, signals, snr):
+        data = numpy.zeros(self.flen, dtype=numpy.complex128)
+        for h, t in signals:
+            scale = snr / (4 * self.delta_f * (abs(h) ** 2).sum()) ** 0.5
+            data += scale * h * numpy.exp(-2.0j * numpy.pi * self.f * t)
+        seg = FrequencySeries(data, delta_f=self.delta_f, dtype=complex64)
+        seg.analyze = slice(self.tlen / 8, 7 * self.tlen / 8)
+        return seg
+
+    def filters(self, segments, downsample_factor):
+        tmem = zeros(self.tlen, dtype=complex64)
+        full = MatchedFilterControl(self.flow, None, 5.0, self.tlen,
+                                    self.delta_f, complex64, segments, tmem,
+                                    True, cluster_function='findchirp')
+        red = MatchedFilterControl(self.flow, None, 5.0, self.tlen,
+                                   self.delta_f, complex64, segments, tmem,
+                                   True, downsample_factor=downsample_factor,
+                                   upsample_threshold=0.5)
+        return tmem, full, red
+
+    def test_template_changes(self):
+        # The template memory is reused, so each template must give its own
+        # triggers and not those of the first template filtered
+        if self.scheme != 'cpu':
+            return
+        with self.context:
+            tmem, full, red = self.filters(self.segments[0:1], 4)
+            start = self.segments[0].analyze.start
+            for i in [0, 1, 0]:
+                tmem[0:self.flen] = self.templates[i]
+                _, norm, _, idx, snrv = full.matched_filter_and_cluster(0,
+                                                        self.norms[i], 4096)
+                _, rnorm, _, ridx, rsnrv = red.matched_filter_and_cluster(0,
+                                                        self.norms[i], 4096)
+                loud = abs(numpy.array(snrv)).argmax()
+                rloud = abs(numpy.array(rsnrv)).argmax()
+                expected = int(self.times[i] / self.delta_t) - start
+                self.assertEqual(idx[loud], expected)
+                self.assertEqual(ridx[rloud], expected)
+                self.assertAlmostEqual(abs(rsnrv[rloud]) * rnorm /
+                                       (abs(snrv[loud]) * norm), 1, places=3)
+                self.assertAlmostEqual(abs(rsnrv[rloud]) * rnorm, 30, delta=0.1)
+
+    def test_analysis_region(self):
+        # A peak just outside the analysis region must not give triggers
+        # before it
+        if self.scheme != 'cpu':
+            return
+        with self.context:
+            tmem, _, red = self.filters(self.segments, 4)
+            tmem[0:self.flen] = self.templates[0]
+            _, _, _, idx, _ = red.matched_filter_and_cluster(1,
+                                                        self.norms[0], 4096)
+            analyze = self.segments[1].analyze
+            self.assertTrue(len(idx) > 0)
+            idx = numpy.array(idx)
+            self.assertTrue((idx >= 0).all())
+            self.assertTrue((idx < analyze.stop - analyze.start).all())
+
+    def test_snr_series(self):
+        # The reduced rate SNR is returned as a time series with the given
+        # epoch, and its peak keeps at least the bound on the SNR loss
+        if self.scheme != 'cpu':
+            return
+        with self.context:
+            for factor in [2, 4, 8]:
+                tmem, _, red = self.filters(self.segments[0:1], factor)
+                tmem[0:self.flen] = self.templates[0]
+                htilde = FrequencySeries(self.templates[0],
+                                         delta_f=self.delta_f)
+                bound = hierarchical_snr_loss_bound(htilde, None, factor,
+                                                    self.flow)
+                self.assertTrue(0 < bound <= 1)
+                for offset in range(factor):
+                    # Move the peak between the reduced rate samples
+                    t = self.times[0] + offset * self.delta_t
+                    seg = self.segment([(self.templates[0], t)], 30.0)
+                    red.segments[0] = seg
+                    snr, norm, _, idx, _ = red.matched_filter_and_cluster(0,
+                                    self.norms[0], 4096, epoch=1000000000)
+                    self.assertTrue(isinstance(snr, TimeSeries))
+                    self.assertEqual(snr.start_time, 1000000000)
+                    self.assertAlmostEqual(snr.delta_t,
+                                           self.delta_t * factor)
+                    self.assertEqual(len(snr), self.tlen / factor)
+                    peak = abs(snr.numpy()).max() * norm
+                    self.assertTrue(peak >= 30 * bound * (1 - 1e-3))
+                    self.assertTrue(peak <= 30 * (1 + 1e-3))
+
+    def test_smear(self):
+        from pycbc.filter.matchedfilter import smear
+        idx = smear(numpy.array([64, 200]), 4)
+        self.assertEqual(list(idx), range(62, 67) + range(198, 203))
+        self.assertTrue(idx.dtype.kind == 'i')
+
+    def test_transpose(self):
+        if self.scheme != 'cpu':
+            return
+        from pycbc.fft import fftw_pruned
+        with self.context:
+            numpy.random.seed(0)
+            for i in range(2):
+                vec = numpy.random.normal(size=self.tlen) + \
+                      1.0j * numpy.random.normal(size=self.tlen)
+                vec = Array(vec, dtype=complex64)
+                out = fftw_pruned.fft_transpose_fftw(vec)
+                expected = fftw_pruned.fft_transpose_numpy(vec)
+                self.assertTrue(numpy.array_equal(out.numpy(),
+                                                  expected.numpy()))
+                # The transpose is only planned once
+                if i == 0:
+                    plan = fftw_pruned._thetransposeplan
+                self.assertTrue(fftw_pruned._thetransposeplan is plan)
+
 suite = unittest.TestSuite()
 suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestMatchedFilter))
+suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestHierarchicalMatchedFilter))
 
 if __name__ == '__main__':
     results = unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,140 @@
+"""
+These are the unittests for the sine-Gaussian chisq of pycbc.vetoes.sgchisq
+"""
+import unittest
+import numpy
+from pycbc.types import FrequencySeries, complex64, float32
+from pycbc.io import FieldArray
+from pycbc.filter import sigma
+from pycbc.events import newsnr
+from pycbc.waveform import sinegauss
+from pycbc.waveform.utils import apply_fseries_time_shift
+from pycbc.vetoes.sgchisq import SingleDetSGChisq
+from utils import parse_args_cpu_only, simple_exit
+
+parse_args_cpu_only("SG Chisq")
+
+class Bank(object):
+    def __init__(self, table):
+        self.table = table
+
+class TestSGChisq(unittest.TestCase):
+    def setUp(self, *args):
+        numpy.random.seed(0)
+        self.delta_f = 1.0 / 16
+        self.flen = 2048 * 16 + 1
+        self.N = (self.flen - 1) * 2
+        f = numpy.arange(self.flen) * self.delta_f
+        f[0] = 1.0
+        self.psd = FrequencySeries(((f + 10) / 100.0) ** -4 + 1.0 +
+                                   (f / 500.0) ** 2,
+                                   delta_f=self.delta_f, dtype=float32)
+        data = numpy.random.normal(size=self.flen) + \
+               numpy.random.normal(size=self.flen) * 1.0j
+        self.stilde = FrequencySeries(data / self.psd.numpy() ** 0.5,
+                                      delta_f=self.delta_f, dtype=complex64)
+
+        table = FieldArray.from_kwargs(mass1=numpy.array([10.0, 1.4]),
+                                       mass2=numpy.array([8.0, 1.4]),
+                                       template_hash=numpy.array([11, 22]))
+        self.bank = Bank(table)
+        self.locations = ['mass1>5:20-30,10-0,40-15']
+
+        # A synthetic template which ends at 800 Hz
+        self.templates = []
+        for params in table:
+            htilde = f ** (-7.0 / 6) * numpy.exp(-2.0j * numpy.pi *
+                                                 (f / 30.0) ** (-5.0 / 3))
+            htilde[(f < 30) | (f > 800)] = 0
+            template = FrequencySeries(htilde, delta_f=self.delta_f,
+                                       dtype=complex64, epoch=0)
+            template.params = params
+            template.f_lower = 30.0
+            template.end_idx = int(800 / self.delta_f)
+            template.approximant = 'SPAtmplt'
+            self.templates.append(template)
+
+        self.snrv = (numpy.random.uniform(4, 12, size=40) *
+                     numpy.exp(numpy.random.uniform(0, 2 * numpy.pi,
+                                                    size=40) * 1.0j))
+        self.bchisq = numpy.random.uniform(0.5, 3, size=40)
+        self.bchisq_dof = numpy.repeat(14, 40)
+        self.indices = numpy.random.randint(0, self.N, size=40)
+
+    def per_trigger(self, sg, template, snrv, snr_norm, indices):
+        """ The sine-Gaussian chisq, calculated for one trigger at a time by
+        shifting the data to the time of each trigger
+        """
+        values = sg.params[template.params.template_hash].split(',')
+        bins = sg.cached_chisq_bins(template, self.psd)
+        chisq = numpy.ones(len(snrv))
+        for i, snrvi in enumerate(snrv):
+            snr = abs(snrvi * snr_norm)
+            nsnr = newsnr(snr, self.bchisq[i] / self.bchisq_dof[i])
+            if nsnr < sg.snr_threshold:
+                continue
+
+            dt = 1.0 / (self.N * template.delta_f)
+            kmin = int(template.f_lower / self.psd.delta_f)
+            time = float(template.epoch) + dt * indices[i]
+            stilde_shift = apply_fseries_time_shift(self.stilde, -time)
+
+            fstep = (bins[-2] - bins[-3])
+            fpeak = (bins[-2] + fstep) * template.delta_f
+            chisq[i] = 0
+            for descr in values:
+                q, offset = descr.split('-')
+                q, offset = float(q), float(offset)
+                fcen = fpeak + offset
+                flow = max(kmin * template.delta_f, fcen - 50)
+                fhigh = fcen + 50
+                kmin = int(flow / template.delta_f)
+                kmax = int(fhigh / template.delta_f)
+                gtem = sinegauss.fd_sine_gaussian(1.0, q, fcen, flow,
+                                      len(template) * template.delta_f,
+                                      template.delta_f).astype(complex64)
+                gsigma = sigma(gtem, psd=self.psd, low_frequency_cutoff=flow,
+                               high_frequency_cutoff=fhigh)
+                gsnr = (gtem[kmin:kmax] * stilde_shift[kmin:kmax]).sum()
+                gsnr *= 4.0 * gtem.delta_f / gsigma
+                chisq[i] += abs(gsnr) ** 2.0
+            chisq[i] /= 2 * len(values)
+        return chisq
+
+    def test_values(self):
+        sg = SingleDetSGChisq(self.bank, '8', 8.0, self.locations)
+        template = self.templates[0]
+        chisq = sg.values(self.stilde, template, self.psd, self.snrv, 1.0,
+                          self.bchisq, self.bchisq_dof, self.indices)
+        expected = self.per_trigger(sg, template, self.snrv, 1.0,
+                                    self.indices)
+        self.assertEqual(len(chisq), len(self.snrv))
+        # Some of the triggers are below the threshold
+        self.assertTrue((expected == 1).any())
+        self.assertTrue((expected != 1).any())
+        self.assertTrue(numpy.allclose(chisq, expected, rtol=1e-3))
+
+        # The tiles are cached, and give the same values again
+        again = sg.values(self.stilde, template, self.psd, self.snrv, 1.0,
+                          self.bchisq, self.bchisq_dof, self.indices)
+        self.assertTrue(numpy.array_equal(chisq, again))
+
+    def test_not_applied(self):
+        # The sine-Gaussians are only placed for the templates in the
+        # regions given
+        sg = SingleDetSGChisq(self.bank, '8', 8.0, self.locations)
+        chisq = sg.values(self.stilde, self.templates[1], self.psd, self.snrv,
+                          1.0, self.bchisq, self.bchisq_dof, self.indices)
+        self.assertTrue((chisq == 1).all())
+
+        sg = SingleDetSGChisq(self.bank, '8', None, self.locations)
+        self.assertEqual(sg.values(self.stilde, self.templates[0], self.psd,
+                                   self.snrv, 1.0, self.bchisq,
+                                   self.bchisq_dof, self.indices), None)
+
+suite = unittest.TestSuite()
+suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestSGChisq))
+
+if __name__ == '__main__':
+    results = unittest.TextTestRunner(verbosity=2).run(suite)
+    simple_exit(results)
@@ -0,0 +1,116 @@
+"""
+These are the unittests for saving and reading back the conditioned data
+segments of pycbc.strain
+"""
+import unittest
+import os, tempfile, shutil
+import numpy
+import h5py
+from pycbc.types import FrequencySeries, complex64, float32
+from pycbc.strain import save_fourier_segments, load_fourier_segments
+from pycbc.events import EventManager
+from utils import parse_args_cpu_only, simple_exit
+
+parse_args_cpu_only("Strain")
+
+class TestFourierSegments(unittest.TestCase):
+    def setUp(self, *args):
+        self.dir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.dir, 'segments.hdf')
+        numpy.random.seed(0)
+        psds = [FrequencySeries(numpy.random.uniform(1, 2, size=65),
+                                delta_f=0.25, epoch=1000000000 + 32 * i)
+                for i in range(2)]
+        # The first two segments share a PSD
+        self.segments = []
+        for i, psd in enumerate([psds[0], psds[0], psds[1]]):
+            data = numpy.random.normal(size=65) + \
+                   numpy.random.normal(size=65) * 1.0j
+            seg = FrequencySeries(data.astype(numpy.complex64), delta_f=0.25,
+                                  epoch=1000000000 + 16 * i)
+            seg.analyze = slice(256, 768)
+            seg.seg_slice = slice(i * 512, i * 512 + 1024)
+            seg.cumulative_index = i * 512 + 256
+            seg.psd = psd
+            self.segments.append(seg)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def assertSegmentsEqual(self, segments):
+        self.assertEqual(len(segments), len(self.segments))
+        for a, b in zip(self.segments, segments):
+            self.assertTrue(numpy.array_equal(a.numpy(), b.numpy()))
+            self.assertEqual(a.delta_f, b.delta_f)
+            self.assertEqual(float(a.epoch), float(b.epoch))
+            self.assertEqual(a.analyze, b.analyze)
+            self.assertEqual(a.seg_slice, b.seg_slice)
+            self.assertEqual(a.cumulative_index, b.cumulative_index)
+            self.assertTrue(numpy.array_equal(a.psd.numpy(), b.psd.numpy()))
+            self.assertEqual(float(a.psd.epoch), float(b.psd.epoch))
+        self.assertTrue(segments[0].psd is segments[1].psd)
+        self.assertFalse(segments[0].psd is segments[2].psd)
+
+    def test_round_trip(self):
+        save_fourier_segments(self.fname, self.segments)
+        self.assertSegmentsEqual(load_fourier_segments(self.fname))
+
+        # Saving again replaces the segments
+        save_fourier_segments(self.fname, self.segments[0:1])
+        self.assertEqual(len(load_fourier_segments(self.fname)), 1)
+
+    def test_incomplete(self):
+        h5py.File(self.fname, 'w').close()
+        self.assertEqual(load_fourier_segments(self.fname), None)
+
+        # A job evicted while writing leaves no count of the segments
+        save_fourier_segments(self.fname, self.segments)
+        f = h5py.File(self.fname, 'a')
+        del f['segments'].attrs['num_segments']
+        f.close()
+        self.assertEqual(load_fourier_segments(self.fname), None)
+
+    def test_resume_checkpoint(self):
+        # A checkpoint file holds the segments and the streamed triggers
+        names = ['snr', 'chisq']
+        types = [complex64, float32]
+        tmplt = numpy.rec.fromarrays([numpy.arange(10) * 3, numpy.ones(10)],
+                                     names='template_hash,template_duration')
+        save_fourier_segments(self.fname, self.segments)
+
+        def filter_templates(mgr, start, end):
+            for i in range(start, end):
+                n = numpy.random.randint(0, 30)
+                mgr.new_template(tmplt=tmplt[i], sigmasq=float(i))
+                mgr.add_template_events(names,
+                                        [numpy.random.normal(size=n) * 1.0j,
+                                         numpy.random.uniform(size=n)])
+                mgr.finalize_template_events()
+                if i < 6:
+                    mgr.checkpoint(i)
+
+        numpy.random.seed(1)
+        mgr = EventManager(None, names, types)
+        self.assertEqual(mgr.stream_to_hdf(self.fname, resume=True), -1)
+        filter_templates(mgr, 0, 8)
+        # The job is evicted after committing template 5
+        mgr.stream.close()
+
+        self.assertSegmentsEqual(load_fourier_segments(self.fname))
+        mgr = EventManager(None, names, types)
+        last = mgr.stream_to_hdf(self.fname, resume=True)
+        self.assertEqual(last, 5)
+        numpy.random.seed(1)
+        ref = EventManager(None, names, types)
+        filter_templates(ref, 0, 6)
+        self.assertTrue((mgr.events == ref.events).all())
+        self.assertEqual([p['sigmasq'] for p in mgr.template_params],
+                         [p['sigmasq'] for p in ref.template_params])
+        mgr.stream.close()
+
+suite = unittest.TestSuite()
+suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestFourierSegments))
+
+if __name__ == '__main__':
+    results = unittest.TextTestRunner(verbosity=2).run(suite)
+    simple_exit(results)
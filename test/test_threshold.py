@@ -37,6 +37,7 @@ from utils import parse_args_all_schemes, simple_exit
 _scheme, _context = parse_args_all_schemes("Threshold")
 
 from pycbc.events.threshold_cpu import threshold_numpy
+from pycbc.events.threshold_cpu import threshold_and_cluster_block_numpy
 trusted_threshold = threshold_numpy
 
 class TestThreshold(unittest.TestCase):
@@ -58,6 +59,29 @@ class TestThreshold(unittest.TestCase):
             self.assertTrue((locs == self.locs).all())
             self.assertTrue((vals == self.vals).all())
             print(len(locs), len(vals))
+
+    def test_threshold_and_cluster_block(self):
+        # The batched version is only implemented for the cpu
+        if self.scheme != 'cpu':
+            return
+        block = self.series.numpy().reshape(16, 2**16)
+        # Search only part of each row, as for the analyzed part of a segment
+        block = block[:, 100:60000]
+        thresholds = numpy.linspace(0.5, 1.4, 16)
+        window = 1000
+        trows, tlocs, tvals = threshold_and_cluster_block_numpy(block,
+                                                    thresholds, window)
+        with self.context:
+            rows, locs, vals = threshold_and_cluster_block(block, thresholds,
+                                                           window)
+            self.assertTrue((rows == trows).all())
+            self.assertTrue((locs == tlocs).all())
+            self.assertTrue((vals == tvals).all())
+            for r in range(len(block)):
+                tc = ThresholdCluster(Array(block[r].copy()))
+                rvals, rlocs = tc.threshold_and_cluster(thresholds[r], window)
+                self.assertTrue((locs[rows == r] == rlocs).all())
+
 suite = unittest.TestSuite()
 suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TestThreshold))
 
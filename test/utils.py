@@ -65,6 +65,8 @@ once.
 
 import pycbc
 import optparse
+import numpy
+import h5py
 from sys import exit as _exit
 from optparse import OptionParser, OptionValueError
 from pycbc.scheme import CPUScheme, CUDAScheme
@@ -183,6 +185,33 @@ def exit_based_on_results(results):
     else:
         _exit(2)
 
+def write_random_bank(fname, num, mass1=(1.2, 20), mass2=(1.2, 10),
+                      max_spin=0.5):
+    """
+    Write an HDF template bank of aligned spin templates, with masses and
+    spins drawn uniformly from the given ranges, for the tests which
+    generate templates.
+
+    Parameters
+    ----------
+    fname: the name of the bank file to write
+    num: the number of templates
+    mass1, mass2: the (minimum, maximum) of each component mass
+    max_spin: the maximum magnitude of the aligned spins
+
+    Returns
+    -------
+    fname: the name of the bank file
+    """
+    f = h5py.File(fname, 'w')
+    f['mass1'] = numpy.random.uniform(mass1[0], mass1[1], size=num)
+    f['mass2'] = numpy.random.uniform(mass2[0], mass2[1], size=num)
+    f['spin1z'] = numpy.random.uniform(-max_spin, max_spin, size=num)
+    f['spin2z'] = numpy.random.uniform(-max_spin, max_spin, size=num)
+    f.attrs['parameters'] = ['mass1', 'mass2', 'spin1z', 'spin2z']
+    f.close()
+    return fname
+
 # Copied over from base_array.py so we can refactor it to remove
 # the scheme shuffling and take advantage of the new equality/almost
 # equal methods of the types.
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+""" Benchmark the auto-chisq for increasing numbers of points.
+
+The auto-chisq of a set of triggers is computed from a random SNR time series
+and autocorrelation, once with pycbc.vetoes.autochisq_at_lags, which gathers
+the points of all triggers at once, and once with a loop over the triggers,
+as autochisq_from_precomputed used to do. The time per trigger is printed for
+each number of points on each side of the trigger.
+"""
+import argparse, time
+import numpy
+from pycbc.vetoes import autochisq_lags, autochisq_at_lags
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--length', type=int, default=2**20,
+                    help='Length of the SNR time series')
+parser.add_argument('--num-triggers', type=int, default=10000)
+parser.add_argument('--stride', type=int, default=3)
+parser.add_argument('--num-points', type=int, nargs='+',
+                    default=[10, 50, 100, 200, 500])
+args = parser.parse_args()
+
+numpy.random.seed(0)
+n = args.length
+sn = (numpy.random.normal(size=n) +
+      numpy.random.normal(size=n) * 1.0j).astype(numpy.complex64)
+hautocorr = (numpy.random.normal(size=n) +
+             numpy.random.normal(size=n) * 1.0j) * 0.01
+indices = numpy.random.randint(0, n, size=args.num_triggers)
+
+def loop(lags, hauto):
+    chisq_norm = 1.0 - abs(hauto) ** 2
+    achisq = numpy.zeros(len(indices))
+    for i, ind in enumerate(indices):
+        snr = sn[ind]
+        cphi = snr.real / abs(snr)
+        sphi = snr.imag / abs(snr)
+        points = (lags + ind) % n
+        z = sn[points].real * cphi + sn[points].imag * sphi
+        dz = z - hauto.real * abs(snr)
+        chisq = dz * dz / chisq_norm
+        z = -sn[points].real * sphi + sn[points].imag * cphi
+        dz = z - hauto.imag * abs(snr)
+        chisq += dz * dz / chisq_norm
+        achisq[i] = chisq.sum()
+    return achisq
+
+print("%8s %16s %16s" % ('points', 'gather us/trig', 'loop us/trig'))
+for num_points in args.num_points:
+    lags, _ = autochisq_lags(n, stride=args.stride, num_points=num_points)
+    hauto = hautocorr[lags]
+
+    start = time.time()
+    autochisq_at_lags(sn, sn, hauto, lags, indices)
+    gather = (time.time() - start) / len(indices) * 1e6
+
+    start = time.time()
+    loop(lags, hauto)
+    legacy = (time.time() - start) / len(indices) * 1e6
+    print("%8d %16.2f %16.2f" % (num_points, gather, legacy))
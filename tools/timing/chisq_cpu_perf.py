@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+""" Benchmark the scaling of the CPU chisq kernels with the number of threads.
+
+The point-wise power chisq (shift_sum), the batched point-wise chisq of a
+block of templates (shift_sum_block) and the accumulation of the bins
+(chisq_accum_bin) are run in a CPU processing scheme with each number of
+threads. The time, speedup and parallel efficiency relative to the first
+number of threads are printed for each kernel.
+"""
+import argparse, time
+import numpy
+from pycbc.scheme import CPUScheme
+from pycbc.types import Array, zeros, complex64, float32
+from pycbc.vetoes.chisq_cpu import shift_sum, shift_sum_block, chisq_accum_bin
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--segment-length', type=int, default=256,
+                    help='Length of the data segment in seconds')
+parser.add_argument('--sample-rate', type=int, default=4096)
+parser.add_argument('--num-bins', type=int, default=16)
+parser.add_argument('--num-points', type=int, default=200,
+                    help='Number of trigger points')
+parser.add_argument('--num-templates', type=int, default=8,
+                    help='Number of templates in the block for shift_sum_block')
+parser.add_argument('--num-threads', type=int, nargs='+',
+                    default=[1, 2, 4, 8, 16, 32])
+parser.add_argument('--repeats', type=int, default=3,
+                    help='The best time of this many runs is printed')
+args = parser.parse_args()
+
+tlen = args.segment_length * args.sample_rate
+numpy.random.seed(0)
+block = numpy.random.normal(size=(args.num_templates, tlen)) + \
+        numpy.random.normal(size=(args.num_templates, tlen)) * 1.0j
+block = block.astype(complex64)
+corr = Array(block[0], copy=False)
+bins = numpy.linspace(tlen // 200, tlen // 4, args.num_bins + 1).astype(int)
+shifts = numpy.random.randint(0, tlen, size=args.num_points)
+
+rows = numpy.repeat(numpy.arange(args.num_templates), args.num_points)
+block_shifts = numpy.random.randint(0, tlen, size=len(rows))
+bin_edges = numpy.tile(bins, args.num_templates)
+bin_offsets = numpy.arange(args.num_templates + 1) * len(bins)
+
+chisq = zeros(tlen, dtype=float32)
+q = Array(block[1], copy=False)
+
+kernels = [
+    ('shift_sum', lambda: shift_sum(corr, shifts, bins)),
+    ('shift_sum_block', lambda: shift_sum_block(block, rows, block_shifts,
+                                                bin_edges, bin_offsets)),
+    ('chisq_accum_bin', lambda: chisq_accum_bin(chisq, q)),
+]
+
+def best_time(func):
+    times = []
+    for i in range(args.repeats):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+print("%16s %8s %12s %10s %12s" % ('kernel', 'threads', 'time (s)',
+                                   'speedup', 'efficiency'))
+for name, func in kernels:
+    # Compile the kernel before timing it
+    func()
+    first = None
+    for num in args.num_threads:
+        with CPUScheme(num_threads=num):
+            elapsed = best_time(func)
+        if first is None:
+            first = elapsed
+        speedup = first / elapsed
+        efficiency = speedup * args.num_threads[0] / num
+        print("%16s %8d %12.4f %10.2f %12.2f" % (name, num, elapsed, speedup,
+                                                 efficiency))
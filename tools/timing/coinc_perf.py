@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+""" Benchmark the time coincidence of two detectors with many timeslides.
+
+Random trigger times of two detectors are made coincident with
+pycbc.events.coinc.time_coincidence for each chunk size, once keeping all the
+pairs and once keeping only the zerolag and the background pairs above a
+threshold on a random statistic. The time and the number of pairs returned
+are printed for each chunk size.
+"""
+import argparse, time
+import numpy
+from pycbc.events.coinc import time_coincidence
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--num-triggers', type=int, default=20000,
+                    help='Number of triggers in each detector')
+parser.add_argument('--duration', type=float, default=100000,
+                    help='Length of time spanned by the triggers in seconds')
+parser.add_argument('--window', type=float, default=0.015)
+parser.add_argument('--timeslide-interval', type=float, default=0.5)
+parser.add_argument('--threshold', type=float, default=3.0,
+                    help='Threshold on the statistic of the background pairs')
+parser.add_argument('--chunk-sizes', type=int, nargs='+',
+                    default=[2**16, 2**20, 2**22, 2**24])
+args = parser.parse_args()
+
+numpy.random.seed(0)
+t1 = numpy.random.uniform(0, args.duration, size=args.num_triggers)
+t2 = numpy.random.uniform(0, args.duration, size=args.num_triggers)
+s1 = numpy.random.exponential(size=args.num_triggers)
+s2 = numpy.random.exponential(size=args.num_triggers)
+
+def keep(i1, i2, slide):
+    return (slide == 0) | (s1[i1] + s2[i2] > args.threshold)
+
+print("%12s %14s %12s %14s %12s" % ('chunk size', 'all (s)', 'all pairs',
+                                    'threshold (s)', 'pairs'))
+for chunk_size in args.chunk_sizes:
+    start = time.time()
+    num_all = len(time_coincidence(t1, t2, args.window,
+                                   args.timeslide_interval,
+                                   chunk_size=chunk_size)[0])
+    elapsed_all = time.time() - start
+
+    start = time.time()
+    num_kept = len(time_coincidence(t1, t2, args.window,
+                                    args.timeslide_interval, keep=keep,
+                                    chunk_size=chunk_size)[0])
+    elapsed_kept = time.time() - start
+    print("%12d %14.3f %12d %14.3f %12d" % (chunk_size, elapsed_all, num_all,
+                                            elapsed_kept, num_kept))
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+""" Benchmark the hierarchical matched filter against the full rate filter.
+
+A bank of binary neutron star templates is filtered against a segment of
+Gaussian noise containing a signal, once with the full rate matched filter
+using findchirp clustering, and once with the hierarchical matched filter for
+each downsample factor. The time per filter, the SNR found for the signal and
+the smallest bound on the SNR kept at the reduced rate over the bank
+(see pycbc.filter.hierarchical_snr_loss_bound) are printed.
+"""
+import argparse, time
+import numpy
+import pycbc.psd, pycbc.noise, pycbc.waveform
+from pycbc.filter import MatchedFilterControl, hierarchical_snr_loss_bound
+from pycbc.filter import make_frequency_series, sigmasq
+from pycbc.types import zeros, complex64, float32
+from pycbc import DYN_RANGE_FAC
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--segment-length', type=int, default=256,
+                    help='Length of the data segment in seconds')
+parser.add_argument('--sample-rate', type=int, default=4096)
+parser.add_argument('--low-frequency-cutoff', type=float, default=30.0)
+parser.add_argument('--num-templates', type=int, default=20,
+                    help='Number of templates in the bank')
+parser.add_argument('--downsample-factors', type=int, nargs='+',
+                    default=[2, 4, 8])
+parser.add_argument('--upsample-threshold', type=float, default=0.9)
+parser.add_argument('--snr-threshold', type=float, default=5.5)
+parser.add_argument('--signal-snr', type=float, default=10.0)
+args = parser.parse_args()
+
+tlen = args.segment_length * args.sample_rate
+flen = tlen // 2 + 1
+delta_f = 1.0 / args.segment_length
+delta_t = 1.0 / args.sample_rate
+flow = args.low_frequency_cutoff
+
+strain_psd = pycbc.psd.aLIGOZeroDetHighPower(flen, delta_f, flow)
+noise = pycbc.noise.noise_from_psd(tlen, delta_t, strain_psd, seed=0)
+noise = noise * DYN_RANGE_FAC
+psd = (strain_psd * DYN_RANGE_FAC ** 2).astype(float32)
+
+masses = numpy.linspace(1.2, 1.6, args.num_templates)
+def template(mass, out):
+    out.clear()
+    htilde = pycbc.waveform.get_waveform_filter(out[0:flen],
+                            approximant='TaylorF2', mass1=mass, mass2=mass,
+                            f_lower=flow, delta_f=delta_f, delta_t=delta_t,
+                            distance=1.0 / DYN_RANGE_FAC)
+    return htilde.astype(complex64)
+
+# Add a signal matching the middle template to the noise
+signal = template(masses[len(masses) // 2], zeros(tlen, dtype=complex64))
+signal = signal.cyclic_time_shift(args.segment_length / 2.0)
+amp = args.signal_snr / sigmasq(signal, psd, flow) ** 0.5
+stilde = make_frequency_series(noise).astype(complex64) + signal * amp
+stilde /= psd
+stilde.psd = psd
+stilde.analyze = slice(0, tlen)
+stilde.cumulative_index = 0
+
+def run(downsample_factor):
+    template_mem = zeros(tlen, dtype=complex64)
+    mf = MatchedFilterControl(flow, None, args.snr_threshold, tlen, delta_f,
+                              complex64, [stilde], template_mem, True,
+                              downsample_factor=downsample_factor,
+                              upsample_threshold=args.upsample_threshold,
+                              cluster_function='findchirp')
+    loudest = 0
+    elapsed = 0
+    for mass in masses:
+        htilde = template(mass, template_mem)
+        norm = sigmasq(htilde, psd, flow)
+        start = time.time()
+        _, snr_norm, _, idx, snrv = mf.matched_filter_and_cluster(0, norm,
+                                                    args.sample_rate)
+        elapsed += time.time() - start
+        if len(idx):
+            loudest = max(loudest, abs(numpy.array(snrv)).max() * snr_norm)
+    return elapsed / len(masses), loudest
+
+print("%8s %16s %12s %12s" % ('factor', 'ms per filter', 'signal snr',
+                              'loss bound'))
+full_time, full_snr = run(1)
+print("%8d %16.1f %12.2f %12s" % (1, full_time * 1000, full_snr, '-'))
+
+for factor in args.downsample_factors:
+    bound = min(hierarchical_snr_loss_bound(template(m, zeros(tlen,
+                                            dtype=complex64)), psd, factor,
+                                            low_frequency_cutoff=flow)
+                for m in masses)
+    red_time, red_snr = run(factor)
+    print("%8d %16.1f %12.2f %12.3f" % (factor, red_time * 1000, red_snr,
+                                        bound))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+""" Benchmark the ways of calculating the power chisq at trigger points.
+
+For a block of templates, each with the given number of trigger points, the
+chisq is calculated with the direct method one template at a time, with the
+batched kernel for all templates at once, and with inverse FFTs of the bins.
+The method chosen by the measured cost model of SingleDetPowerChisq is
+printed for each number of points.
+"""
+import argparse, time
+import numpy
+from pycbc.types import Array, TimeSeries, complex64
+from pycbc.vetoes import power_chisq_at_points_from_precomputed
+from pycbc.vetoes import power_chisq_at_points_block
+from pycbc.vetoes import power_chisq_from_precomputed, PowerChisqCostModel
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--segment-length', type=int, default=256,
+                    help='Length of the data segment in seconds')
+parser.add_argument('--sample-rate', type=int, default=4096)
+parser.add_argument('--num-templates', type=int, default=16)
+parser.add_argument('--num-bins', type=int, default=16)
+parser.add_argument('--num-points', type=int, nargs='+',
+                    default=[1, 10, 100, 1000],
+                    help='Numbers of trigger points per template')
+args = parser.parse_args()
+
+tlen = args.segment_length * args.sample_rate
+numpy.random.seed(0)
+block = numpy.random.normal(size=(args.num_templates, tlen)) + \
+        numpy.random.normal(size=(args.num_templates, tlen)) * 1.0j
+block = block.astype(complex64)
+corrs = [Array(row, copy=False) for row in block]
+snr = TimeSeries(numpy.zeros(tlen, dtype=complex64),
+                 delta_t=1.0 / args.sample_rate)
+kmax = tlen // 4
+bins = numpy.linspace(tlen // 200, kmax, args.num_bins + 1).astype(int)
+model = PowerChisqCostModel()
+
+print("%8s %14s %14s %14s %8s" % ('points', 'direct (s)', 'batched (s)',
+                                  'fft (s)', 'model'))
+for num in args.num_points:
+    indices = [numpy.random.randint(0, tlen, size=num)
+               for i in range(args.num_templates)]
+    snrv = numpy.zeros(num, dtype=complex64)
+
+    start = time.time()
+    for corr, idx in zip(corrs, indices):
+        power_chisq_at_points_from_precomputed(corr, snrv, 1.0, bins, idx)
+    direct = time.time() - start
+
+    start = time.time()
+    rows = numpy.repeat(numpy.arange(args.num_templates), num)
+    power_chisq_at_points_block(block, rows,
+                                numpy.zeros(len(rows), dtype=complex64),
+                                numpy.ones(args.num_templates),
+                                [bins] * args.num_templates,
+                                numpy.concatenate(indices))
+    batched = time.time() - start
+
+    start = time.time()
+    for corr, idx in zip(corrs, indices):
+        power_chisq_from_precomputed(corr, snr, 1.0, bins, indices=idx)
+    fft = time.time() - start
+
+    choice = 'fft' if model.use_fft(corrs[0], snr, bins, num) else 'direct'
+    print("%8d %14.3f %14.3f %14.3f %8s" % (num, direct, batched, fft, choice))
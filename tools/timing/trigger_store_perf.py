@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+""" Benchmark accumulating triggers in the EventManager.
+
+Triggers are added in chunks, one chunk per template, as pycbc_inspiral does.
+The time per trigger of the EventManager (backed by a TriggerStore) should be
+independent of the total number of triggers, while repeatedly calling
+numpy.append on a structured array scales quadratically.
+"""
+import argparse, time
+import numpy
+from pycbc.events import EventManager
+from pycbc.types import complex64, float32
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--max-triggers', type=int, default=10**7,
+                    help='Largest number of triggers to accumulate')
+parser.add_argument('--triggers-per-template', type=int, default=100,
+                    help='Number of triggers added for each template')
+parser.add_argument('--max-legacy-triggers', type=int, default=10**5,
+                    help='Largest number of triggers to accumulate with '
+                         'numpy.append, for comparison')
+args = parser.parse_args()
+
+names = ['chisq', 'chisq_dof', 'snr', 'time_index']
+types = [float32, int, complex64, int]
+chunk = args.triggers_per_template
+
+def chunk_vectors(i):
+    return [numpy.ones(chunk, dtype=numpy.float32),
+            numpy.ones(chunk, dtype=int),
+            numpy.ones(chunk, dtype=numpy.complex64),
+            numpy.arange(i * chunk, (i + 1) * chunk)]
+
+def event_manager(num):
+    mgr = EventManager(None, names, types)
+    for i in range(num // chunk):
+        mgr.new_template(tmplt=None, sigmasq=1.0)
+        mgr.add_template_events(names, chunk_vectors(i))
+        mgr.finalize_template_events()
+    return len(mgr.events)
+
+def legacy_append(num):
+    dtype = [('template_id', int)] + list(zip(names, types))
+    events = numpy.array([], dtype=dtype)
+    for i in range(num // chunk):
+        new = numpy.zeros(chunk, dtype=dtype)
+        new['template_id'] = i
+        for n, v in zip(names, chunk_vectors(i)):
+            new[n] = v
+        events = numpy.append(events, new)
+    return len(events)
+
+print("%12s %16s %16s" % ('triggers', 'store ns/trig', 'append ns/trig'))
+num = 10**4
+while num <= args.max_triggers:
+    start = time.time()
+    found = event_manager(num)
+    store_time = (time.time() - start) / found * 1e9
+
+    legacy = '-'
+    if num <= args.max_legacy_triggers:
+        start = time.time()
+        found = legacy_append(num)
+        legacy = '%.1f' % ((time.time() - start) / found * 1e9)
+
+    print("%12d %16.1f %16s" % (num, store_time, legacy))
+    num *= 10